@@ -0,0 +1,201 @@
+"""
+Benchmarks for the MemoryDatabase hot paths on synthetic corpora.
+
+Uses a deterministic fake word2vec model in place of the real download, like tests/test_memory_database.py does, so it
+runs offline and gives comparable numbers between commits on the same machine:
+
+    python benchmarks/benchmark_memory_database.py --output before.json
+    python benchmarks/benchmark_memory_database.py --output after.json --compare before.json
+"""
+import argparse
+import contextlib
+import glob
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+from unittest.mock import patch
+
+import numpy as np
+from gensim.models import KeyedVectors
+from sqlalchemy import insert
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from memory_database import DialogueHistory, MemoryDatabase, Memories  # noqa: E402
+from token_counter import count_tokens  # noqa: E402
+
+VOCABULARY_SIZE = 20000
+VECTOR_SIZE = 300
+SEED_BATCH_SIZE = 10000
+
+
+def fake_word2vec(seed: int = 0) -> KeyedVectors:
+    """Deterministic word vectors for a vocabulary of 'word0'...'wordN'"""
+    rng = np.random.default_rng(seed)
+    model = KeyedVectors(VECTOR_SIZE)
+    model.add_vectors([f'word{i}' for i in range(VOCABULARY_SIZE)],
+                      rng.normal(size=(VOCABULARY_SIZE, VECTOR_SIZE)).astype(np.float32))
+    return model
+
+
+def random_text(rng: np.random.Generator, min_words: int = 3, max_words: int = 12) -> str:
+    # A few words outside the vocabulary, as in real text
+    word_numbers = rng.integers(0, VOCABULARY_SIZE * 1.1, size=rng.integers(min_words, max_words + 1))
+    return ' '.join(f'word{number}' for number in word_numbers)
+
+
+def timestamp(offset_seconds: int) -> str:
+    return (datetime(2023, 1, 1) + timedelta(seconds=offset_seconds)).isoformat()
+
+
+def seed_corpus(memory_db: MemoryDatabase, size: int, rng: np.random.Generator):
+    """Bulk insert size memories and size dialogue rows, bypassing the code being measured"""
+    for start in range(0, size, SEED_BATCH_SIZE):
+        count = min(SEED_BATCH_SIZE, size - start)
+        summaries = [random_text(rng) for _ in range(count)]
+        prompts = [random_text(rng, 8, 30) for _ in range(count)]
+        contents = [random_text(rng, 5, 40) for _ in range(count)]
+        embeddings = memory_db.generate_embeddings(summaries)
+        # Token counts are filled in as saving would, otherwise the next startup backfills them and that's timed too
+        with memory_db.db.write_session() as session:
+            session.execute(insert(Memories), [
+                {'memory_summary': summary, 'related_prompt': prompt, 'token_count': count_tokens(prompt),
+                 'embedding': memory_db._serialize_embedding(embedding), 'timestamp': timestamp(start + i),
+                 'importance': float(rng.uniform(2.0, 10.0))}
+                for i, (summary, prompt, embedding) in enumerate(zip(summaries, prompts, embeddings))])
+            session.execute(insert(DialogueHistory), [
+                {'speaker': 'user' if (start + i) % 2 == 0 else 'assistant', 'content': content,
+                 'token_count': count_tokens(content), 'timestamp': timestamp(start + i)}
+                for i, content in enumerate(contents)])
+
+
+def summarise(durations: List[float]) -> Dict:
+    milliseconds = np.array(durations) * 1000
+    return {'count': len(milliseconds), 'mean_ms': float(milliseconds.mean()),
+            'p50_ms': float(np.percentile(milliseconds, 50)), 'p95_ms': float(np.percentile(milliseconds, 95)),
+            'min_ms': float(milliseconds.min())}
+
+
+def time_calls(function: Callable, arguments: List[tuple]) -> Dict:
+    durations = []
+    for call_arguments in arguments:
+        begin_time = time.perf_counter()
+        function(*call_arguments)
+        durations.append(time.perf_counter() - begin_time)
+    return summarise(durations)
+
+
+def time_once(function: Callable) -> Dict:
+    return time_calls(function, [()])
+
+
+def remove_index_snapshot(db_file: str):
+    for path in glob.glob(f'{db_file}.annoy*'):
+        os.remove(path)
+
+
+def benchmark_size(size: int, operations: int, work_dir: str, seed: int) -> Dict:
+    rng = np.random.default_rng(seed)
+    db_file = os.path.join(work_dir, f'memories_{size}.db')
+
+    memory_db = MemoryDatabase(db_file)
+    begin_time = time.perf_counter()
+    seed_corpus(memory_db, size, rng)
+    print(f"  seeded in {time.perf_counter() - begin_time:.1f}s", file=sys.__stdout__)
+
+    results = {}
+    remove_index_snapshot(db_file)
+    results['startup_without_snapshot'] = time_once(lambda: MemoryDatabase(db_file))
+    results['startup_with_snapshot'] = time_once(lambda: MemoryDatabase(db_file))
+    memory_db = MemoryDatabase(db_file)
+    results['_build_annoy_index'] = time_once(lambda: memory_db._build_annoy_index(memory_db.partition()))
+
+    queries = [(random_text(rng, 5, 30),) for _ in range(operations)]
+    results['retrieve_relevant_memories'] = time_calls(memory_db.retrieve_relevant_memories, queries)
+    results['get_dialogue_history'] = time_calls(memory_db.get_dialogue_history, [(10,)] * operations)
+    results['get_dialogue_history_unlimited'] = time_calls(memory_db.get_dialogue_history, [()] * min(operations, 10))
+
+    results['insert_memory'] = time_calls(memory_db.insert_memory, [
+        (random_text(rng), random_text(rng, 8, 30), timestamp(size + i), 5.0) for i in range(operations)])
+    # An importance of 5 scales to 1.25 and is dropped, 10 is kept
+    results['save_memory'] = time_calls(memory_db.save_memory, [
+        (random_text(rng), random_text(rng, 8, 30), timestamp(size + operations + i), 5.0 if i % 2 else 10.0)
+        for i in range(operations)])
+    dialogue = [('user', random_text(rng, 5, 40), timestamp(size + i)) for i in range(operations)]
+    results['save_dialogue_entry'] = time_calls(memory_db.save_dialogue_entry, dialogue)
+    memory_db.close()
+
+    # Queued writes return straight away, the commits are timed by the flush
+    memory_db = MemoryDatabase(db_file, write_behind='async')
+    results['save_dialogue_entry_write_behind'] = time_calls(memory_db.save_dialogue_entry, dialogue)
+    results['write_behind_flush'] = time_once(memory_db.flush)
+    memory_db.close()
+    return results
+
+
+def environment() -> Dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__,
+            'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+            'date': datetime.now().isoformat()}
+
+
+def compare(previous: Dict, current: Dict):
+    print(f"\nCompared with {previous['environment'].get('commit')}:")
+    for size, operations in current['results'].items():
+        for operation, stats in operations.items():
+            previous_stats = previous['results'].get(size, {}).get(operation)
+            if previous_stats:
+                ratio = stats['p50_ms'] / previous_stats['p50_ms'] if previous_stats['p50_ms'] else float('inf')
+                print(f"{size:>8} {operation:<32} {previous_stats['p50_ms']:>10.3f}ms -> {stats['p50_ms']:>10.3f}ms "
+                      f"({ratio:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the MemoryDatabase hot paths")
+    parser.add_argument('--sizes', default='1000,10000,100000,1000000',
+                        help="Comma separated corpus sizes, in memories and dialogue rows")
+    parser.add_argument('--operations', type=int, default=200, help="Calls timed per operation")
+    parser.add_argument('--output', default='benchmark_results.json', help="Where to write the JSON results")
+    parser.add_argument('--compare', help="Previous results to compare against")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='memory_benchmark_')
+    os.environ['GPT_MEMORY_MODEL_CACHE'] = os.path.join(work_dir, 'model_cache')
+    results = {}
+    try:
+        with patch('gensim.downloader.load', return_value=fake_word2vec(args.seed)):
+            for size in [int(size) for size in args.sizes.split(',')]:
+                print(f"{size} memories", file=sys.__stdout__)
+                # MemoryDatabase logs every insert, which would swamp the output
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    results[str(size)] = benchmark_size(size, args.operations, work_dir, args.seed)
+                for operation, stats in results[str(size)].items():
+                    print(f"  {operation:<32} p50={stats['p50_ms']:.3f}ms p95={stats['p95_ms']:.3f}ms")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = {'environment': environment(), 'operations': args.operations, 'results': results}
+    with open(args.output, 'w') as output_file:
+        json.dump(output, output_file, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as previous_file:
+            compare(json.load(previous_file), output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from token_counter import REPLY_PRIMING_TOKENS, count_tokens, message_tokens
+
+# The context window of each model, in tokens, prompt and reply together
+MODEL_CONTEXT_TOKENS = {
+    'gpt-4': 8192,
+    'gpt-4-32k': 32768,
+    'gpt-3.5-turbo': 4096,
+    'gpt-3.5-turbo-16k': 16384,
+}
+DEFAULT_CONTEXT_TOKENS = 4096
+
+
+def prompt_token_budget(model: str, reply_tokens: int = 1000, overrides: Dict[str, int] = None) -> int:
+    """
+    The most tokens a prompt to model should take up, leaving room for the reply.
+
+    :param model: The model name, dated versions like gpt-4-0613 use their base model's window.
+    :param reply_tokens: The tokens kept free for the reply.
+    :param overrides: Prompt budgets by model name, used as they are.
+    """
+    if overrides and model in overrides:
+        return overrides[model]
+    # Longest matching prefix, so gpt-4-32k-0613 isn't taken for gpt-4
+    matches = [name for name in MODEL_CONTEXT_TOKENS if model == name or model.startswith(f'{name}-')]
+    context_tokens = MODEL_CONTEXT_TOKENS[max(matches, key=len)] if matches else DEFAULT_CONTEXT_TOKENS
+    return max(context_tokens - reply_tokens, 0)
+
+
+class _Section:
+    def __init__(self, name: str, messages: List[Tuple[Dict[str, str], int]], priority: Optional[int],
+                 max_tokens: Optional[int], newest_first: bool):
+        self.name = name
+        self.messages = messages
+        self.priority = priority
+        self.max_tokens = max_tokens
+        self.newest_first = newest_first
+        self.included: List[bool] = [priority is None] * len(messages)
+        self.tokens = 0
+
+
+class ContextBuilder:
+    """
+    Packs a prompt into a token budget a section at a time.
+
+    Sections are added in the order they appear in the prompt, each with a priority. Required sections always go in,
+    then the rest are filled most important first, each message going in if it still fits. The messages are counted
+    once, by whoever has the count to hand, so nothing is tokenized again to build the prompt.
+    """
+
+    def __init__(self, budget: int):
+        """
+        :param budget: The most tokens the prompt may take up.
+        """
+        self.budget = budget
+        self._sections: List[_Section] = []
+
+    def add_section(self, name: str, messages: Sequence[Dict[str, str]], token_counts: Sequence[int] = None,
+                    priority: int = None, max_tokens: int = None, newest_first: bool = False):
+        """
+        Add the next section of the prompt.
+
+        :param name: Identifies the section in token_usage.
+        :param messages: The section's chat messages, in prompt order.
+        :param token_counts: The tokens in each message's content, counted here if None.
+        :param priority: Lower priorities are filled first, None for a section that always goes in whole.
+        :param max_tokens: The most tokens the section may take up.
+        :param newest_first: Fill from the last message back, stopping at the first that doesn't fit, so a
+            conversation is cut off at its oldest end rather than having gaps. Otherwise messages are filled in order,
+            skipping any that don't fit.
+        """
+        if token_counts is None:
+            token_counts = [count_tokens(message['content']) for message in messages]
+        self._sections.append(_Section(name, [(message, message_tokens(tokens))
+                                              for message, tokens in zip(messages, token_counts)],
+                                       priority, max_tokens, newest_first))
+
+    def build(self) -> List[Dict[str, str]]:
+        """The prompt's messages, the required sections and as much of the rest as fits in the budget"""
+        used = REPLY_PRIMING_TOKENS
+        for section in self._sections:
+            section.tokens = 0
+            section.included = [section.priority is None] * len(section.messages)
+            if section.priority is None:
+                section.tokens = sum(tokens for _, tokens in section.messages)
+                used += section.tokens
+
+        # A stable sort, so sections with the same priority are filled in prompt order
+        for section in sorted((section for section in self._sections if section.priority is not None),
+                              key=lambda section: section.priority):
+            order = range(len(section.messages))
+            if section.newest_first:
+                order = reversed(order)
+            for i in order:
+                tokens = section.messages[i][1]
+                fits = used + tokens <= self.budget and \
+                    (section.max_tokens is None or section.tokens + tokens <= section.max_tokens)
+                if not fits:
+                    if section.newest_first:
+                        break
+                    continue
+                section.included[i] = True
+                section.tokens += tokens
+                used += tokens
+
+        return [message for section in self._sections
+                for (message, _), included in zip(section.messages, section.included) if included]
+
+    def token_usage(self) -> Dict[str, int]:
+        """The tokens each section took up in the last build"""
+        return {section.name: section.tokens for section in self._sections}
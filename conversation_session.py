@@ -0,0 +1,127 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Dict, List
+
+DEFAULT_CONVERSATION_ID = 'default'
+
+
+class ConversationSession:
+    """
+    The in-memory state of one conversation: the last prompt sent, the memories that hang around for a few replies
+    and the condensed history.
+
+    Replies for the same conversation can overlap, so the state is only changed while holding the session's lock.
+    """
+
+    def __init__(self, conversation_id: str, assistant_instruction: str, recent_memory_limit: int = 15,
+                 condensed_history_limit: int = 10):
+        """
+        :param conversation_id: The channel, DM or user the conversation is with.
+        :param assistant_instruction: The system message each prompt starts with.
+        :param recent_memory_limit: The most recent memories kept between replies.
+        :param condensed_history_limit: The most condensed history summaries kept.
+        """
+        self.conversation_id = conversation_id
+        self.assistant_instruction = assistant_instruction
+        self.recent_memory_limit = recent_memory_limit
+        self.lock = threading.Lock()
+        self.messages: List[Dict[str, str]] = []
+        self.recent_memories: List[Dict[str, str]] = []
+        self.dialogue_history_condensed = deque(maxlen=condensed_history_limit)
+        # How long each stage of the conversation's latest prompt took in milliseconds, and its tokens by section
+        self.last_stage_timings: Dict[str, float] = {}
+        self.last_token_usage: Dict[str, int] = {}
+        self.last_used = time.monotonic()
+        self.clear_messages()
+
+    def clear_messages(self):
+        self.messages = [{"role": "system", "content": f'{self.assistant_instruction}'}]
+
+    def add_message(self, role: str, content: str):
+        self.messages.append({"role": role, "content": content})
+
+    def add_recent_memories(self, memories: List[Dict[str, str]],
+                            results: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        """
+        Add retrieved memories, skipping any already there, expire the oldest past the limit, then add the results of
+        profile actions.
+
+        :return: A copy of the recent memories to build the prompt from.
+        """
+        with self.lock:
+            for memory in memories:
+                # Check if this memory is already in the recent memories
+                if all(recent_memory['content'] != memory['content'] for recent_memory in self.recent_memories):
+                    self.recent_memories.append(memory)
+            # A mechanism for having memories hang around for a few responses, allows discussion
+            del self.recent_memories[:max(0, len(self.recent_memories) - self.recent_memory_limit)]
+            self.recent_memories.extend(results)
+            return list(self.recent_memories)
+
+    def add_condensed_history(self, content: str):
+        with self.lock:
+            self.dialogue_history_condensed.append(content)
+
+    def get_condensed_history(self) -> List[str]:
+        with self.lock:
+            return list(self.dialogue_history_condensed)
+
+
+class SessionManager:
+    """
+    Conversation sessions by id, created on first use and evicted once idle for idle_timeout seconds, or oldest first
+    when there are more than max_sessions.
+    """
+
+    def __init__(self, assistant_instruction: str, idle_timeout: float = 3600, max_sessions: int = 1000,
+                 recent_memory_limit: int = 15):
+        self.assistant_instruction = assistant_instruction
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.recent_memory_limit = recent_memory_limit
+        self._lock = threading.Lock()
+        # Least recently used first
+        self._sessions: 'OrderedDict[str, ConversationSession]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __contains__(self, conversation_id: str) -> bool:
+        return conversation_id in self._sessions
+
+    def get(self, conversation_id: str = DEFAULT_CONVERSATION_ID) -> ConversationSession:
+        """The conversation's session, created if it's new or was evicted"""
+        with self._lock:
+            session = self._sessions.get(conversation_id)
+            if session is None:
+                session = ConversationSession(conversation_id, self.assistant_instruction,
+                                              recent_memory_limit=self.recent_memory_limit)
+                self._sessions[conversation_id] = session
+            else:
+                self._sessions.move_to_end(conversation_id)
+            session.last_used = time.monotonic()
+            self._evict(keep=conversation_id)
+        return session
+
+    def evict_idle(self) -> int:
+        """
+        Remove sessions that haven't been used for idle_timeout seconds.
+
+        :return: The number of sessions removed.
+        """
+        with self._lock:
+            return self._evict()
+
+    def _evict(self, keep: str = None) -> int:
+        evicted = 0
+        idle_before = time.monotonic() - self.idle_timeout
+        while self._sessions:
+            conversation_id, session = next(iter(self._sessions.items()))
+            if conversation_id == keep:
+                break
+            if session.last_used >= idle_before and len(self._sessions) <= self.max_sessions:
+                break
+            del self._sessions[conversation_id]
+            evicted += 1
+        return evicted
@@ -0,0 +1,107 @@
+import contextlib
+import threading
+from typing import Iterator
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import QueuePool, StaticPool
+
+
+class SQLiteDatabase:
+    """
+    Connections to one SQLite file, shared by everything that uses it.
+
+    The database runs in WAL mode so reads never wait for a write to commit. Reads use a pool of connections, one per
+    thread reading at the time, marked query_only. All writes go through a single connection, one write session at a
+    time, which is what SQLite allows anyway but without busy retries.
+    """
+
+    def __init__(self, db_file: str, synchronous: str = 'NORMAL', cache_size_kib: int = 65536,
+                 reader_pool_size: int = 8, busy_timeout_ms: int = 30000):
+        """
+        :param db_file: The SQLite file, or ':memory:'.
+        :param synchronous: SQLite's synchronous setting, NORMAL is safe from corruption in WAL mode but the last
+            transactions before a power loss may be rolled back, FULL syncs every commit.
+        :param cache_size_kib: Page cache size per connection.
+        :param reader_pool_size: Reader connections kept open.
+        :param busy_timeout_ms: How long to wait for a lock held by another process.
+        """
+        self.db_file = db_file
+        self.synchronous = synchronous
+        self.cache_size_kib = cache_size_kib
+        self.busy_timeout_ms = busy_timeout_ms
+
+        if db_file == ':memory:':
+            # Every connection to :memory: is a separate database, so readers have to share the writer's connection
+            # and take turns with it
+            self.writer_engine = create_engine("sqlite://", connect_args={"check_same_thread": False},
+                                               poolclass=StaticPool, echo=False)
+            self.reader_engine = self.writer_engine
+            self._read_lock = self._write_lock = threading.RLock()
+        else:
+            self.writer_engine = create_engine(f"sqlite:///{db_file}", connect_args={"check_same_thread": False},
+                                               poolclass=QueuePool, pool_size=1, max_overflow=0, echo=False)
+            self.reader_engine = create_engine(f"sqlite:///{db_file}", connect_args={"check_same_thread": False},
+                                               poolclass=QueuePool, pool_size=reader_pool_size,
+                                               max_overflow=reader_pool_size, echo=False)
+            self._write_lock = threading.RLock()
+            self._read_lock = contextlib.nullcontext()
+            event.listen(self.writer_engine, 'connect', self._configure_writer)
+            event.listen(self.reader_engine, 'connect', self._configure_reader)
+
+        # Objects stay usable after their session closes, which every caller relies on
+        self._writer_sessions = sessionmaker(bind=self.writer_engine, expire_on_commit=False)
+        self._reader_sessions = sessionmaker(bind=self.reader_engine, expire_on_commit=False)
+
+    def _configure_connection(self, dbapi_connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+        cursor.execute(f"PRAGMA cache_size = -{int(self.cache_size_kib)}")
+        cursor.execute(f"PRAGMA synchronous = {self.synchronous}")
+        cursor.close()
+
+    def _configure_writer(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # Persistent in the file, so readers opened afterwards pick it up too
+        cursor.execute("PRAGMA journal_mode = WAL")
+        cursor.close()
+        self._configure_connection(dbapi_connection)
+
+    def _configure_reader(self, dbapi_connection, connection_record):
+        self._configure_connection(dbapi_connection)
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA query_only = 1")
+        cursor.close()
+
+    @contextlib.contextmanager
+    def write_session(self) -> Iterator[Session]:
+        """A session on the writer connection, committed when the block exits and rolled back if it raises"""
+        with self._write_lock:
+            session = self._writer_sessions()
+            try:
+                yield session
+                session.commit()
+            except BaseException:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+
+    @contextlib.contextmanager
+    def read_session(self) -> Iterator[Session]:
+        """A session on a pooled reader connection"""
+        with self._read_lock:
+            session = self._reader_sessions()
+            try:
+                yield session
+            finally:
+                session.close()
+
+    def create_all(self, metadata):
+        # Through the writer, as the database may not exist yet and readers can't create it
+        with self._write_lock:
+            metadata.create_all(bind=self.writer_engine)
+
+    def dispose(self):
+        self.writer_engine.dispose()
+        self.reader_engine.dispose()
@@ -0,0 +1,363 @@
+import argparse
+import glob
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Sequence
+
+import gensim.downloader as api
+import numpy as np
+from gensim.models import KeyedVectors
+
+WORD2VEC_MODEL = "word2vec-google-news-300"
+DEFAULT_MODEL_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'gpt-semantic-memory')
+
+_loaded_models: Dict[str, object] = {}
+_loaded_models_lock = threading.Lock()
+
+
+def load_word2vec(model_name: str = WORD2VEC_MODEL, cache_dir: str = None):
+    """
+    Load a gensim-downloader model as read-only, memory-mapped KeyedVectors.
+
+    The first load on a host converts the downloaded model to gensim's native format in cache_dir, after that every
+    process maps the same file so the vectors live once in the page cache rather than in each process's heap. Within a
+    process every caller gets the same KeyedVectors instance.
+
+    :param model_name: The gensim-downloader model name.
+    :param cache_dir: Where to keep the converted model, defaults to $GPT_MEMORY_MODEL_CACHE or ~/.cache.
+    :return: The word vectors.
+    """
+    cache_dir = cache_dir or os.environ.get('GPT_MEMORY_MODEL_CACHE') or DEFAULT_MODEL_CACHE_DIR
+    native_path = os.path.join(cache_dir, f'{model_name}.kv')
+
+    with _loaded_models_lock:
+        if native_path in _loaded_models:
+            return _loaded_models[native_path]
+
+        if not os.path.exists(native_path):
+            model = api.load(model_name)
+            if not isinstance(model, KeyedVectors):
+                # Can't be saved natively, so there's nothing to map
+                return model
+            print(f"Converting {model_name} to {native_path}... ", end='')
+            _save_native(model, native_path)
+            print("done")
+            del model
+
+        model = KeyedVectors.load(native_path, mmap='r')
+        _loaded_models[native_path] = model
+        return model
+
+
+def _save_native(model: KeyedVectors, native_path: str):
+    """Save model so that it can be memory-mapped, renaming the finished files into place so readers never see a
+    partial save"""
+    os.makedirs(os.path.dirname(native_path), exist_ok=True)
+    temp_path = f'{native_path}.{os.getpid()}.tmp'
+    # sep_limit=0 stores every array in its own .npy file, which is what allows it to be mapped
+    model.save(temp_path, sep_limit=0)
+
+    # The arrays first, the main file last as its existence is what marks the conversion as finished
+    for array_path in glob.glob(f'{glob.escape(temp_path)}.*.npy'):
+        os.replace(array_path, native_path + array_path[len(temp_path):])
+    os.replace(temp_path, native_path)
+
+
+class CompactWordVectors:
+    """
+    A pruned word2vec model holding only the vocabulary whitespace-split, lowercased text can actually hit, optionally
+    with float16 vectors and hashed buckets that stand in for words pruned from the vocabulary.
+
+    Provides the parts of the KeyedVectors interface used for embedding text. Built with build_compact_model.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, 'metadata.json')) as metadata_file:
+            self.metadata = json.load(metadata_file)
+        with open(os.path.join(path, 'vocab.txt'), encoding='utf-8') as vocab_file:
+            vocab = vocab_file.read()
+        self.index_to_key = vocab.split('\n') if vocab else []
+        self.key_to_index = {key: index for index, key in enumerate(self.index_to_key)}
+        # Hash buckets are stored as the rows after the vocabulary
+        self.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+        self.vector_size = self.vectors.shape[1]
+        self.hash_buckets = self.metadata['hash_buckets']
+        self.name = self.metadata['name']
+
+    def __len__(self) -> int:
+        return len(self.index_to_key)
+
+    def __contains__(self, key: str) -> bool:
+        return self.hash_buckets > 0 or key in self.key_to_index
+
+    def __getitem__(self, key: str) -> np.ndarray:
+        return np.asarray(self.vectors[self.get_index(key)], dtype=np.float32)
+
+    def get_index(self, key: str, default: Optional[int] = None) -> Optional[int]:
+        """Same as KeyedVectors.get_index, raises KeyError for unknown keys unless a default is given"""
+        index = self.key_to_index.get(key)
+        if index is not None:
+            return index
+        if self.hash_buckets > 0:
+            return len(self.index_to_key) + _hash_bucket(key, self.hash_buckets)
+        if default is not None:
+            return default
+        raise KeyError(f"Key '{key}' not present")
+
+
+class EmbeddingCache:
+    """
+    Thread-safe LRU cache of text embeddings.
+
+    Keys are the lowercased, whitespace-normalised text, which is all embedding looks at, so texts differing only in
+    case or spacing share an entry. Cached arrays are read-only as they're handed to every caller.
+    """
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._embeddings: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._embeddings)
+
+    @staticmethod
+    def normalise(text: str) -> str:
+        return ' '.join(text.lower().split())
+
+    def get(self, text: str, generate: Callable[[str], np.ndarray]) -> np.ndarray:
+        """Return the cached embedding for text, calling generate(text) to create it on a miss"""
+        if self.max_size <= 0:
+            return generate(text)
+
+        key = self.normalise(text)
+        with self._lock:
+            embedding = self._embeddings.get(key)
+            if embedding is not None:
+                self._embeddings.move_to_end(key)
+                self.hits += 1
+                return embedding
+            self.misses += 1
+
+        # Generated outside the lock so a miss doesn't hold up other threads, two threads missing on the same text
+        # at once just both generate it
+        embedding = generate(text)
+        embedding.setflags(write=False)
+        with self._lock:
+            self._embeddings[key] = embedding
+            self._embeddings.move_to_end(key)
+            while len(self._embeddings) > self.max_size:
+                self._embeddings.popitem(last=False)
+        return embedding
+
+    def clear(self):
+        with self._lock:
+            self._embeddings.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self._embeddings), 'max_size': self.max_size, 'hits': self.hits,
+                    'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+def _hash_bucket(word: str, hash_buckets: int) -> int:
+    # crc32 rather than hash() as it has to be stable between processes
+    return zlib.crc32(word.encode('utf-8')) % hash_buckets
+
+
+def build_compact_model(model: KeyedVectors, path: str, top_n: int = 200000, float16: bool = False,
+                        hash_buckets: int = 0, source_name: str = WORD2VEC_MODEL) -> CompactWordVectors:
+    """
+    Write a compact copy of model to the directory at path.
+
+    Text is lowercased and split on whitespace before lookup, so only lowercase keys without phrase underscores can
+    ever match. The top_n most frequent of those are kept. Each hash bucket is the mean of the pruned lowercase words
+    that hash to it.
+
+    :param model: The full model, with keys ordered by frequency as in the gensim-downloader models.
+    :param path: Directory to write the compact model to.
+    :param top_n: The number of vocabulary entries to keep.
+    :param float16: Store vectors as float16, halving the size again.
+    :param hash_buckets: The number of fallback buckets for out of vocabulary words, 0 to skip words as usual.
+    :param source_name: Name of the full model, recorded so stored embeddings can be tied to the model used.
+    :return: The compact model.
+    """
+    kept_indices = []
+    bucket_sums = np.zeros((hash_buckets, model.vector_size), dtype=np.float64)
+    bucket_counts = np.zeros(hash_buckets, dtype=np.int64)
+    for index, key in enumerate(model.index_to_key):
+        if key != key.lower() or '_' in key:
+            continue
+        if len(kept_indices) < top_n:
+            kept_indices.append(index)
+        elif hash_buckets > 0:
+            bucket = _hash_bucket(key, hash_buckets)
+            bucket_sums[bucket] += model.vectors[index]
+            bucket_counts[bucket] += 1
+        else:
+            break
+
+    vectors = np.asarray(model.vectors[kept_indices], dtype=np.float32)
+    if hash_buckets > 0:
+        bucket_vectors = bucket_sums / np.maximum(bucket_counts, 1)[:, np.newaxis]
+        vectors = np.concatenate([vectors, bucket_vectors.astype(np.float32)])
+
+    name = f'{source_name}-compact-{top_n}' + ('-f16' if float16 else '') + \
+           (f'-h{hash_buckets}' if hash_buckets > 0 else '')
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'vectors.npy'), vectors.astype(np.float16 if float16 else np.float32))
+    with open(os.path.join(path, 'vocab.txt'), 'w', encoding='utf-8') as vocab_file:
+        vocab_file.write('\n'.join(model.index_to_key[index] for index in kept_indices))
+    with open(os.path.join(path, 'metadata.json'), 'w') as metadata_file:
+        json.dump({'name': name, 'source': source_name, 'top_n': top_n, 'float16': float16,
+                   'hash_buckets': hash_buckets}, metadata_file)
+
+    return CompactWordVectors(path)
+
+
+def load_compact_word2vec(path: str) -> CompactWordVectors:
+    """Load a compact model built by build_compact_model, shared by every caller in this process"""
+    path = os.path.abspath(path)
+    with _loaded_models_lock:
+        if path not in _loaded_models:
+            _loaded_models[path] = CompactWordVectors(path)
+        return _loaded_models[path]
+
+
+def average_word_vectors(model, words: Sequence[str]) -> np.ndarray:
+    """The mean of the vectors of the words found in model, or zeros if none are"""
+    word_embeddings = [model[word.strip(',').strip(' ')] for word in words if word in model]
+    if not word_embeddings:
+        return np.zeros(model.vector_size)
+    return np.mean(word_embeddings, axis=0)
+
+
+def batch_average_word_vectors(model, word_lists: Sequence[Sequence[str]]) -> np.ndarray:
+    """
+    average_word_vectors for many texts at once, giving exactly the same values.
+
+    Each distinct word is looked up once, then the sums are built a word position at a time: step j gathers the jth
+    word vector of every text long enough to have one and adds them all in one go. That adds each text's vectors in the
+    same order np.mean does, so the rounding is the same too.
+
+    :param model: The word vectors.
+    :param word_lists: The preprocessed words of each text.
+    :return: A (len(word_lists), vector_size) float32 array.
+    """
+    if not isinstance(getattr(model, 'key_to_index', None), dict):
+        # No vocabulary index to gather from, so go one text at a time
+        return np.array([average_word_vectors(model, words) for words in word_lists],
+                        dtype=np.float32).reshape(len(word_lists), model.vector_size)
+
+    word_indices = {}
+    indices = []
+    counts = np.zeros(len(word_lists), dtype=np.int64)
+    for text_number, words in enumerate(word_lists):
+        for word in words:
+            index = word_indices.get(word)
+            if index is None:
+                # Mirrors average_word_vectors, which checks the word as-is but looks it up stripped
+                index = model.get_index(word.strip(',').strip(' ')) if word in model else -1
+                word_indices[word] = index
+            if index >= 0:
+                indices.append(index)
+                counts[text_number] += 1
+
+    embeddings = np.zeros((len(word_lists), model.vector_size), dtype=np.float32)
+    if not indices:
+        return embeddings
+
+    # Lay the flat word indices out as a (text, position) matrix
+    starts = np.cumsum(counts) - counts
+    text_numbers = np.repeat(np.arange(len(word_lists)), counts)
+    positions = np.arange(len(indices)) - np.repeat(starts, counts)
+    index_matrix = np.zeros((len(word_lists), counts.max()), dtype=np.int64)
+    index_matrix[text_numbers, positions] = indices
+
+    for position in range(index_matrix.shape[1]):
+        texts = np.flatnonzero(counts > position)
+        embeddings[texts] += np.asarray(model.vectors[index_matrix[texts, position]], dtype=np.float32)
+
+    has_words = counts > 0
+    embeddings[has_words] /= counts[has_words, np.newaxis].astype(np.float32)
+    return embeddings
+
+
+def retrieval_overlap(reference_embeddings: np.ndarray, embeddings: np.ndarray, k: int = 10,
+                      num_queries: int = 1000) -> float:
+    """
+    How closely nearest neighbour retrieval with one set of embeddings matches another for the same texts.
+
+    Each of the first num_queries texts is used as a query against all the others.
+
+    :return: The mean fraction of each query's top k neighbours under reference_embeddings that are also in its top k
+        under embeddings.
+    """
+    def top_k(matrix: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        unit = np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+        similarities = unit[:num_queries] @ unit.T
+        # A text is always its own nearest neighbour, so leave it out
+        np.fill_diagonal(similarities, -np.inf)
+        return np.argsort(-similarities, axis=1, kind='stable')[:, :k]
+
+    k = min(k, len(reference_embeddings) - 1)
+    if k < 1:
+        return 1.0
+    reference_top_k = top_k(np.asarray(reference_embeddings, dtype=np.float32))
+    compact_top_k = top_k(np.asarray(embeddings, dtype=np.float32))
+    overlaps = [len(set(reference_row) & set(compact_row)) / k
+                for reference_row, compact_row in zip(reference_top_k, compact_top_k)]
+    return float(np.mean(overlaps))
+
+
+def _memory_summaries(db_file: str) -> List[str]:
+    connection = sqlite3.connect(db_file)
+    summaries = [row[0] for row in connection.execute("SELECT memory_summary FROM memories") if row[0]]
+    connection.close()
+    return summaries
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a compact word2vec model for MemoryDatabase and report how "
+                                                 "closely its memory retrieval matches the full model")
+    parser.add_argument('output', help="Directory to write the compact model to")
+    parser.add_argument('--top-n', type=int, default=200000, help="Vocabulary entries to keep")
+    parser.add_argument('--float16', action='store_true', help="Store vectors as float16")
+    parser.add_argument('--hash-buckets', type=int, default=0, help="Fallback buckets for out of vocabulary words")
+    parser.add_argument('--db', help="Memory database whose summaries are used to measure retrieval overlap")
+    parser.add_argument('--cache-dir', help="Model cache directory, as for load_word2vec")
+    args = parser.parse_args()
+
+    model = load_word2vec(WORD2VEC_MODEL, cache_dir=args.cache_dir)
+    begin_time = time.time()
+    compact_model = build_compact_model(model, args.output, top_n=args.top_n, float16=args.float16,
+                                        hash_buckets=args.hash_buckets)
+    print(f"Built {compact_model.name} in {time.time() - begin_time:.1f} seconds")
+
+    begin_time = time.time()
+    compact_model = CompactWordVectors(args.output)
+    print(f"Loads in {time.time() - begin_time:.2f} seconds")
+    print(f"Vectors: {compact_model.vectors.nbytes / 2 ** 20:.0f} MiB, "
+          f"full model {model.vectors.nbytes / 2 ** 20:.0f} MiB")
+
+    if args.db:
+        summaries = _memory_summaries(args.db)
+        word_lists = [text.lower().split() for text in summaries]
+        reference_embeddings = batch_average_word_vectors(model, word_lists)
+        embeddings = batch_average_word_vectors(compact_model, word_lists)
+        print(f"Retrieval overlap@10 over {len(summaries)} memories: "
+              f"{retrieval_overlap(reference_embeddings, embeddings):.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,13 @@
+import json
 import urllib.parse
+import uuid
+
+from flask import Flask, Response, make_response, render_template, request, jsonify, stream_with_context
+from sqlalchemy import text
+from werkzeug.middleware.proxy_fix import ProxyFix
 
-from flask import Flask, render_template, request, jsonify
 from gpt_communication import GPTCommunication
+from request_gate import Overloaded, RequestGate
 import configparser
 import os
 
@@ -10,6 +16,11 @@ config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../confi
 config.read(config_path)
 
 app = Flask(__name__)
+# Behind a reverse proxy every request comes from the proxy's address, so the client's is taken from the
+# X-Forwarded-For header the trusted proxies add. Only set when there are proxies, or clients could send their own
+trusted_proxies = config.getint('web', 'trusted_proxies', fallback=0)
+if trusted_proxies > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=trusted_proxies)
 
 openweathermap_api_key = config['openweathermap']['api_key']
 weather_update_interval = int(config['openweathermap']['update_interval'])
@@ -17,9 +28,67 @@ weather_update_interval = int(config['openweathermap']['update_interval'])
 db_file = '../memories.db'
 gpt_comm = GPTCommunication(db_file, config=config)
 
+# Each chat holds a worker for two model calls, so only so many can run at once before they all slow down
+request_gate = RequestGate(max_concurrent=config.getint('web', 'workers', fallback=8),
+                           max_queued=config.getint('web', 'max_queued', fallback=16),
+                           per_user_limit=config.getint('web', 'per_user_limit', fallback=2),
+                           queue_timeout=config.getfloat('web', 'queue_timeout', fallback=30))
+
+
+# Each browser's conversation, so visitors don't share a prompt, recent memories, dialogue and cached replies
+CONVERSATION_COOKIE = 'conversation_id'
+CONVERSATION_COOKIE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def request_conversation_id() -> str:
+    # Clients without the cookie, such as scripts, can name their conversation themselves
+    conversation_id = request.cookies.get(CONVERSATION_COOKIE) or request.form.get('conversation_id', 'web')
+    return f'web:{conversation_id}'
+
+
+def request_user_key() -> str:
+    # The web page has no login, and anything the client sends can be changed to get round the per-user limit, so
+    # the address the request came from stands in for the user. Behind trusted_proxies that's the forwarded address
+    return request.remote_addr
+
+
+@app.errorhandler(Overloaded)
+def overloaded(e: Overloaded):
+    response = jsonify({"error": e.reason, "retry_after": e.retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+
+@app.route('/healthz')
+def healthz():
+    """The process is up and serving requests"""
+    return jsonify({"status": "ok"})
+
+
+@app.route('/readyz')
+def readyz():
+    """Ready for more chats: the database answers and the request queue isn't full"""
+    status = {"gate": request_gate.stats(), "openai_queued": gpt_comm.openai_client.queue_depth()}
+    try:
+        with gpt_comm.memory_db.db.read_session() as session:
+            session.execute(text('SELECT 1'))
+    except Exception as e:
+        status["database"] = f"{type(e).__name__}: {e}"
+        return jsonify(status), 503
+    if request_gate.is_saturated():
+        return jsonify(status), 503
+    return jsonify(status)
+
+
 @app.route('/')
 def index():
-    return render_template('index.html')
+    response = make_response(render_template('index.html'))
+    if CONVERSATION_COOKIE not in request.cookies:
+        # Random, so one browser can't guess another's conversation
+        response.set_cookie(CONVERSATION_COOKIE, uuid.uuid4().hex, max_age=CONVERSATION_COOKIE_MAX_AGE,
+                            httponly=True, samesite='Lax')
+    return response
 
 @app.route('/send_message', methods=['POST'])
 def send_message():
@@ -27,9 +96,35 @@ def send_message():
     user_input = request.form['user_input']
     # Decode URI encoded user input using urllib.parse.unquote
     decoded_user_input = urllib.parse.unquote(user_input)
-    assistant_response = gpt_comm.send_message(decoded_user_input, name_of_user=name_of_user, name_of_agent=name_of_agent, user_pronouns='she/her', num_memories=3)
+    conversation_id = request_conversation_id()
+    with request_gate.acquire(request_user_key()):
+        # The names of the user and agent come from the config
+        assistant_response = gpt_comm.send_message(decoded_user_input, user_pronouns='she/her', num_memories=3,
+                                                   conversation_id=conversation_id)
     return jsonify({"response": assistant_response})
 
+@app.route('/stream_message', methods=['POST'])
+def stream_message():
+    """Like send_message, but sends the reply as Server-Sent Events as it's generated, a delta event per piece of
+    text and a done event at the end"""
+    decoded_user_input = urllib.parse.unquote(request.form['user_input'])
+    conversation_id = request_conversation_id()
+    # Held until the response is closed, once the last of the reply is sent
+    slot = request_gate.acquire(request_user_key())
+
+    def events():
+        for text in gpt_comm.stream_message(decoded_user_input, user_pronouns='she/her', num_memories=3,
+                                            conversation_id=conversation_id):
+            yield f'event: delta\ndata: {json.dumps({"text": text})}\n\n'
+        yield 'event: done\ndata: {}\n\n'
+
+    # Not buffered by proxies, so each piece reaches the browser as it's sent
+    response = Response(stream_with_context(events()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(slot.release)
+    return response
+
 if __name__ == '__main__':
+    # For development, serve.py runs it for production
     app.run(debug=True)
 
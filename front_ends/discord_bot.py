@@ -4,12 +4,8 @@ import os
 import discord
 from discord.ext import commands
 
-from pydispatch import dispatcher
-
 from gpt_communication import GPTCommunication
 
-MESSAGE_RECEIVED_SIGNAL = 'discord.message.received'
-
 # This example requires the 'message_content' intent.
 
 intents = discord.Intents.default()
@@ -31,7 +27,6 @@ class DiscordBot:
         self.bot.username = self.agent_name
 
         self.gpt_communication = GPTCommunication(db_file, config=config)
-        dispatcher.connect(self.process_discord_message, signal=MESSAGE_RECEIVED_SIGNAL, sender=dispatcher.Any)
 
         @self.bot.event
         async def on_ready():
@@ -43,7 +38,8 @@ class DiscordBot:
             if message.author == self.bot.user:
                 return
 
-            dispatcher.send(MESSAGE_RECEIVED_SIGNAL, message=message)
+            # discord.py runs each event in its own task, so other messages are handled while this one waits on GPT
+            await self.process_discord_message(message)
 
     def send_message(self, channel_id: int, message: str):
         print(channel_id, message)
@@ -65,8 +61,17 @@ class DiscordBot:
 
         self.bot.loop.create_task(send_message_async())
 
-    def process_discord_message(self, message: discord.Message):
-        gpt_response = self.gpt_communication.send_message(message.content, name_of_user=message.author.display_name)
+    async def process_discord_message(self, message: discord.Message):
+        # A conversation per channel, each DM being its own channel. Memories are shared across a guild's channels,
+        # and kept to the user in DMs
+        if message.guild is not None:
+            memory_namespace = f'discord:guild:{message.guild.id}'
+        else:
+            memory_namespace = f'discord:user:{message.author.id}'
+        gpt_response = await self.gpt_communication.asend_message(message.content,
+                                                                  name_of_user=message.author.display_name,
+                                                                  conversation_id=f'discord:{message.channel.id}',
+                                                                  memory_namespace=memory_namespace)
         print(message.author.display_name, message.channel, message.content, gpt_response)
         # If it's a DM, send it to the DM channel
         if isinstance(message.channel, discord.DMChannel):
@@ -0,0 +1,88 @@
+"""
+Runs the web front end for production, on a fixed pool of threads: waitress if it's installed, otherwise werkzeug's
+server with a thread pool in place of a thread per request.
+
+The pool has a thread for each chat the request gate lets run at once, each it lets wait, and a few spare so health
+checks and turned away requests are still answered when it's full. Connections beyond that are answered with a 503
+rather than queued in memory, and those not yet accepted wait in the listen backlog.
+"""
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer
+
+from app import app, config, request_gate
+
+# Threads kept free of chats, for /healthz, /readyz and 429 responses
+SPARE_THREADS = 4
+# Sent straight from the accepting thread when every pool thread is busy
+BUSY_RESPONSE = (b'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Type: text/plain\r\n'
+                 b'Content-Length: 12\r\nConnection: close\r\n\r\nServer busy\n')
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    werkzeug's development server, handling requests on a fixed pool of threads. A connection is only handed to the
+    pool when a thread is free for it, the executor's own queue is unbounded.
+    """
+
+    def __init__(self, host: str, port: int, wsgi_app, threads: int, backlog: int):
+        self.request_queue_size = backlog
+        super().__init__(host, port, wsgi_app)
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='http')
+        self._free_threads = threading.BoundedSemaphore(threads)
+        self.busy_count = 0
+
+    def process_request(self, request, client_address):
+        if not self._free_threads.acquire(blocking=False):
+            self.busy_count += 1
+            try:
+                request.sendall(BUSY_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        self._pool.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._free_threads.release()
+
+    def server_close(self):
+        super().server_close()
+        self._pool.shutdown(wait=False)
+
+
+def serve(host: str, port: int):
+    threads = request_gate.max_concurrent + request_gate.max_queued + SPARE_THREADS
+    backlog = config.getint('web', 'backlog', fallback=64)
+    print(f"Serving on {host}:{port} with {threads} threads, {request_gate.max_concurrent} chats at once and "
+          f"{request_gate.max_queued} waiting")
+    try:
+        import waitress
+    except ImportError:
+        waitress = None
+
+    if waitress is not None:
+        waitress.serve(app, host=host, port=port, threads=threads, backlog=backlog,
+                       connection_limit=threads + backlog)
+    else:
+        server = PooledWSGIServer(host, port, app, threads, backlog)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--host', default=config.get('web', 'host', fallback='127.0.0.1'))
+    parser.add_argument('--port', type=int, default=config.getint('web', 'port', fallback=5000))
+    args = parser.parse_args()
+    serve(args.host, args.port)
@@ -31,10 +31,14 @@ class SlackBot:
             user_info = self.client.users_info(user=user_id)
             user_name = user_info['user']['real_name']
 
-            dispatcher.send(MESSAGE_RECEIVED_SIGNAL, message=text, user_name=user_name, reply_func=say)
-
-    def process_slack_message(self, message: str, user_name: str, reply_func):
-        gpt_response = self.gpt_communication.send_message(message, name_of_user=user_name)
+            dispatcher.send(MESSAGE_RECEIVED_SIGNAL, message=text, user_name=user_name, reply_func=say,
+                            conversation_id=f"slack:{body['event']['channel']}")
+
+    def process_slack_message(self, message: str, user_name: str, reply_func, conversation_id: str = None):
+        # Each channel's memories are kept to that channel
+        gpt_response = self.gpt_communication.send_message(message, name_of_user=user_name,
+                                                           conversation_id=conversation_id or 'slack',
+                                                           memory_namespace=conversation_id or 'slack')
         reply_func(gpt_response)
 
     def run(self):
@@ -1,13 +1,21 @@
+import asyncio
+import functools
 import re
 import time
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Iterator, List, Optional
 
 import openai
-import threading
-import requests
 
 from datetime import datetime
-from memory_database import MemoryDatabase, ProfileMemory
+from context_builder import ContextBuilder, prompt_token_budget
+from conversation_session import DEFAULT_CONVERSATION_ID, SessionManager
+from memory_database import GLOBAL_NAMESPACE, MemoryDatabase, ProfileMemory, ProfileStore
+from modules.context_providers import DEFAULT_GEOCODE_CACHE, ContextScheduler, GeocodeCache
+from openai_client import PRIORITY_BACKGROUND, PRIORITY_REPLY, OpenAIClient
+from response_cache import ResponseCache
+from response_parser import ParsedResponse, StreamingResponseParser, parse_response
+from token_counter import count_tokens
 
 ASSISTANT_INSTRUCTION = "You're a %ASSISTANT_TYPE% assistant and use user names often, apologizing when needed, and frequently using emojis. Note memories & awarenesses, but don't copy them. You provide responses in the requested format."
 #ASSISTANT_INSTRUCTION = "You are Tiny Tina and speak like her. You use the user's name a lot if you know it. You use emojis frequently. You have listed your related memories and awarenesses for reference only, do not use them as a template for output, I use the Required Output Format for that"
@@ -15,184 +23,430 @@ ASSISTANT_INSTRUCTION = "You're a %ASSISTANT_TYPE% assistant and use user names
 SUMMARISE_INSTRUCTION = 'At the end of each of your responses, please add a line which summarises the user input and assistant response in format another instance of you will understand. Add another line with how important this information was from 0.0-10.0, a list of 1-6 content words that summarise both your response and the user input.'
 
 
+class _PreparedReply:
+    """The prompt for a reply, ready to send, or the cached reply to give instead"""
+
+    def __init__(self, session, conversation_id: str, user_input: str, name_of_user: str, messages: List[dict] = None,
+                 input_embedding=None, cached_body: str = None, memory_namespace: str = GLOBAL_NAMESPACE):
+        self.session = session
+        self.conversation_id = conversation_id
+        self.memory_namespace = memory_namespace
+        self.user_input = user_input
+        self.name_of_user = name_of_user
+        self.messages = messages
+        self.input_embedding = input_embedding
+        self.cached_body = cached_body
+        # This reply's own, as replies in flight at once would overwrite each other's on anything shared
+        self.stage_timings = {}
+        self.token_usage = {}
+
+
 class GPTCommunication:
     def __init__(self, db_file: str, config: dict = None):
-        self.profile_memories = {}
         self.config = config
         openai.api_key = config['openai']['api_key']
         self.openai_api_model = config['openai']['api_model']
         self.openai_fast_api_model = config['openai']['fast_api_model']
+        # Shared by every bot in the process using this key, so together they stay under its rate limits
+        self.openai_client = OpenAIClient.from_config(config)
+        # Prompts are packed into the model's context window less what's kept free for the reply
+        prompt_token_overrides = {option[len('prompt_tokens.'):]: config.getint('openai', option)
+                                  for option in config['openai'] if option.startswith('prompt_tokens.')}
+        self.prompt_token_budget = prompt_token_budget(self.openai_api_model,
+                                                       config.getint('openai', 'reply_tokens', fallback=1000),
+                                                       prompt_token_overrides)
+        self.dialogue_history_tokens = config.getint('memory', 'dialogue_history_tokens', fallback=1000)
 
         assistant_type = self.config['default']['assistant_type']
         self.assistant_instruction = ASSISTANT_INSTRUCTION.replace('%ASSISTANT_TYPE%', assistant_type)
-        self.memory_db = MemoryDatabase(db_file)
-        self.messages = []
-        self.clear_messages()
-        self.recent_memories = []
-        self.dialogue_history_condensed = []
+        self.memory_db = MemoryDatabase(db_file,
+                                        model_cache_dir=config.get('memory', 'model_cache_dir', fallback=None),
+                                        compact_model_path=config.get('memory', 'compact_model_path', fallback=None),
+                                        embedding_cache_size=config.getint('memory', 'embedding_cache_size',
+                                                                           fallback=1024),
+                                        n_trees=config.getint('memory', 'n_trees', fallback=10),
+                                        search_k=config.getint('memory', 'search_k', fallback=-1),
+                                        candidate_oversample=config.getint('memory', 'candidate_oversample',
+                                                                           fallback=3),
+                                        sqlite_synchronous=config.get('memory', 'sqlite_synchronous',
+                                                                      fallback='NORMAL'),
+                                        write_behind=config.get('memory', 'write_behind', fallback='off'),
+                                        write_behind_delay=config.getint('memory', 'write_behind_delay_ms',
+                                                                         fallback=10) / 1000,
+                                        max_loaded_namespaces=config.getint('memory', 'max_loaded_namespaces',
+                                                                            fallback=64))
+        # Whether a namespace's searches also look through the memories everyone shares
+        self.search_global_namespace = config.getboolean('memory', 'search_global_namespace', fallback=True)
+        # Database and embedding work runs here so it doesn't block the event loop, bounded so a burst of messages
+        # queues up rather than starting a thread each
+        self.executor = ThreadPoolExecutor(max_workers=config.getint('memory', 'worker_threads', fallback=8),
+                                           thread_name_prefix='gpt-memory')
+        self.profile_store = ProfileStore(config.get('memory', 'profile_db', fallback='profiles.db'),
+                                          max_cached_profiles=config.getint('memory', 'max_cached_profiles',
+                                                                            fallback=256),
+                                          sqlite_synchronous=config.get('memory', 'sqlite_synchronous',
+                                                                        fallback='NORMAL'))
+        # Profiles used to be a database file each in the working directory
+        self.profile_store.migrate_profile_files()
+        # Each channel, DM or user has its own prompt and recent memories, so their replies can run side by side
+        self.sessions = SessionManager(self.assistant_instruction,
+                                       idle_timeout=config.getint('default', 'session_idle_minutes', fallback=60) * 60)
+        # Off unless asked for, a cached reply is only as current as the weather and memories it was made with
+        self.response_cache = None
+        if config.getboolean('response_cache', 'enabled', fallback=False):
+            self.response_cache = ResponseCache(
+                similarity_threshold=config.getfloat('response_cache', 'similarity_threshold', fallback=0.97),
+                ttl=config.getfloat('response_cache', 'ttl_minutes', fallback=60) * 60,
+                max_entries=config.getint('response_cache', 'max_entries', fallback=256))
 
-        self.current_weather = "Unknown"
         self.openweathermap_api_key = config['openweathermap']['api_key']
         self.weather_update_interval = int(config['openweathermap']['update_interval']) * 60
+        # One scheduler thread and connection pool for the whole process, however many bots are running in it
+        self.context = ContextScheduler.shared()
+        self.geocode_cache = GeocodeCache(config.get('openweathermap', 'geocode_cache', fallback=None)
+                                          or DEFAULT_GEOCODE_CACHE)
+        self.weather_provider = f"weather:{config['openweathermap']['location']}"
 
         self.start_weather_updater()
 
-    def update_weather(self):
+    @property
+    def current_weather(self) -> str:
+        return self.context.get(self.weather_provider, default="Unknown")
+
+    def start_weather_updater(self):
+        # Bots for the same location share the one provider
         location = self.config['openweathermap']['location']
+        self.context.register(self.weather_provider, lambda: self.get_weather(location), self.weather_update_interval)
 
-        while True:
-            self.current_weather = self.get_weather(location)
-            time.sleep(self.weather_update_interval)
+    # The state of the default conversation, used when no conversation_id is given
+    @property
+    def messages(self):
+        return self.sessions.get().messages
 
-    def start_weather_updater(self):
-        update_thread = threading.Thread(target=self.update_weather, daemon=True)
-        update_thread.start()
+    @messages.setter
+    def messages(self, messages):
+        self.sessions.get().messages = messages
+
+    @property
+    def last_stage_timings(self):
+        return self.sessions.get().last_stage_timings
+
+    @property
+    def last_token_usage(self):
+        return self.sessions.get().last_token_usage
+
+    @property
+    def recent_memories(self):
+        return self.sessions.get().recent_memories
+
+    @property
+    def dialogue_history_condensed(self):
+        return self.sessions.get().dialogue_history_condensed
 
     def add_message(self, role: str, content: str):
-        self.messages.append({"role": role, "content": content})
+        self.sessions.get().add_message(role, content)
 
     def add_recent_memory(self, role: str, content: str):
-        # Check if this memory is already in the recent memories
-        for memory in self.recent_memories:
-            if memory['content'] == content:
-                return
-        self.recent_memories.append({"role": role, "content": content})
+        self.sessions.get().add_recent_memories([{"role": role, "content": content}], [])
 
     def expire_recent_memories(self, limit):
-        while len(self.recent_memories) > limit:
-            self.recent_memories.pop(0)
+        session = self.sessions.get()
+        with session.lock:
+            del session.recent_memories[:max(0, len(session.recent_memories) - limit)]
 
     def clear_messages(self):
-        self.messages = [{"role": "system", "content": f'{self.assistant_instruction}'}]
+        self.sessions.get().clear_messages()
+
+    async def _run_blocking(self, function, *args, **kwargs):
+        """Run a blocking database or embedding call on the executor"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor,
+                                                                functools.partial(function, *args, **kwargs))
+
+    @staticmethod
+    async def _timed(timings: dict, stage: str, awaitable):
+        """Await a stage of building the prompt, recording how long it took in milliseconds"""
+        begin_time = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            timings[stage] = (time.perf_counter() - begin_time) * 1000
+
+    async def _history_and_retrieval(self, user_input: str, num_memories: int, conversation_id: str,
+                                     memory_namespace: str, timings: dict):
+        """
+        Read the recent dialogue, then retrieve memories relevant to it and the input while the input is saved.
+
+        :return: The dialogue history oldest first, and the relevant memories.
+        """
+        dialogue_history = list(reversed(await self._timed(
+            timings, 'history', self._run_blocking(self.memory_db.get_dialogue_history,
+                                                   max_tokens=self.dialogue_history_tokens,
+                                                   session_key=conversation_id, conversation_id=conversation_id))))
+        if len(dialogue_history) > 0:
+            query = f"{dialogue_history[-1]['content']}. {user_input}"
+        else:
+            query = f'{user_input}'
+
+        # Saved only once the history is read, so it isn't in its own prompt twice
+        timestamp = datetime.now().isoformat()
+        relevant_memories, _ = await asyncio.gather(
+            self._timed(timings, 'retrieval', self._run_blocking(self.memory_db.retrieve_relevant_memories, query,
+                                                                 num_results=num_memories,
+                                                                 session_key=conversation_id,
+                                                                 namespace=memory_namespace,
+                                                                 include_global=self.search_global_namespace)),
+            self._timed(timings, 'save_input', self._run_blocking(self.memory_db.save_dialogue_entry, 'user',
+                                                                  user_input, timestamp,
+                                                                  session_key=conversation_id,
+                                                                  conversation_id=conversation_id)))
+        return dialogue_history, relevant_memories
+
+    async def _increment_history_summarise_count(self, conversation_id: str) -> int:
+        # Counted per conversation, as each conversation's history is condensed on its own
+        key = f'history_summarise_count:{conversation_id}'
+        history_summarise_count = await self._run_blocking(self.memory_db.increment_count, key)
+        if history_summarise_count >= 10:
+            await self._run_blocking(self.memory_db.set_count, key, 0)
+        return history_summarise_count
 
-    # Receive a message from the Discord bot
     def send_message(self, user_input: str, importance: float = None, num_memories=5, name_of_user=None,
-                     user_pronouns=None, name_of_agent=None) -> str:
+                     user_pronouns=None, name_of_agent=None,
+                     conversation_id: str = DEFAULT_CONVERSATION_ID, memory_namespace: str = GLOBAL_NAMESPACE) -> str:
+        """Blocking version of asend_message, for callers that aren't running an event loop"""
+        return asyncio.run(self.asend_message(user_input, importance=importance, num_memories=num_memories,
+                                              name_of_user=name_of_user, user_pronouns=user_pronouns,
+                                              name_of_agent=name_of_agent, conversation_id=conversation_id,
+                                              memory_namespace=memory_namespace))
+
+    def stream_message(self, user_input: str, importance: float = None, num_memories=5, name_of_user=None,
+                       user_pronouns=None, name_of_agent=None,
+                       conversation_id: str = DEFAULT_CONVERSATION_ID,
+                       memory_namespace: str = GLOBAL_NAMESPACE) -> Iterator[str]:
+        """Blocking version of astream_message, running it on an event loop of its own"""
+        loop = asyncio.new_event_loop()
+        stream = self.astream_message(user_input, importance=importance, num_memories=num_memories,
+                                      name_of_user=name_of_user, user_pronouns=user_pronouns,
+                                      name_of_agent=name_of_agent, conversation_id=conversation_id,
+                                      memory_namespace=memory_namespace)
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(stream.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            loop.run_until_complete(stream.aclose())
+            loop.close()
+
+    # Receive a message from the Discord bot
+    async def asend_message(self, user_input: str, importance: float = None, num_memories=5, name_of_user=None,
+                            user_pronouns=None, name_of_agent=None,
+                            conversation_id: str = DEFAULT_CONVERSATION_ID,
+                            memory_namespace: str = GLOBAL_NAMESPACE) -> str:
+        """
+        Reply to the user's input.
+
+        :param conversation_id: The channel, DM or user the input came from, each has its own prompt and history.
+        :param memory_namespace: The namespace memories are searched in and saved to, see MemoryDatabase.
+        """
+        reply = await self._prepare_reply(user_input, num_memories, name_of_user, conversation_id, memory_namespace)
+        if reply.cached_body is not None:
+            return reply.cached_body
+
+        try:
+            response = await self.openai_client.chat_completion(self.openai_api_model, reply.messages,
+                                                                priority=PRIORITY_REPLY)
+        except Exception as e:
+            return self._reply_error(e, reply.messages)
+
+        assistant_response = response.choices[0].message.content
+        print("ASSISTANT RESPONSE:", assistant_response.split('\n'))
+        return await self._finish_reply(reply, parse_response(assistant_response,
+                                                              importance if importance is not None else 1.0))
+
+    async def astream_message(self, user_input: str, importance: float = None, num_memories=5, name_of_user=None,
+                              user_pronouns=None, name_of_agent=None,
+                              conversation_id: str = DEFAULT_CONVERSATION_ID,
+                              memory_namespace: str = GLOBAL_NAMESPACE) -> AsyncIterator[str]:
+        """
+        Like asend_message, but yields the body of the reply as it's generated. The summary, importance and content
+        words that follow it are held back, and the memory is saved from them once the reply is complete.
+        """
+        reply = await self._prepare_reply(user_input, num_memories, name_of_user, conversation_id, memory_namespace)
+        if reply.cached_body is not None:
+            yield reply.cached_body
+            return
+
+        parser = StreamingResponseParser(importance if importance is not None else 1.0)
+        try:
+            stream = await self.openai_client.chat_completion(self.openai_api_model, reply.messages,
+                                                              priority=PRIORITY_REPLY, stream=True)
+            async for chunk in stream:
+                text = parser.feed(chunk['choices'][0]['delta'].get('content') or '')
+                if text:
+                    yield text
+        except Exception as e:
+            # Whatever was already shown stays, the rest of the reply is lost with the stream
+            yield self._reply_error(e, reply.messages)
+            return
+
+        print("ASSISTANT RESPONSE:", parser.text.split('\n'))
+        rest_of_body, parsed = parser.finish()
+        if rest_of_body:
+            yield rest_of_body
+        await self._finish_reply(reply, parsed)
+
+    @staticmethod
+    def _reply_error(e: Exception, messages: List[dict]) -> str:
+        print("ERROR:", type(e), e)
+        if isinstance(e, openai.error.RateLimitError):
+            return "Sorry, I'm being rate limited communicating with my brain. Please try again later."
+        print(messages)
+        return "Sorry, I'm having trouble communicating with my brain. Please try again later."
+
+    async def _prepare_reply(self, user_input: str, num_memories: int, name_of_user: Optional[str],
+                             conversation_id: str, memory_namespace: str) -> _PreparedReply:
+        """Build the prompt for a reply, or find a cached reply, recording the input in the dialogue either way"""
         if name_of_user is None:
             name_of_user = self.config['default']['name_of_user']
         else:
             name_of_user = name_of_user.strip()
         name_of_agent = self.config['default']['name_of_agent']
 
-        self.clear_messages()
-        dialogue_history = list(reversed(self.memory_db.get_dialogue_history(10)))
-        if len(dialogue_history) > 0:
-            relevant_memories = self.memory_db.retrieve_relevant_memories(f'{dialogue_history[-1]}. {user_input}',
-                                                                          num_results=num_memories)
-        else:
-            relevant_memories = self.memory_db.retrieve_relevant_memories(f'{user_input}', num_results=num_memories)
+        session = self.sessions.get(conversation_id)
+        # Each reply builds its own prompt, as several can be in flight at once. The session is left pointing at the
+        # most recent one
+        header = [{"role": "system", "content": f'{self.assistant_instruction}'}]
+        messages = header
+        session.messages = messages
+
+        def add_message(role: str, content: str):
+            messages.append({"role": role, "content": content})
 
         if name_of_agent is not None:
-            self.add_message('system', f'Your name is {name_of_agent}')
-        self.add_message("assistant", f'Following are a series of my relevant memories for reference:')
+            add_message('system', f'Your name is {name_of_agent}')
+        add_message("assistant", f'Following are a series of my relevant memories for reference:')
         if name_of_user is not None:
-            self.add_message('assistant', f'Memory: Name of user: {name_of_user}')
+            add_message('assistant', f'Memory: Name of user: {name_of_user}')
         else:
             name_of_user = 'user'
         #if user_pronouns is not None:
-        #    self.add_message('assistant', f'Memory: {name_of_user} pronouns: {user_pronouns}')
+        #    add_message('assistant', f'Memory: {name_of_user} pronouns: {user_pronouns}')
         if name_of_agent is not None:
-            self.add_message('assistant', f'Memory: Assistant\'s chosen name is {name_of_agent}')
+            add_message('assistant', f'Memory: Assistant\'s chosen name is {name_of_agent}')
 
         # Give the agent the current time
-        self.add_message('assistant', f'Awareness: {datetime.now().isoformat()}')
+        add_message('assistant', f'Awareness: {datetime.now().isoformat()}')
         # Give the agent the current weather, updates every 10 minutes
-        self.add_message('assistant', f'Awareness: Weather, {self.current_weather}')
-        #self.add_message('assistant', f'Awareness: Location=York, UK')
+        add_message('assistant', f'Awareness: Weather, {self.current_weather}')
+        #add_message('assistant', f'Awareness: Location=York, UK')
+
+        input_embedding = None
+        if self.response_cache is not None:
+            cached_body = self.response_cache.get_exact(conversation_id, name_of_user, user_input)
+            if cached_body is None:
+                input_embedding = await self._run_blocking(self.memory_db._generate_embedding, user_input)
+                cached_body = self.response_cache.get(conversation_id, name_of_user, user_input, input_embedding)
+            if cached_body is not None:
+                print("CACHED RESPONSE:", cached_body, self.response_cache.stats())
+                reply = _PreparedReply(session, conversation_id, user_input, name_of_user, cached_body=cached_body)
+                await self._reply_from_cache(reply)
+                return reply
+
+        # The fast model only sees the messages so far, so it runs alongside the database stages rather than after
+        # them, and the prompt is ready as soon as the slowest stage is
+        timings = {}
+        begin_time = time.perf_counter()
+        (dialogue_history, relevant_memories), fast_results, _, history_summarise_count = await asyncio.gather(
+            self._history_and_retrieval(user_input, num_memories, conversation_id, memory_namespace, timings),
+            self._timed(timings, 'fast_analysis', self.afast_analyse_prompt(name_of_user, header)),
+            self._timed(timings, 'profile_prefetch', self._run_blocking(self.get_profile, name_of_user)),
+            self._timed(timings, 'counters', self._increment_history_summarise_count(conversation_id)))
+        timings['prompt'] = (time.perf_counter() - begin_time) * 1000
+        print("STAGES:", ', '.join(f'{stage}={milliseconds:.1f}ms' for stage, milliseconds in timings.items()))
+
+        # Memories only have their text's tokens stored, the prefix is counted here
+        memory_tokens = {}
+        memory_messages = []
         for memory in relevant_memories:
-            memory_details = memory['related_prompt']
-            self.add_recent_memory("assistant", f'Memory: {memory["timestamp"]}: {memory_details}')
-
-        # A mechanism for having memories hang around for a few responses, allows discussion
-        self.expire_recent_memories(15)
-        self.fast_analyse_prompt(name_of_user)
-        for memory in self.recent_memories:
-            self.add_message(memory['role'], memory['content'])
+            prefix = f'Memory: {memory["timestamp"]}: '
+            memory_tokens[prefix + memory["related_prompt"]] = count_tokens(prefix) + (memory['token_count'] or 0)
+            memory_messages.append({"role": "assistant", "content": prefix + memory["related_prompt"]})
+        recent_memories = session.add_recent_memories(memory_messages, fast_results)
+        for memory in recent_memories:
             print("M:", memory)
-
-        for content in self.dialogue_history_condensed[-10:]:
-            self.add_message('assistant', f'Memory: {content}')
-            print("CH:", content)
-
+        condensed_history = [{'role': 'assistant', 'content': f'Memory: {content}'}
+                             for content in session.get_condensed_history()]
+        for entry in condensed_history:
+            print("CH:", entry['content'])
         for entry in dialogue_history:
-            self.add_message(entry['speaker'], entry['content'])
             print("D:", entry)
 
-        timestamp = datetime.now().isoformat()
-        self.memory_db.save_dialogue_entry('user', user_input, timestamp)
-
         format_instruction = 'Provide your response in the following format in this order (r,summary,i,c): r:<actual response>\nsummary: <an info dense summary of the full response, including the speaker and the context>\ni: <how useful this information will be for future reference purposes from 0.0-10.0, rate uncommon items higher>\nc: <a list of 1-6 content words that summarise both your response and the user input in context>'
-        history_summarise_count = self.memory_db.increment_count('history_summarise_count')
         if history_summarise_count >= 10:
             # 'compress' the dialogue history to provide a longer context
             format_instruction += '\nCH: <an info dense summary of the conversation so far using as few tokens as possible>'
-            self.memory_db.set_count('history_summarise_count', 0)
 
         message_to_send_to_gpt = f'{user_input}. {format_instruction}'
-        self.add_message("user", message_to_send_to_gpt)
-
-        try:
-            response = openai.ChatCompletion.create(
-                model=self.openai_api_model,
-                messages=self.messages
-            )
-        except openai.error.RateLimitError as e:
-            print("ERROR:", type(e), e)
-            return "Sorry, I'm being rate limited communicating with my brain. Please try again later."
-        except Exception as e:
-            print("ERROR:", type(e), e)
-            print(self.messages)
-            return "Sorry, I'm having trouble communicating with my brain. Please try again later."
 
-        assistant_response = response.choices[0].message.content
-        assistant_response = assistant_response.split('\n')
-        print("ASSISTANT RESPONSE:", assistant_response)
-        if importance is None:
-            importance = 1.0
-        conversation_history_condensed = None
-        content_words = None
-        memory_summary = ""
-        summary_begins_at = 0
-        if len(assistant_response) > 1:
-            # Handles odd issues with extra newlines
-            for line_num in range(1, min(7, len(assistant_response) + 1)):
-                memory_summary = assistant_response[-3]
-                if match := re.match('\s*[Ii]:\s*(\d\.?\d*)', assistant_response[-line_num]):
-                    importance = float(match.group(1))
-                    summary_begins_at = line_num
-                elif match := re.match('\s*[Ss]ummary:\s*(.+)', assistant_response[-line_num]):
-                    memory_summary = match.group(1)
-                    summary_begins_at = line_num
-                elif match := re.match('\s*[Cc]:\s*(.+)', assistant_response[-line_num]):
-                    content_words = match.group(1)
-                    summary_begins_at = line_num
-                elif match := re.match('\s*[Cc][Hh]:\s*(.+)', assistant_response[-line_num]):
-                    conversation_history_condensed = match.group(1)
-                    summary_begins_at = line_num
-        else:
-            memory_summary = assistant_response[-1]
-
-        body = '\n'.join(assistant_response[:-summary_begins_at])
-        if body.startswith('r:') or body.startswith('R:'):
-            body = body[2:].strip()
-        else:
-            body = '\n'.join(assistant_response)
+        # The latest dialogue goes in first, then memories and condensed history as far as the budget allows. Anything
+        # carried over from earlier replies has its count cached by count_tokens
+        context = ContextBuilder(self.prompt_token_budget)
+        context.add_section('header', header)
+        context.add_section('memories', recent_memories,
+                            [memory_tokens.get(memory['content']) or count_tokens(memory['content'])
+                             for memory in recent_memories], priority=2)
+        context.add_section('condensed_history', condensed_history, priority=3)
+        context.add_section('dialogue', [{'role': entry['speaker'], 'content': entry['content']}
+                                         for entry in dialogue_history],
+                            [entry['token_count'] for entry in dialogue_history], priority=1,
+                            max_tokens=self.dialogue_history_tokens, newest_first=True)
+        context.add_section('input', [{'role': 'user', 'content': message_to_send_to_gpt}])
+        messages = context.build()
+        session.messages = messages
+        token_usage = context.token_usage()
+        session.last_stage_timings, session.last_token_usage = timings, token_usage
+        print("TOKENS:", ', '.join(f'{section}={tokens}' for section, tokens in token_usage.items()),
+              f'of {self.prompt_token_budget}')
+
+        reply = _PreparedReply(session, conversation_id, user_input, name_of_user, messages, input_embedding,
+                               memory_namespace=memory_namespace)
+        reply.stage_timings, reply.token_usage = timings, token_usage
+        return reply
+
+    async def _finish_reply(self, reply: _PreparedReply, parsed: ParsedResponse) -> str:
+        """Save the memory and dialogue from a complete reply, returning its body"""
+        body = parsed.body
         print("B:", body)
-        self.add_message("assistant", body)
+        reply.messages.append({"role": "assistant", "content": body})
         timestamp = datetime.now().isoformat()
-        if content_words:
-            self.memory_db.save_memory(content_words, memory_summary, timestamp, importance)
-        self.memory_db.save_dialogue_entry('assistant', body, timestamp)
-
-        if conversation_history_condensed:
-            self.dialogue_history_condensed.append(conversation_history_condensed)
+        if parsed.content_words:
+            await self._run_blocking(self.memory_db.save_memory, parsed.content_words, parsed.memory_summary,
+                                     timestamp, parsed.importance, session_key=reply.conversation_id,
+                                     namespace=reply.memory_namespace)
+        await self._run_blocking(self.memory_db.save_dialogue_entry, 'assistant', body, timestamp,
+                                 session_key=reply.conversation_id, conversation_id=reply.conversation_id)
+
+        if parsed.conversation_history_condensed:
+            reply.session.add_condensed_history(parsed.conversation_history_condensed)
+        if self.response_cache is not None:
+            self.response_cache.put(reply.conversation_id, reply.name_of_user, reply.user_input, body,
+                                    reply.input_embedding)
 
         return body
 
+    async def _reply_from_cache(self, reply: _PreparedReply):
+        """Record a cached reply in the dialogue as if the model had made it"""
+        reply.session.add_message('user', reply.user_input)
+        reply.session.add_message('assistant', reply.cached_body)
+        timestamp = datetime.now().isoformat()
+        await self._run_blocking(self.memory_db.save_dialogue_entry, 'user', reply.user_input, timestamp,
+                                 session_key=reply.conversation_id, conversation_id=reply.conversation_id)
+        await self._run_blocking(self.memory_db.save_dialogue_entry, 'assistant', reply.cached_body, timestamp,
+                                 session_key=reply.conversation_id, conversation_id=reply.conversation_id)
+
     def get_profile(self, user_id: str, display_name: str = '') -> ProfileMemory:
-        if user_id not in self.profile_memories:
-            self.profile_memories[user_id] = ProfileMemory(user_id, display_name=display_name)
-        return self.profile_memories[user_id]
+        return self.profile_store.get(user_id, display_name=display_name)
 
     def perform_action(self, action: str) -> Optional[str]:
         """Perform an action returned by the fast_api_model, valid actions are:
@@ -212,21 +466,36 @@ class GPTCommunication:
             value = match.group(3)
             profile = self.get_profile(user_id)
             profile.set_key_value(key, value)
+            self._invalidate_cached_responses(user_id)
             return "OK"
         elif match := re.search('DELETE\((.+?),\s*(.+)\)', action):
             user_id = match.group(1)
             key = match.group(2)
             profile = self.get_profile(user_id)
             profile.delete_key(key)
+            self._invalidate_cached_responses(user_id)
             return "OK"
         else:
             return None
 
+    def _invalidate_cached_responses(self, user_id: str):
+        # Replies made before the profile changed may contradict it
+        if self.response_cache is not None:
+            self.response_cache.invalidate_user(user_id)
+
     def fast_analyse_prompt(self, name_of_user):
-        """Send a request to fast_api_model to analyse a prompt and return a list of actions prior to sending to the
-        slower model"""
+        """Blocking version of afast_analyse_prompt, analysing self.messages and adding the results to the recent
+        memories"""
+        self.sessions.get().add_recent_memories([], asyncio.run(self.afast_analyse_prompt(name_of_user, self.messages)))
+
+    async def afast_analyse_prompt(self, name_of_user, messages) -> List[dict]:
+        """Send a request to fast_api_model to analyse a prompt and carry out the actions it returns prior to sending
+        to the slower model
 
-        full_prompt = self.messages[:]
+        :return: Messages with the results of any FETCH actions, for the recent memories.
+        """
+
+        full_prompt = messages[:]
         full_prompt.append({
             'role': 'user',
             'content': "Please analyse the above prompt and history and return a list of actions that *will* be "
@@ -238,40 +507,46 @@ class GPTCommunication:
                        "user_id, key)'. FETCH retrieves useful information relating to the prompt. Don't annotate the "
                        "commands."})
         try:
-            response = openai.ChatCompletion.create(
-                model=self.openai_fast_api_model,
-                messages=full_prompt
-            )
+            # Waits behind any replies, which matter more than what this finds
+            response = await self.openai_client.chat_completion(self.openai_fast_api_model, full_prompt,
+                                                                priority=PRIORITY_BACKGROUND)
         except openai.error.RateLimitError as e:
             print("RATE LIMITED in fast_analyse_prompt:", type(e), e)
-            return
+            return []
         except Exception as e:
             print(f"ERROR in fast_analyse_prompt: {type(e)} {e}\n{e.__traceback__.tb_lineno}")
             print("PROMPT:", full_prompt)
-            return
+            return []
 
+        results = []
         actions = response.choices[0].message.content.split('\n')
         for action in actions:
             print("ACTION:", action)
-            result = self.perform_action(action)
+            result = await self._run_blocking(self.perform_action, action)
             if result == 'OK':
                 print("OK")
             elif result:
                 print("RESULT:", result)
-                self.recent_memories.append({'role': 'assistant', 'content': result})
+                results.append({'role': 'assistant', 'content': result})
             else:
                 print("NO RESULT in fast_analyse_prompt:", action)
 
         #print("FAST RESPONSE:", response.json())
         #return response.json()
-        return
+        return results
 
     def get_city_coordinates(self, city_name):
+        coordinates = self.geocode_cache.get(city_name)
+        if coordinates is not None:
+            return coordinates
+
         url = f"http://api.openweathermap.org/geo/1.0/direct?q={city_name}&limit=1&appid={self.openweathermap_api_key}"
-        response = requests.get(url)
+        response = self.context.session.get(url, timeout=self.context.request_timeout)
+        response.raise_for_status()
         data = response.json()
 
         if data and "lat" in data[0] and "lon" in data[0]:
+            self.geocode_cache.set(city_name, data[0]["lat"], data[0]["lon"])
             return data[0]["lat"], data[0]["lon"]
         else:
             return None, None
@@ -280,29 +555,26 @@ class GPTCommunication:
         if re.match(r'-?\d+\.?\d*,-?\d+\.?\d*', location):
             lat, lon = location.split(",")
         else:
-            city = "York,GB"
-            lat, lon = self.get_city_coordinates(city)
+            lat, lon = self.get_city_coordinates(location)
         print(lat, lon)
 
-        if lat and lon:
-            url = f"https://api.openweathermap.org/data/3.0/onecall?lat={lat}&lon={lon}&appid={self.openweathermap_api_key}&units=metric"
-            response = requests.get(url)
-            data = response.json()
-
-            if response.status_code == 200:
-                sunrise = datetime.fromtimestamp(data["current"]["sunrise"]).strftime("%H:%M")
-                sunset = datetime.fromtimestamp(data["current"]["sunset"]).strftime("%H:%M")
-                uvi = data["current"]["uvi"]
-                wind_speed = data["current"]["wind_speed"]
-                wind_degrees = data["current"]["wind_deg"]
-                temperature = data["current"]["temp"]
-                feels_like = data["current"]["feels_like"]
-                description = data["current"]["weather"][0]["description"]
-                return f"Sunrise: {sunrise}, Sunset: {sunset}, Now: {temperature}C, feels like {feels_like}C, wind speed {wind_speed}, wind direction in degrees {wind_degrees}, uv index {uvi}, {description}."
-            else:
-                return "Error fetching weather data"
-        else:
-            return "City not found."
+        # Errors are raised rather than returned, so the scheduler keeps the last weather instead of storing them
+        if not (lat and lon):
+            raise ValueError(f"City not found: {location}")
+        url = f"https://api.openweathermap.org/data/3.0/onecall?lat={lat}&lon={lon}&appid={self.openweathermap_api_key}&units=metric"
+        response = self.context.session.get(url, timeout=self.context.request_timeout)
+        response.raise_for_status()
+        data = response.json()
+
+        sunrise = datetime.fromtimestamp(data["current"]["sunrise"]).strftime("%H:%M")
+        sunset = datetime.fromtimestamp(data["current"]["sunset"]).strftime("%H:%M")
+        uvi = data["current"]["uvi"]
+        wind_speed = data["current"]["wind_speed"]
+        wind_degrees = data["current"]["wind_deg"]
+        temperature = data["current"]["temp"]
+        feels_like = data["current"]["feels_like"]
+        description = data["current"]["weather"][0]["description"]
+        return f"Sunrise: {sunrise}, Sunset: {sunset}, Now: {temperature}C, feels like {feels_like}C, wind speed {wind_speed}, wind direction in degrees {wind_degrees}, uv index {uvi}, {description}."
 
     def generate_memory_summary(self, user_input: str, assistant_response: str) -> str:
         # Implement a function to generate a memory summary from user_input and assistant_response
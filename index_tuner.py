@@ -0,0 +1,141 @@
+import argparse
+import sqlite3
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from annoy import AnnoyIndex
+
+from embedding_model import WORD2VEC_MODEL, batch_average_word_vectors, load_compact_word2vec, load_word2vec
+
+
+def load_memory_embeddings(db_file: str) -> Tuple[np.ndarray, np.ndarray]:
+    """The ids and stored embeddings of every memory with one"""
+    connection = sqlite3.connect(db_file)
+    rows = connection.execute("SELECT id, embedding FROM memories WHERE embedding IS NOT NULL").fetchall()
+    connection.close()
+    ids = np.array([memory_id for memory_id, _ in rows], dtype=np.int64)
+    embeddings = np.array([np.frombuffer(embedding, dtype=np.float32) for _, embedding in rows])
+    return ids, embeddings
+
+
+def load_dialogue_queries(db_file: str, model, num_queries: int, rng: np.random.Generator) -> np.ndarray:
+    """Embed a sample of what users actually said, which is what retrieval gets queried with"""
+    connection = sqlite3.connect(db_file)
+    texts = [row[0] for row in connection.execute("SELECT content FROM dialogue_history WHERE speaker = 'user'")]
+    connection.close()
+    if len(texts) > num_queries:
+        texts = [texts[i] for i in rng.choice(len(texts), num_queries, replace=False)]
+    return batch_average_word_vectors(model, [text.lower().split() for text in texts])
+
+
+def exact_neighbours(embeddings: np.ndarray, queries: np.ndarray, k: int, chunk_size: int = 64) -> np.ndarray:
+    """The positions in embeddings of each query's k nearest neighbours by angular distance"""
+    def unit(matrix: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+    unit_embeddings = unit(embeddings.astype(np.float32))
+    unit_queries = unit(queries.astype(np.float32))
+    neighbours = []
+    for start in range(0, len(unit_queries), chunk_size):
+        similarities = unit_queries[start:start + chunk_size] @ unit_embeddings.T
+        top_k = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(similarities, top_k, axis=1), axis=1)
+        neighbours.append(np.take_along_axis(top_k, order, axis=1))
+    return np.concatenate(neighbours)
+
+
+def measure(index: AnnoyIndex, queries: np.ndarray, exact_ids: np.ndarray, k: int, search_k: int) -> Tuple[float, float]:
+    """
+    :return: The mean recall@k against the exact neighbours and the mean search time in milliseconds.
+    """
+    recalls = []
+    begin_time = time.perf_counter()
+    for query, expected in zip(queries, exact_ids):
+        found = index.get_nns_by_vector(query, k, search_k=search_k)
+        recalls.append(len(set(found) & set(expected.tolist())) / k)
+    return float(np.mean(recalls)), (time.perf_counter() - begin_time) * 1000 / len(queries)
+
+
+def tune(ids: np.ndarray, embeddings: np.ndarray, queries: np.ndarray, k: int, target_recall: float,
+         tree_counts: Sequence[int], search_k_multipliers: Sequence[int]) -> Tuple[List[Dict], Optional[Dict]]:
+    """
+    Measure every combination of tree count and search_k, where search_k is a multiple of Annoy's default k * n_trees.
+
+    :return: All the measurements, and the one with the fastest searches that meets target_recall, if any do.
+    """
+    exact_ids = ids[exact_neighbours(embeddings, queries, k)]
+    results = []
+    for n_trees in tree_counts:
+        begin_time = time.perf_counter()
+        index = AnnoyIndex(embeddings.shape[1], 'angular')
+        for memory_id, embedding in zip(ids, embeddings):
+            index.add_item(int(memory_id), embedding)
+        index.build(n_trees)
+        build_seconds = time.perf_counter() - begin_time
+
+        for multiplier in search_k_multipliers:
+            search_k = k * n_trees * multiplier
+            recall, latency = measure(index, queries, exact_ids, k, search_k)
+            results.append({'n_trees': n_trees, 'search_k': search_k, 'recall': recall, 'latency_ms': latency,
+                            'build_seconds': build_seconds})
+            print(f"n_trees={n_trees:<4} search_k={search_k:<8} recall@{k}={recall:.3f} "
+                  f"latency={latency:.3f}ms build={build_seconds:.1f}s")
+        index.unload()
+
+    passing = [result for result in results if result['recall'] >= target_recall]
+    best = min(passing, key=lambda result: (result['latency_ms'], result['n_trees'])) if passing else None
+    return results, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure vector search recall against exact search on a memory "
+                                                 "database and suggest the cheapest settings that meet a target")
+    parser.add_argument('db', help="The memory database")
+    parser.add_argument('--num-results', type=int, default=5, help="num_results used for retrieval")
+    parser.add_argument('--oversample', type=int, default=3, help="candidate_oversample used for retrieval")
+    parser.add_argument('--recall', type=float, default=0.95, help="Target recall of the candidates")
+    parser.add_argument('--queries', type=int, default=200, help="Number of queries to measure with")
+    parser.add_argument('--trees', default='5,10,20,50', help="Comma separated tree counts to try")
+    parser.add_argument('--search-k-multipliers', default='1,2,4,8,16',
+                        help="Comma separated multiples of Annoy's default search_k to try")
+    parser.add_argument('--compact-model', help="Compact model the database's embeddings were made with")
+    parser.add_argument('--cache-dir', help="Model cache directory, as for load_word2vec")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    ids, embeddings = load_memory_embeddings(args.db)
+    if len(ids) == 0:
+        print("No memories with stored embeddings")
+        return
+
+    if args.compact_model:
+        model = load_compact_word2vec(args.compact_model)
+    else:
+        model = load_word2vec(WORD2VEC_MODEL, cache_dir=args.cache_dir)
+    queries = load_dialogue_queries(args.db, model, args.queries, rng)
+    if len(queries) == 0:
+        # No dialogue to sample, so query with the memories themselves
+        queries = embeddings[rng.choice(len(embeddings), min(args.queries, len(embeddings)), replace=False)]
+    # Inputs with no known words embed as zeros, which every memory is equally far from
+    queries = queries[np.linalg.norm(queries, axis=1) > 0]
+
+    # Retrieval reranks num_results * oversample candidates, so that's the set that needs to be found
+    k = min(args.num_results * args.oversample, len(ids))
+    print(f"{len(ids)} memories, {len(queries)} queries, measuring recall@{k}")
+    _, best = tune(ids, embeddings, queries, k, args.recall,
+                   [int(trees) for trees in args.trees.split(',')],
+                   [int(multiplier) for multiplier in args.search_k_multipliers.split(',')])
+
+    if best is None:
+        print(f"Nothing reached a recall of {args.recall}, try more trees or larger search_k multipliers")
+        return
+    print(f"\nCheapest settings with recall@{k} >= {args.recall}:\n"
+          f"[memory]\nn_trees={best['n_trees']}\nsearch_k={best['search_k']}\n"
+          f"candidate_oversample={args.oversample}")
+
+
+if __name__ == '__main__':
+    main()
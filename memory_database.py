@@ -1,27 +1,53 @@
+import glob
+import os
+import sqlite3
 import threading
 import time
-from typing import Dict, List, Sequence, Optional
-from fuzzywuzzy import fuzz, process
-from urllib.parse import unquote
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, Iterator, List, Sequence, Optional, Set, Tuple
+from urllib.parse import quote, unquote
 
-import gensim.downloader as api
 import numpy as np
-from annoy import AnnoyIndex
-from sqlalchemy import Column, Integer, String, Float, LargeBinary, MetaData, func
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker, declarative_base
-from sqlalchemy.pool import StaticPool
+from sqlalchemy import Column, Integer, String, Float, LargeBinary, MetaData, Index, UniqueConstraint, func, \
+    inspect, or_, text, tuple_
+from sqlalchemy.orm import Session, declarative_base
+
+from conversation_session import DEFAULT_CONVERSATION_ID
+from db_connection import SQLiteDatabase
+from embedding_model import WORD2VEC_MODEL, EmbeddingCache, average_word_vectors, batch_average_word_vectors, \
+    load_compact_word2vec, load_word2vec
+from memory_metadata import MemoryMetadataStore
+from profile_key_index import ProfileKeyIndex
+from token_counter import TOKENIZER_NAME, count_tokens
+from vector_index import VectorIndex
+from write_behind import WRITE_BEHIND_GROUP, WRITE_BEHIND_MODES, WRITE_BEHIND_OFF, WriteBehindQueue
 
 Base = declarative_base()
 
+# Where memories go unless they're saved to a namespace, and where every memory saved before namespaces existed is
+GLOBAL_NAMESPACE = 'global'
+
 
 class ProfileData(Base):
+    # The table in the old per-user {user_id}_profile.db files, see ProfileStore.migrate_profile_files
     __tablename__ = 'profile_data'
 
     key = Column(String, primary_key=True)
     value = Column(String, nullable=False)
 
 
+class UserProfileData(Base):
+    __tablename__ = 'user_profile_data'
+    # Also the index a profile's keys are loaded by, user_id being its first column
+    __table_args__ = (UniqueConstraint('user_id', 'key', name='uq_user_profile_data_user_id_key'),)
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(String, nullable=False)
+    key = Column(String, nullable=False)
+    value = Column(String, nullable=False)
+
+
 class ArbitraryData(Base):
     __tablename__ = 'arbitrary_data'
 
@@ -33,71 +59,92 @@ class ArbitraryData(Base):
 
 class DialogueHistoryCompressed(Base):
     __tablename__ = 'dialogue_history_compressed'
+    # Dialogue is always read newest first, id breaks ties between entries with the same timestamp. Prompts read one
+    # conversation's dialogue, the second index keeps that a range scan however many conversations there are
+    __table_args__ = (Index('ix_dialogue_history_compressed_timestamp_id', 'timestamp', 'id'),
+                      Index('ix_dialogue_history_compressed_conversation_id_timestamp_id', 'conversation_id',
+                            'timestamp', 'id'))
 
     id = Column(Integer, primary_key=True)
     content = Column(String, nullable=False)
     timestamp = Column(String, nullable=False)
+    # Counted once when the row is saved, so prompts can be packed without tokenizing the dialogue again
+    token_count = Column(Integer, nullable=True)
+    # The channel, DM or user the dialogue was in. Dialogue saved before conversations were kept apart is the default
+    # conversation's
+    conversation_id = Column(String, nullable=True, default=DEFAULT_CONVERSATION_ID)
 
 
 class DialogueHistory(Base):
     __tablename__ = 'dialogue_history'
+    __table_args__ = (Index('ix_dialogue_history_timestamp_id', 'timestamp', 'id'),
+                      Index('ix_dialogue_history_conversation_id_timestamp_id', 'conversation_id', 'timestamp', 'id'))
 
     id = Column(Integer, primary_key=True)
     content = Column(String, nullable=False)
     speaker = Column(String, nullable=False)
     timestamp = Column(String, nullable=False)
+    token_count = Column(Integer, nullable=True)
+    conversation_id = Column(String, nullable=True, default=DEFAULT_CONVERSATION_ID)
 
 
 class Memories(Base):
     __tablename__ = 'memories'
+    # A namespace's memories are read together when its index is loaded
+    __table_args__ = (Index('ix_memories_namespace_id', 'namespace', 'id'),)
+
     id = Column(Integer, primary_key=True)
     memory_summary = Column(String)
     related_prompt = Column(String)
     embedding = Column(LargeBinary)
     timestamp = Column(String)
     importance = Column(Float)
+    # The tokens in related_prompt, which is what goes into prompts
+    token_count = Column(Integer, nullable=True)
+    # The guild, channel or user the memory was saved for, so searches for one don't turn up another's memories
+    namespace = Column(String, nullable=True, default=GLOBAL_NAMESPACE)
 
 
 def delete_unimportant_memories():
-    engine = create_engine(f"sqlite:///memories.db",
-                           connect_args={"check_same_thread": False},
-                           poolclass=StaticPool,
-                           echo=False)
-    session = scoped_session(sessionmaker(bind=engine))
-
-    Base.metadata.create_all(bind=engine)
-    session.query(Memories).filter(Memories.importance < 10.0).delete()
-    session.commit()
-    session.close()
+    db = SQLiteDatabase("memories.db")
+    db.create_all(Base.metadata)
+    with db.write_session() as session:
+        session.query(Memories).filter(Memories.importance < 10.0).delete()
+    db.dispose()
 
 
 # delete_unimportant_memories()
 
 class ProfileMemory:
+    """
+    A user's profile, key value pairs the fast model stores and fetches with fuzzy matched keys.
 
-    def __init__(self, user_id: str, display_name: str):
+    The profile is read from the store once and then served from memory, writes go to both.
+    """
+
+    def __init__(self, user_id: str, display_name: str, db: SQLiteDatabase):
         self.user_id = user_id
         self.display_name = display_name
-        self.db_file = f'{user_id}_profile.db'
-        engine = create_engine(f"sqlite:///{self.db_file}",
-                               connect_args={"check_same_thread": False},
-                               poolclass=StaticPool,
-                               echo=False)
-        self.Session = scoped_session(sessionmaker(bind=engine))
-
-        Base.metadata.create_all(bind=engine)
+        self.db = db
+        self._lock = threading.Lock()
+        with self.db.read_session() as session:
+            self._values: Dict[str, str] = dict(session.query(UserProfileData.key, UserProfileData.value).filter(
+                UserProfileData.user_id == user_id).all())
+        self._key_index = ProfileKeyIndex(self._values)
 
     def delete_key(self, key: str):
-        best_key = self.get_closest_key(key)
-        if best_key is not None:
-            session = self.Session()
-            session.query(ProfileData).filter(ProfileData.key == best_key).delete()
-            session.commit()
-            session.close()
+        with self._lock:
+            best_key = self.get_closest_key(key)
+            if best_key is not None:
+                with self.db.write_session() as session:
+                    session.query(UserProfileData).filter(UserProfileData.user_id == self.user_id,
+                                                          UserProfileData.key == best_key).delete()
+                del self._values[best_key]
+                self._key_index.remove(best_key)
 
     def get_closest_key(self, key: str, threshold: int = 80) -> Optional[str]:
         """Get the closest matching key using fuzzywuzzy for string matching"""
-        extracted = process.extract(key, self.get_all_keys())
+        extracted = self._key_index.extract(key)
         if extracted is None or len(extracted) == 0:
             return None
 
@@ -112,158 +159,636 @@ class ProfileMemory:
 
     def set_key_value(self, key: str, value: str):
         """If key exists, update value, else create new key value pair"""
-        session = self.Session()
-        best_key = self.get_closest_key(key)
-        if best_key is not None:
-            print(f"Updating key: key={key}, best_key={best_key}")
-            session.query(ProfileData).filter(ProfileData.key == best_key).update({ProfileData.value: value})
-        else:
-            new_data = ProfileData(key=key, value=value)
-            session.add(new_data)
-        session.commit()
-        session.close()
+        # Held across the lookup and the write, so two stores of a new key can't both add it
+        with self._lock:
+            best_key = self.get_closest_key(key)
+            if best_key is not None:
+                print(f"Updating key: key={key}, best_key={best_key}")
+            stored_key = best_key if best_key is not None else key
+            # Checked in the database rather than in memory, as an evicted copy of the profile that's still in use
+            # may have added or deleted the key since this one was loaded
+            with self.db.write_session() as session:
+                row = session.query(UserProfileData).filter(UserProfileData.user_id == self.user_id,
+                                                            UserProfileData.key == stored_key).first()
+                if row is not None:
+                    row.value = value
+                else:
+                    session.add(UserProfileData(user_id=self.user_id, key=stored_key, value=value))
+            if stored_key not in self._values:
+                self._key_index.add(stored_key)
+            self._values[stored_key] = value
 
     def get_key_value(self, key: str, threshold: int = 95) -> Optional[str]:
         """Get profile data closest key"""
         best_key = self.get_closest_key(key, threshold)
 
         if best_key is not None:
-            session = self.Session()
-            result = session.query(ProfileData).filter(ProfileData.key == best_key).first()
-            session.close()
-            return result.value
+            return self._values.get(best_key)
 
         return None
 
     def get_all_keys(self) -> List[str]:
         """Get all keys"""
-        session = self.Session()
-        keys = [index_key.key for index_key in session.query(ProfileData.key).all()]
-        session.close()
-        return keys
+        return list(self._values)
+
+
+class ProfileStore:
+    """
+    Every user's profile in one database, with the most recently used profiles held in memory. However many users
+    there are, that's one set of connections and at most max_cached_profiles profiles in memory.
+    """
+
+    def __init__(self, db_file: str = 'profiles.db', max_cached_profiles: int = 256,
+                 sqlite_synchronous: str = 'NORMAL'):
+        self.db = SQLiteDatabase(db_file, synchronous=sqlite_synchronous)
+        self.db.create_all(Base.metadata)
+        self.max_cached_profiles = max_cached_profiles
+        self._lock = threading.Lock()
+        # Least recently used first
+        self._profiles: 'OrderedDict[str, ProfileMemory]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._profiles)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._profiles
+
+    def get(self, user_id: str, display_name: str = '') -> ProfileMemory:
+        """The user's profile, loaded from the database if it isn't in memory"""
+        with self._lock:
+            profile = self._profiles.get(user_id)
+            if profile is not None:
+                self._profiles.move_to_end(user_id)
+                return profile
+
+            # Loaded under the lock, so a user's profile is only ever loaded once at a time
+            profile = ProfileMemory(user_id, display_name=display_name, db=self.db)
+            self._profiles[user_id] = profile
+            while len(self._profiles) > self.max_cached_profiles:
+                self._profiles.popitem(last=False)
+            return profile
+
+    def migrate_profile_files(self, directory: str = '.') -> int:
+        """
+        Copy the profiles in per-user {user_id}_profile.db files into the store, renaming each file to .migrated once
+        it's copied. Keys the store already has for a user are left as they are.
+
+        :param directory: Where to look for the files.
+        :return: The number of files migrated.
+        """
+        paths = sorted(glob.glob(os.path.join(glob.escape(directory), '*_profile.db')))
+        for path in paths:
+            user_id = os.path.basename(path)[:-len('_profile.db')]
+            connection = sqlite3.connect(path)
+            try:
+                rows = connection.execute("SELECT key, value FROM profile_data").fetchall()
+            except sqlite3.OperationalError:
+                # Created but never written to
+                rows = []
+            finally:
+                connection.close()
+
+            with self.db.write_session() as session:
+                existing_keys = {key for key, in session.query(UserProfileData.key).filter(
+                    UserProfileData.user_id == user_id)}
+                session.add_all([UserProfileData(user_id=user_id, key=key, value=value) for key, value in rows
+                                 if key not in existing_keys])
+            with self._lock:
+                # Reloaded with the migrated keys next time it's used
+                self._profiles.pop(user_id, None)
+
+            os.replace(path, f'{path}.migrated')
+            print(f"Migrated {len(rows)} profile keys for {user_id} from {path}")
+        return len(paths)
+
+
+class MemoryPartition:
+    """One namespace's memories as held in memory for searching, its vector index and retrieval metadata"""
+
+    def __init__(self, namespace: str, vector_index: VectorIndex):
+        self.namespace = namespace
+        self.vector_index = vector_index
+        self.memory_metadata = MemoryMetadataStore()
+        # Held while the index is loaded, so a namespace is only ever loaded once at a time
+        self.load_lock = threading.Lock()
+        self.loaded = False
 
 
 class MemoryDatabase:
 
-    def __init__(self, db_file: str):
+    def __init__(self, db_file: str, index_rebuild_threshold: int = 1000, model_cache_dir: str = None,
+                 compact_model_path: str = None, embedding_cache_size: int = 1024, n_trees: int = 10,
+                 search_k: int = -1, candidate_oversample: int = 3, sqlite_synchronous: str = 'NORMAL',
+                 write_behind: str = WRITE_BEHIND_OFF, write_behind_delay: float = 0.01,
+                 max_loaded_namespaces: int = 64):
+        """
+        :param write_behind: 'off' to commit each write as it's made, 'group' to commit queued writes in batches with
+            callers waiting for their batch, or 'async' to return as soon as a write is queued.
+        :param write_behind_delay: Seconds to let writes gather before committing a batch.
+        :param max_loaded_namespaces: The most namespaces whose index is kept in memory, the least recently searched
+            are unloaded first. The global namespace is always kept.
+        """
+        if write_behind not in WRITE_BEHIND_MODES:
+            raise ValueError(f"write_behind must be one of {', '.join(WRITE_BEHIND_MODES)}, not {write_behind!r}")
         print("Loading word2vec data... ", end='')
         begin_time = time.time()
-        self.word2vec = api.load("word2vec-google-news-300")
+        # Memory-mapped and shared with every other MemoryDatabase on the host
+        if compact_model_path:
+            self.word2vec = load_compact_word2vec(compact_model_path)
+            self.embedding_model_name = self.word2vec.name
+        else:
+            self.word2vec = load_word2vec(WORD2VEC_MODEL, cache_dir=model_cache_dir)
+            self.embedding_model_name = WORD2VEC_MODEL
         print(f"Loaded in {time.time() - begin_time} seconds")
         self.embedding_dim = self.word2vec.vector_size
-        self._db_lock = threading.Lock()
+        self.embedding_cache = EmbeddingCache(embedding_cache_size)
+        # Retrieval reranks this many times num_results nearest memories, so important memories just outside the
+        # nearest few still get a chance
+        self.candidate_oversample = candidate_oversample
+
+        # Pooled readers alongside a single writer, so retrieval isn't held up by saves from other conversations
+        self.db = SQLiteDatabase(db_file, synchronous=sqlite_synchronous)
+        self.db.create_all(Base.metadata)
+        # create_all skips tables that already exist, so databases made before columns and indexes were added need
+        # them created separately
+        self._add_missing_columns()
+        for table in (DialogueHistory.__table__, DialogueHistoryCompressed.__table__, Memories.__table__):
+            for index in table.indexes:
+                index.create(bind=self.db.writer_engine, checkfirst=True)
+        with self.db.write_session() as session:
+            session.query(Memories).filter(Memories.namespace.is_(None)).update(
+                {Memories.namespace: GLOBAL_NAMESPACE}, synchronize_session=False)
+            for model in (DialogueHistory, DialogueHistoryCompressed):
+                session.query(model).filter(model.conversation_id.is_(None)).update(
+                    {model.conversation_id: DEFAULT_CONVERSATION_ID}, synchronize_session=False)
+        self.backfill_token_counts()
+
+        self.write_behind_mode = write_behind
+        self.write_behind = None
+        if write_behind != WRITE_BEHIND_OFF:
+            self.write_behind = WriteBehindQueue(self.db, max_delay=write_behind_delay)
+        # With write-behind, counts are kept here so increments don't have to wait for the last one to be stored
+        self._counters: Dict[str, int] = {}
+        self._counter_lock = threading.Lock()
+
+        # Each namespace has an index of its own, loaded when it's first searched, so a search only costs as much as
+        # the namespaces it looks in
+        self.db_file = db_file
+        self.n_trees = n_trees
+        self.search_k = search_k
+        self.index_rebuild_threshold = index_rebuild_threshold
+        self.max_loaded_namespaces = max_loaded_namespaces
+        self._partitions_lock = threading.Lock()
+        # Least recently used first
+        self._partitions: 'OrderedDict[str, MemoryPartition]' = OrderedDict()
+        # Namespaces whose snapshot was built from embeddings that have since been regenerated
+        self._stale_snapshots: Set[str] = set()
+        if self.backfill_embeddings():
+            with self.db.read_session() as session:
+                self._stale_snapshots = {namespace for namespace, in session.query(Memories.namespace).distinct()}
+
+        print("Loading AnnoyIndex... ", end='')
+        begin_time = time.time()
+        self.partition(GLOBAL_NAMESPACE)
+        print(f"Loaded in {time.time() - begin_time} seconds")
 
-        engine = create_engine(f"sqlite:///{db_file}",
-                               connect_args={"check_same_thread": False},
-                               poolclass=StaticPool,
-                               echo=False)
-        self.Session = scoped_session(sessionmaker(bind=engine))
+    def _add_missing_columns(self):
+        with self.db.write_session() as session:
+            # On the session's connection, the writer pool only has the one
+            existing_tables = inspect(session.connection())
+            for table in Base.metadata.sorted_tables:
+                if not existing_tables.has_table(table.name):
+                    continue
+                existing_columns = {column['name'] for column in existing_tables.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name not in existing_columns:
+                        # Only nullable columns without server defaults are ever added, SQLite can add those in place
+                        column_type = column.type.compile(dialect=self.db.writer_engine.dialect)
+                        session.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+    def backfill_token_counts(self, batch_size: int = 1000) -> int:
+        """
+        Count the tokens of dialogue and memories that don't have a count, or were counted with a different tokenizer.
+        Once every row has been counted with the current tokenizer that's recorded, so later calls don't scan the
+        tables again.
 
-        Base.metadata.create_all(bind=engine)
+        :param batch_size: The number of rows to update per commit.
+        :return: The number of rows updated.
+        """
+        with self.db.read_session() as session:
+            settings = dict(session.query(ArbitraryData.key, ArbitraryData.str_value).filter(
+                ArbitraryData.key.in_(('tokenizer', 'token_counts_backfilled'))).all())
+        if settings.get('token_counts_backfilled') == TOKENIZER_NAME:
+            return 0
+        recount_all = 'tokenizer' in settings and settings['tokenizer'] != TOKENIZER_NAME
+
+        updated = 0
+        for model, text_column in ((DialogueHistory, DialogueHistory.content),
+                                   (DialogueHistoryCompressed, DialogueHistoryCompressed.content),
+                                   (Memories, Memories.related_prompt)):
+            with self.db.read_session() as session:
+                query = session.query(model.id, text_column)
+                if not recount_all:
+                    query = query.filter(model.token_count.is_(None))
+                missing = query.all()
+
+            for start in range(0, len(missing), batch_size):
+                with self.db.write_session() as session:
+                    session.bulk_update_mappings(model, [{'id': row_id, 'token_count': count_tokens(content or '')}
+                                                         for row_id, content in missing[start:start + batch_size]])
+            updated += len(missing)
+
+        # Rows saved from here on are counted as they're saved
+        with self.db.write_session() as session:
+            for key in ('tokenizer', 'token_counts_backfilled'):
+                setting = session.query(ArbitraryData).filter(ArbitraryData.key == key).first()
+                if setting is None:
+                    session.add(ArbitraryData(key=key, str_value=TOKENIZER_NAME))
+                else:
+                    setting.str_value = TOKENIZER_NAME
+
+        if updated:
+            print(f"Counted tokens for {updated} dialogue entries and memories")
+        return updated
+
+    @property
+    def vector_index(self) -> VectorIndex:
+        """The global namespace's index"""
+        return self.partition(GLOBAL_NAMESPACE).vector_index
+
+    @property
+    def memory_metadata(self) -> MemoryMetadataStore:
+        """The global namespace's retrieval metadata"""
+        return self.partition(GLOBAL_NAMESPACE).memory_metadata
+
+    @memory_metadata.setter
+    def memory_metadata(self, memory_metadata: MemoryMetadataStore):
+        self.partition(GLOBAL_NAMESPACE).memory_metadata = memory_metadata
+
+    def partition(self, namespace: str = GLOBAL_NAMESPACE) -> MemoryPartition:
+        """The namespace's memories ready to search, loading its index if it isn't in memory"""
+        with self._partitions_lock:
+            partition = self._partitions.get(namespace)
+            if partition is not None:
+                self._partitions.move_to_end(namespace)
+            else:
+                partition = MemoryPartition(namespace, VectorIndex(
+                    self.embedding_dim, n_trees=self.n_trees, rebuild_threshold=self.index_rebuild_threshold,
+                    snapshot_path=self._snapshot_path(namespace),
+                    snapshot_metadata=lambda memory_ids: self._index_snapshot_metadata(namespace, memory_ids),
+                    search_k=self.search_k))
+                self._partitions[namespace] = partition
+                self._evict_partitions()
+
+        # Loaded outside the partitions lock, so a cold namespace loading doesn't hold up searches of the others
+        with partition.load_lock:
+            if not partition.loaded:
+                self._load_partition(partition)
+        return partition
+
+    def loaded_namespaces(self) -> List[str]:
+        """The namespaces whose index is in memory, least recently used first"""
+        with self._partitions_lock:
+            return list(self._partitions)
+
+    def unload_namespace(self, namespace: str) -> bool:
+        """
+        Free the memory held for a namespace's index, it's loaded again the next time it's searched.
 
-        print("Building AnnoyIndex... ", end='')
-        begin_time = time.time()
-        self.annoy_index = AnnoyIndex(self.embedding_dim, 'angular')
-        self._build_annoy_index()
-        print(f"Loaded in {time.time() - begin_time} seconds")
+        :return: Whether the namespace was loaded.
+        """
+        with self._partitions_lock:
+            return self._partitions.pop(namespace, None) is not None
+
+    def _evict_partitions(self):
+        """Unload the least recently used namespaces over max_loaded_namespaces, called holding the partitions lock"""
+        evictable = [namespace for namespace in self._partitions if namespace != GLOBAL_NAMESPACE]
+        for namespace in evictable[:max(0, len(self._partitions) - self.max_loaded_namespaces)]:
+            del self._partitions[namespace]
+
+    def _loaded_partition(self, namespace: str) -> Optional[MemoryPartition]:
+        """The namespace's partition if its index is in memory, without loading it"""
+        with self._partitions_lock:
+            partition = self._partitions.get(namespace)
+        return partition if partition is not None and partition.loaded else None
+
+    def _loaded_partitions(self) -> List[MemoryPartition]:
+        with self._partitions_lock:
+            return [partition for partition in self._partitions.values() if partition.loaded]
+
+    def _snapshot_path(self, namespace: str) -> Optional[str]:
+        """Indexes are snapshotted next to the database so they can be memory-mapped the next time they're loaded"""
+        if self.db_file == ':memory:':
+            return None
+        if namespace == GLOBAL_NAMESPACE:
+            # Where the only index was snapshotted before there were namespaces
+            return f'{self.db_file}.annoy'
+        return f'{self.db_file}.{quote(namespace, safe="")}.annoy'
+
+    def _load_partition(self, partition: MemoryPartition):
+        """Memory-map the namespace's index snapshot if it's still usable, otherwise rebuild it, then add any of its
+        memories saved since"""
+        namespace = partition.namespace
+        metadata = None
+        if namespace not in self._stale_snapshots:
+            metadata = partition.vector_index.load_snapshot()
+            if metadata is not None and not self._index_snapshot_is_current(namespace, metadata):
+                metadata = None
+        if metadata is not None:
+            indexed_up_to = metadata['max_id']
+        else:
+            indexed_up_to = self._build_annoy_index(partition)
+            self._stale_snapshots.discard(namespace)
+
+        # Saves from here on add themselves to the index, anything committed before is read below
+        partition.loaded = True
+        with self.db.read_session() as session:
+            new_embeddings = session.query(Memories.id, Memories.embedding).filter(
+                Memories.namespace == namespace, Memories.id > indexed_up_to).all()
+        for memory_id, embedding in new_embeddings:
+            partition.vector_index.add_item(memory_id, self._deserialize_embedding(embedding))
+
+    def _index_snapshot_metadata(self, namespace: str, memory_ids: Set[int]) -> Dict:
+        return {'model': self.embedding_model_name, 'namespace': namespace, 'max_id': max(memory_ids, default=0)}
+
+    def _index_snapshot_is_current(self, namespace: str, metadata: Dict) -> bool:
+        """A snapshot is current if it was built for this namespace with this model and tree count, and no memory it
+        covers was deleted since"""
+        if metadata.get('model') != self.embedding_model_name or metadata.get('n_trees') != self.n_trees \
+                or metadata.get('namespace', GLOBAL_NAMESPACE) != namespace or 'max_id' not in metadata:
+            return False
+        with self.db.read_session() as session:
+            covered_count = session.query(func.count(Memories.id)).filter(
+                Memories.namespace == namespace, Memories.id <= metadata['max_id']).scalar()
+        return covered_count == metadata['item_count']
+
+    def _build_annoy_index(self, partition: MemoryPartition) -> int:
+        """
+        Build the namespace's index from its stored embeddings.
 
-    def _build_annoy_index(self):
-        memories = self.get_all_memories()
-        ID_COLUMN = 0
-        SUMMARY_COLUMN = 1
+        :return: The highest memory id in the index.
+        """
+        max_id = 0
 
-        for memory in memories:
-            embedding = self._generate_embedding(memory[SUMMARY_COLUMN])
-            self.annoy_index.add_item(memory[ID_COLUMN], embedding)
+        def stored_embeddings():
+            nonlocal max_id
+            with self.db.read_session() as session:
+                for memory_id, embedding in session.query(Memories.id, Memories.embedding).filter(
+                        Memories.namespace == partition.namespace).yield_per(10000):
+                    max_id = max(max_id, memory_id)
+                    yield memory_id, self._deserialize_embedding(embedding)
 
-        self.annoy_index.build(10)  # You can adjust the number of trees (10) for better accuracy
+        partition.vector_index.build(stored_embeddings())
+        return max_id
 
-    def save_dialogue_entry(self, speaker: str, content: str, timestamp: str):
-        session = self.Session()
-        decoded_content = unquote(content)
-        new_dialogue = DialogueHistory(speaker=speaker, content=decoded_content, timestamp=timestamp)
-        session.add(new_dialogue)
-        session.commit()
-        session.close()
+    def backfill_embeddings(self, batch_size: int = 1000) -> int:
+        """
+        Generate and store embeddings for memories that don't have one, or whose stored embedding doesn't match the
+        dimensions of the current word2vec model. If the stored embeddings came from a different model they're all
+        regenerated.
 
-    def set_count(self, key: str, value: int):
-        # Set the count of a key to a specific value
-        session = self.Session()
+        :param batch_size: The number of memories to update per commit.
+        :return: The number of memories updated.
+        """
+        expected_size = self.embedding_dim * np.dtype(np.float32).itemsize
+        with self.db.read_session() as session:
+            model_setting = session.query(ArbitraryData.str_value).filter(
+                ArbitraryData.key == 'embedding_model').first()
+            # Embeddings stored before the model was recorded came from the full word2vec model
+            embedded_with = model_setting.str_value if model_setting is not None else WORD2VEC_MODEL
+
+            query = session.query(Memories.id, Memories.memory_summary)
+            if embedded_with == self.embedding_model_name:
+                query = query.filter(or_(Memories.embedding.is_(None),
+                                         func.length(Memories.embedding) != expected_size))
+            missing = query.all()
+
+        # Embedding happens outside the write session, so other writers only wait for each batch's update
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start:start + batch_size]
+            embeddings = self.generate_embeddings([summary or '' for _, summary in batch])
+            with self.db.write_session() as session:
+                session.bulk_update_mappings(Memories, [
+                    {'id': memory_id, 'embedding': self._serialize_embedding(embedding)}
+                    for (memory_id, _), embedding in zip(batch, embeddings)])
+
+        if embedded_with != self.embedding_model_name or model_setting is None:
+            with self.db.write_session() as session:
+                setting = session.query(ArbitraryData).filter(ArbitraryData.key == 'embedding_model').first()
+                if setting is None:
+                    session.add(ArbitraryData(key='embedding_model', str_value=self.embedding_model_name))
+                else:
+                    setting.str_value = self.embedding_model_name
+
+        if missing:
+            print(f"Backfilled embeddings for {len(missing)} memories")
+        return len(missing)
+
+    def _write(self, operation: Callable[[Session], Any], on_commit: Callable[[Any], None] = None,
+               session_key: Hashable = None) -> Any:
+        """
+        Make a write in a transaction of its own, or through the write-behind queue if there is one.
+
+        :param operation: Makes the write with the session it's given.
+        :param on_commit: Called with what operation returned once the write is committed.
+        :param session_key: The conversation the write is for, so its reads can wait for it.
+        :return: What operation returned, or None if the write was queued without waiting for it.
+        """
+        if self.write_behind is None:
+            with self.db.write_session() as session:
+                result = operation(session)
+            if on_commit is not None:
+                on_commit(result)
+            return result
+
+        return self._wait_for_write(self.write_behind.submit(operation, on_commit=on_commit, key=session_key))
+
+    def _wait_for_write(self, future: Future) -> Any:
+        """
+        Wait for a queued write to be committed if writes are grouped, so callers can queue it under a lock and wait
+        after releasing it.
+
+        :param future: What the write-behind queue returned for the write.
+        :return: What the write's operation returned, or None if writes are made without waiting for them.
+        """
+        if self.write_behind_mode == WRITE_BEHIND_GROUP:
+            return future.result()
+        return None
+
+    def _wait_for_writes(self, session_key: Hashable = None):
+        """Wait for queued writes made for session_key, or for every queued write if it's None, so reads see them"""
+        if self.write_behind is not None:
+            self.write_behind.wait_for(session_key)
+
+    def flush(self):
+        """Wait for every queued write to be committed"""
+        self._wait_for_writes()
+
+    def close(self):
+        """Commit any queued writes and close the database"""
+        if self.write_behind is not None:
+            self.write_behind.close()
+        for partition in self._loaded_partitions():
+            partition.vector_index.wait_for_rebuild()
+        self.db.dispose()
+
+    def save_dialogue_entry(self, speaker: str, content: str, timestamp: str, session_key: Hashable = None,
+                            conversation_id: str = None):
+        decoded_content = unquote(content)
+        token_count = count_tokens(decoded_content)
+        self._write(lambda session: session.add(DialogueHistory(speaker=speaker, content=decoded_content,
+                                                                timestamp=timestamp, token_count=token_count,
+                                                                conversation_id=conversation_id)),
+                    session_key=session_key)
+
+    @staticmethod
+    def _store_count(session: Session, key: str, value: int):
         arbitrary_data = session.query(ArbitraryData).filter(ArbitraryData.key == key).first()
         if arbitrary_data is None:
             arbitrary_data = ArbitraryData(key=key, int_value=value)
             session.add(arbitrary_data)
         else:
             arbitrary_data.int_value = value
-        session.commit()
-        session.close()
 
-    def increment_count(self, key: str) -> int:
-        session = self.Session()
-        arbitrary_data = session.query(ArbitraryData).filter(ArbitraryData.key == key).first()
-        if arbitrary_data is None:
-            arbitrary_data = ArbitraryData(key=key, int_value=1)
-            session.add(arbitrary_data)
-        else:
-            arbitrary_data.int_value += 1
-        result = int(arbitrary_data.int_value)
-        session.commit()
-        session.close()
-        return result
-
-    def get_dialogue_history(self, num_results: int = None, max_length: int = 2000) -> List[Dict]:
-        session = self.Session()
-        query = session.query(DialogueHistory).order_by(DialogueHistory.timestamp.desc())
+    def set_count(self, key: str, value: int):
+        # Set the count of a key to a specific value
+        if self.write_behind is None:
+            self._write(lambda session: self._store_count(session, key, value))
+            return
 
-        if num_results is not None:
-            query = query.limit(num_results)
+        with self._counter_lock:
+            self._counters[key] = value
+            future = self.write_behind.submit(lambda session: self._store_count(session, key, value))
+        self._wait_for_write(future)
 
-        dialogue_history = query.all()
-        session.close()
+    def increment_count(self, key: str) -> int:
+        if self.write_behind is None:
+            # Read and written in the one write session, so concurrent increments can't be lost
+            with self.db.write_session() as session:
+                arbitrary_data = session.query(ArbitraryData).filter(ArbitraryData.key == key).first()
+                if arbitrary_data is None:
+                    arbitrary_data = ArbitraryData(key=key, int_value=1)
+                    session.add(arbitrary_data)
+                else:
+                    arbitrary_data.int_value += 1
+                result = int(arbitrary_data.int_value)
+            return result
+
+        # Counted in memory, the writes are queued under the lock so they're stored in the order they were counted,
+        # and waited for after it's released so grouped increments can share a batch
+        with self._counter_lock:
+            if key not in self._counters:
+                with self.db.read_session() as session:
+                    stored = session.query(ArbitraryData.int_value).filter(ArbitraryData.key == key).first()
+                self._counters[key] = int(stored.int_value or 0) if stored is not None else 0
+            self._counters[key] += 1
+            result = self._counters[key]
+            future = self.write_behind.submit(lambda session: self._store_count(session, key, result))
+        self._wait_for_write(future)
+        return result
 
-        total_dialogue_length = 0
-        dialogue_to_return = []
-        for entry in reversed(dialogue_history):
-            content_length = len(entry.content)
-            total_dialogue_length += content_length
-            if total_dialogue_length > max_length:
-                break
-            dialogue_to_return.insert(0, entry)
+    def get_dialogue_history(self, num_results: int = None, max_length: int = 2000,
+                             session_key: Hashable = None, max_tokens: int = None,
+                             conversation_id: str = None) -> List[Dict]:
+        """
+        Get the most recent dialogue, newest first.
+
+        :param num_results: The maximum number of entries to return.
+        :param max_length: The maximum total length of the content returned.
+        :param session_key: Only wait for this conversation's queued writes, rather than every queued write.
+        :param max_tokens: The maximum total tokens of the content returned, used instead of max_length if given.
+        :param conversation_id: Only return this conversation's dialogue, rather than every conversation's.
+        :return: A list of dialogue entries.
+        """
+        self._wait_for_writes(session_key)
+        columns = (DialogueHistory.id, DialogueHistory.speaker, DialogueHistory.content, DialogueHistory.timestamp,
+                   DialogueHistory.token_count)
+        return self._get_recent_within_length(DialogueHistory, columns, num_results, max_length, max_tokens,
+                                              conversation_id)
+
+    def iter_dialogue_history(self, page_size: int = 500, before: Tuple[str, int] = None,
+                              conversation_id: str = None) -> Iterator[Dict]:
+        """
+        Iterate over the whole dialogue history, newest first, a page at a time.
 
-        return [{'id': entry.id, 'speaker': entry.speaker, 'content': entry.content, 'timestamp': entry.timestamp} for
-                entry in dialogue_to_return]
+        :param page_size: The number of entries read per query.
+        :param before: Only return entries older than this (timestamp, id).
+        :param conversation_id: Only return this conversation's dialogue, rather than every conversation's.
+        """
+        self._wait_for_writes()
+        columns = (DialogueHistory.id, DialogueHistory.speaker, DialogueHistory.content, DialogueHistory.timestamp)
+        return self._iter_newest_first(DialogueHistory, columns, page_size, before, conversation_id)
 
-    def save_compressed_dialogue_entry(self, content: str, timestamp: str):
-        session = self.Session()
+    def save_compressed_dialogue_entry(self, content: str, timestamp: str, session_key: Hashable = None,
+                                       conversation_id: str = None):
         decoded_content = unquote(content)
-        new_dialogue = DialogueHistoryCompressed(content=decoded_content, timestamp=timestamp)
-        session.add(new_dialogue)
-        session.commit()
-        session.close()
-
-    def get_compressed_dialogue_history(self, num_results: int = None, max_length: int = 1000) -> List[Dict]:
-        session = self.Session()
-        query = session.query(DialogueHistoryCompressed).order_by(DialogueHistoryCompressed.timestamp.desc())
-
-        if num_results is not None:
-            query = query.limit(num_results)
-
-        dialogue_history_compressed = query.all()
-        session.close()
-
-        total_dialogue_length = 0
-        dialogue_to_return = []
-        for entry in reversed(dialogue_history_compressed):
-            content_length = len(entry.content)
-            total_dialogue_length += content_length
-            if total_dialogue_length > max_length:
-                break
-            dialogue_to_return.insert(0, entry)
-
-        return [{'id': entry.id, 'content': entry.content, 'timestamp': entry.timestamp} for
-                entry in dialogue_to_return]
-
-    def save_memory(self, memory_summary: str, related_prompt: str, timestamp: str, importance: float):
+        token_count = count_tokens(decoded_content)
+        self._write(lambda session: session.add(DialogueHistoryCompressed(content=decoded_content,
+                                                                          timestamp=timestamp,
+                                                                          token_count=token_count,
+                                                                          conversation_id=conversation_id)),
+                    session_key=session_key)
+
+    def get_compressed_dialogue_history(self, num_results: int = None, max_length: int = 1000,
+                                        session_key: Hashable = None, max_tokens: int = None,
+                                        conversation_id: str = None) -> List[Dict]:
+        self._wait_for_writes(session_key)
+        columns = (DialogueHistoryCompressed.id, DialogueHistoryCompressed.content, DialogueHistoryCompressed.timestamp,
+                   DialogueHistoryCompressed.token_count)
+        return self._get_recent_within_length(DialogueHistoryCompressed, columns, num_results, max_length,
+                                              max_tokens, conversation_id)
+
+    def iter_compressed_dialogue_history(self, page_size: int = 500, before: Tuple[str, int] = None,
+                                         conversation_id: str = None) -> Iterator[Dict]:
+        self._wait_for_writes()
+        columns = (DialogueHistoryCompressed.id, DialogueHistoryCompressed.content, DialogueHistoryCompressed.timestamp)
+        return self._iter_newest_first(DialogueHistoryCompressed, columns, page_size, before, conversation_id)
+
+    def _get_recent_within_length(self, model, columns: Sequence, num_results: Optional[int],
+                                  max_length: int, max_tokens: int = None, conversation_id: str = None) -> List[Dict]:
+        """
+        Newest rows first, reading from the timestamp index only until max_length worth of content is found, or
+        max_tokens worth if it's given
+        """
+        total = 0
+        rows = []
+        with self.db.read_session() as session:
+            query = session.query(*columns).order_by(model.timestamp.desc(), model.id.desc())
+            if conversation_id is not None:
+                query = query.filter(model.conversation_id == conversation_id)
+            if num_results is not None:
+                query = query.limit(num_results)
+
+            for row in query.yield_per(100):
+                row = row._asdict()
+                if row['token_count'] is None:
+                    # Saved by a process that hadn't backfilled yet
+                    row['token_count'] = count_tokens(row['content'])
+                total += len(row['content']) if max_tokens is None else row['token_count']
+                if total > (max_length if max_tokens is None else max_tokens):
+                    break
+                rows.append(row)
+        return rows
+
+    def _iter_newest_first(self, model, columns: Sequence, page_size: int, before: Optional[Tuple[str, int]],
+                           conversation_id: str = None) -> Iterator[Dict]:
+        """Keyset pagination on (timestamp, id), so each page is an index range scan however deep it is"""
+        while True:
+            with self.db.read_session() as session:
+                query = session.query(*columns).order_by(model.timestamp.desc(), model.id.desc())
+                if conversation_id is not None:
+                    query = query.filter(model.conversation_id == conversation_id)
+                if before is not None:
+                    query = query.filter(tuple_(model.timestamp, model.id) < tuple_(*before))
+                page = [row._asdict() for row in query.limit(page_size)]
+
+            yield from page
+            if len(page) < page_size:
+                return
+            before = (page[-1]['timestamp'], page[-1]['id'])
+
+    def save_memory(self, memory_summary: str, related_prompt: str, timestamp: str, importance: float,
+                    session_key: Hashable = None, namespace: str = GLOBAL_NAMESPACE):
         # embedding = self._generate_embedding(memory_summary)
         # same_memory = self.find_same_memory(embedding)
 
@@ -277,54 +802,80 @@ class MemoryDatabase:
         if scaled_importance < 2.0:
             # Don't save memories that are too low importance
             return
-        self.insert_memory(memory_summary, related_prompt, timestamp, scaled_importance)
-
-    def insert_memory(self, memory_summary: str, related_prompt: str, timestamp: str, importance: float):
-        session = self.Session()
+        self.insert_memory(memory_summary, related_prompt, timestamp, scaled_importance, session_key=session_key,
+                           namespace=namespace)
 
+    def insert_memory(self, memory_summary: str, related_prompt: str, timestamp: str, importance: float,
+                      session_key: Hashable = None, namespace: str = GLOBAL_NAMESPACE):
         print(f"ADDING MEMORY: s:{memory_summary}\nr:{related_prompt}\nt:{timestamp}\ni:{importance}")
-        new_memory = Memories(memory_summary=memory_summary, related_prompt=related_prompt,
-                              embedding=None, timestamp=timestamp, importance=importance)
-        session.add(new_memory)
-        session.commit()
-
         embedding = self._generate_embedding(memory_summary)
-        self.annoy_index.unbuild()
-        self.annoy_index.add_item(new_memory.id, embedding)
-        self.annoy_index.build(10)
-
-        session.close()
+        serialized_embedding = self._serialize_embedding(embedding)
+        token_count = count_tokens(related_prompt or '')
+
+        def insert(session: Session) -> int:
+            new_memory = Memories(memory_summary=memory_summary, related_prompt=related_prompt,
+                                  embedding=serialized_embedding, timestamp=timestamp, importance=importance,
+                                  token_count=token_count, namespace=namespace)
+            session.add(new_memory)
+            session.flush()
+            return new_memory.id
+
+        def index(memory_id: int):
+            # A namespace that isn't loaded reads the memory from the database when it is
+            partition = self._loaded_partition(namespace)
+            if partition is None:
+                return
+            # Only once committed, so a reader never finds an id in the index that isn't in the database yet
+            partition.memory_metadata.upsert(memory_id, memory_summary, related_prompt, timestamp, importance,
+                                             token_count)
+            # Goes into the index's delta, the full index is only rebuilt in the background once enough have built up
+            partition.vector_index.add_item(memory_id, embedding)
+
+        self._write(insert, on_commit=index, session_key=session_key)
 
     def update_memory(self, memory_id: int, timestamp: str, new_importance: float):
-        session = self.Session()
+        def update(session: Session) -> int:
+            return session.query(Memories).filter(Memories.id == memory_id).update(
+                {Memories.timestamp: timestamp, Memories.importance: new_importance})
+
+        def update_metadata(updated: int):
+            if updated:
+                # Only the partition holding the memory has it in its metadata, the others ignore the update
+                for partition in self._loaded_partitions():
+                    partition.memory_metadata.update(memory_id, timestamp, new_importance)
 
-        memory = session.query(Memories).filter(Memories.id == memory_id).first()
-        if memory:
-            memory.timestamp = timestamp
-            memory.importance = new_importance
-            session.commit()
+        self._write(update, on_commit=update_metadata)
 
-        session.close()
+    def delete_memory(self, memory_id: int):
+        def remove_from_index(_):
+            for partition in self._loaded_partitions():
+                partition.memory_metadata.remove(memory_id)
+                partition.vector_index.remove_item(memory_id)
 
-    def find_same_memory(self, new_embedding: np.ndarray, threshold: float = 0.99) -> Optional[Memories]:
+        self._write(lambda session: session.query(Memories).filter(Memories.id == memory_id).delete(),
+                    on_commit=remove_from_index)
+
+    def find_same_memory(self, new_embedding: np.ndarray, threshold: float = 0.99,
+                         namespace: str = GLOBAL_NAMESPACE) -> Optional[Memories]:
         """
         Find a memory in the database with a similar embedding to the given embedding.
 
         :param new_embedding: The embedding to compare with the existing memories.
         :param threshold: The similarity threshold above which a memory is considered similar.
+        :param namespace: The namespace to look in.
         :return: The similar memory if found, otherwise None.
         """
-        closest_memory_ids, closest_memory_distances = self.annoy_index.get_nns_by_vector(new_embedding, 1,
-                                                                                          include_distances=True)
-        session = self.Session()
-
+        closest_memory_ids, closest_memory_distances = self.partition(namespace).vector_index.get_nns_by_vector(
+            new_embedding, 1, include_distances=True)
         if not closest_memory_ids:
             return None
 
-        memory = session.query(Memories).filter(Memories.id == closest_memory_ids[0]).first()
+        self._wait_for_writes()
+        with self.db.read_session() as session:
+            memory = session.query(Memories).filter(Memories.id == closest_memory_ids[0]).first()
 
-        if memory:
-            existing_embedding = np.frombuffer(memory.embedding, dtype=np.float32)
+        if memory and memory.embedding is not None:
+            existing_embedding = self._deserialize_embedding(memory.embedding)
             similarity = self.calculate_similarity(new_embedding, existing_embedding)
             if similarity > threshold:
                 return memory
@@ -332,11 +883,11 @@ class MemoryDatabase:
         return None
 
     def get_all_memories(self) -> Sequence:
-        session = self.Session()
-        cursor = session.connection().connection.cursor()
-        cursor.execute("SELECT * FROM memories")
-        memories = cursor.fetchall()
-        session.close()
+        self._wait_for_writes()
+        with self.db.read_session() as session:
+            cursor = session.connection().connection.cursor()
+            cursor.execute("SELECT * FROM memories")
+            memories = cursor.fetchall()
         return memories
 
     def calculate_similarity(self, embedding1: np.ndarray, embedding2: np.ndarray) -> float:
@@ -349,46 +900,62 @@ class MemoryDatabase:
         """
         return np.dot(embedding1, embedding2) / (np.linalg.norm(embedding1) * np.linalg.norm(embedding2))
 
-    def retrieve_relevant_memories(self, user_input: str, num_results: int = 5, similarity_weight: float = 0.5) -> List[
-        Dict]:
+    def retrieve_relevant_memories(self, user_input: str, num_results: int = 5, similarity_weight: float = 0.5,
+                                   session_key: Hashable = None, namespace: str = GLOBAL_NAMESPACE,
+                                   include_global: bool = True) -> List[Dict]:
         """
         Retrieve memories relevant to the user input.
 
         :param user_input: The user input to find relevant memories.
         :param num_results: The number of results to return.
+        :param session_key: Only wait for this conversation's queued writes, rather than every queued write.
+        :param namespace: The namespace to search.
+        :param include_global: Whether to search the global namespace as well.
         :return: A list of relevant memories.
         """
+        self._wait_for_writes(session_key)
         user_input_embedding = self._generate_embedding(user_input)
 
-        closest_memory_ids, closest_memory_distances = self.annoy_index.get_nns_by_vector(
-            user_input_embedding, num_results, include_distances=True)
-
-        closest_memories = []
-        session = self.Session()
-
-        for memory_id, distance in zip(closest_memory_ids, closest_memory_distances):
-            memory = session.query(Memories).filter(Memories.id == memory_id).first()
-
-            if memory is not None:
-                closest_memories.append({
-                    'memory_id': memory.id,
-                    'memory_summary': memory.memory_summary,
-                    'related_prompt': memory.related_prompt,
-                    'timestamp': memory.timestamp,
-                    'importance': memory.importance,
-                    'distance': distance
-                })
-
-        session.close()
-
-        # Sort the memories by their combined scores
-        sorted_memories = sorted(
-            closest_memories,
-            key=lambda x: self.calculate_combined_score(1 - x['distance'], x['importance'], similarity_weight),
-            reverse=True
-        )
-
-        return sorted_memories
+        namespaces = [namespace]
+        if include_global and namespace != GLOBAL_NAMESPACE:
+            namespaces.append(GLOBAL_NAMESPACE)
+        # Each namespace gives its own candidates, which are then reranked together
+        distances, importances, columns = [], [], {}
+        for partition in map(self.partition, namespaces):
+            closest_memory_ids, closest_memory_distances = partition.vector_index.get_nns_by_vector(
+                user_input_embedding, num_results * self.candidate_oversample, include_distances=True)
+
+            # Anything not seen since the namespace was loaded is fetched in one query and kept for next time
+            missing_ids = partition.memory_metadata.missing(closest_memory_ids)
+            if missing_ids:
+                with self.db.read_session() as session:
+                    partition.memory_metadata.upsert_many(session.query(
+                        Memories.id, Memories.memory_summary, Memories.related_prompt, Memories.timestamp,
+                        Memories.importance, Memories.token_count).filter(Memories.id.in_(missing_ids)))
+
+            found, partition_columns, partition_importances = partition.memory_metadata.get_many(closest_memory_ids)
+            distances.append(np.array(closest_memory_distances, dtype=np.float64)[found])
+            importances.append(partition_importances)
+            partition_columns['namespace'] = [partition.namespace] * len(found)
+            for name, values in partition_columns.items():
+                columns.setdefault(name, []).extend(values)
+        distances = np.concatenate(distances)
+        importances = np.concatenate(importances)
+
+        # Sort the memories by their combined scores, a stable sort keeps ties in distance order
+        scores = self.calculate_combined_score(1 - distances, importances, similarity_weight)
+        order = np.argsort(-scores, kind='stable')[:num_results]
+
+        return [{
+            'memory_id': columns['memory_id'][i],
+            'memory_summary': columns['memory_summary'][i],
+            'related_prompt': columns['related_prompt'][i],
+            'timestamp': columns['timestamp'][i],
+            'importance': None if np.isnan(importances[i]) else float(importances[i]),
+            'distance': float(distances[i]),
+            'token_count': columns['token_count'][i],
+            'namespace': columns['namespace'][i]
+        } for i in order]
 
     def calculate_combined_score(self, similarity: float, importance: float, similarity_weight: float) -> float:
         """
@@ -402,11 +969,30 @@ class MemoryDatabase:
         return similarity_weight * similarity + (1 - similarity_weight) * importance
 
     def _generate_embedding(self, text: str) -> np.ndarray:
+        # Repeated inputs (retries, greetings, bot commands) are served from the cache, the array returned is read-only
+        return self.embedding_cache.get(text, self._embed_text)
+
+    def _embed_text(self, text: str) -> np.ndarray:
         words = self._preprocess_text(text)
-        word_embeddings = [self.word2vec[word.strip(',').strip(' ')] for word in words if word in self.word2vec]
-        if not word_embeddings:
-            return np.zeros(self.word2vec.vector_size)
-        return np.mean(word_embeddings, axis=0)
+        return average_word_vectors(self.word2vec, words)
+
+    def generate_embeddings(self, texts: Sequence[str]) -> np.ndarray:
+        """
+        Embed many texts at once, each row is identical to what _generate_embedding gives for that text.
+
+        :param texts: The texts to embed.
+        :return: A (len(texts), embedding_dim) float32 array.
+        """
+        return batch_average_word_vectors(self.word2vec, [self._preprocess_text(text) for text in texts])
+
+    @staticmethod
+    def _serialize_embedding(embedding: np.ndarray) -> bytes:
+        """Embeddings are stored as raw float32 blobs in Memories.embedding"""
+        return np.asarray(embedding, dtype=np.float32).tobytes()
+
+    @staticmethod
+    def _deserialize_embedding(blob: bytes) -> np.ndarray:
+        return np.frombuffer(blob, dtype=np.float32)
 
     def _preprocess_text(self, text: str) -> List[str]:
         text = text.lower()
@@ -0,0 +1,109 @@
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+class MemoryMetadataStore:
+    """
+    In-memory, id-indexed copy of the memory metadata needed to return retrieval results, held column by column so
+    importances can be gathered straight into a NumPy array for scoring.
+
+    Rows are added the first time they're fetched from SQLite and kept in sync by MemoryDatabase's insert, update and
+    delete.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._positions: Dict[int, int] = {}
+        self._ids: List[int] = []
+        self._summaries: List[str] = []
+        self._prompts: List[str] = []
+        self._timestamps: List[str] = []
+        self._token_counts: List[Optional[int]] = []
+        self._importances = np.zeros(1024, dtype=np.float64)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, memory_id: int) -> bool:
+        return memory_id in self._positions
+
+    def upsert(self, memory_id: int, memory_summary: str, related_prompt: str, timestamp: str, importance: float,
+               token_count: int = None):
+        with self._lock:
+            position = self._positions.get(memory_id)
+            if position is None:
+                position = len(self._ids)
+                self._positions[memory_id] = position
+                self._ids.append(memory_id)
+                self._summaries.append(memory_summary)
+                self._prompts.append(related_prompt)
+                self._timestamps.append(timestamp)
+                self._token_counts.append(token_count)
+                if position >= len(self._importances):
+                    self._importances = np.concatenate([self._importances, np.zeros_like(self._importances)])
+            else:
+                self._summaries[position] = memory_summary
+                self._prompts[position] = related_prompt
+                self._timestamps[position] = timestamp
+                self._token_counts[position] = token_count
+            self._importances[position] = np.nan if importance is None else importance
+
+    def upsert_many(self, rows: Iterable[Tuple]):
+        """Add (id, summary, prompt, timestamp, importance) rows, optionally with the prompt's token count last"""
+        for row in rows:
+            self.upsert(*row)
+
+    def update(self, memory_id: int, timestamp: str, importance: float):
+        """Update a memory's timestamp and importance, if it's in the store"""
+        with self._lock:
+            position = self._positions.get(memory_id)
+            if position is not None:
+                self._timestamps[position] = timestamp
+                self._importances[position] = np.nan if importance is None else importance
+
+    def remove(self, memory_id: int):
+        with self._lock:
+            position = self._positions.pop(memory_id, None)
+            if position is None:
+                return
+            # Move the last row into the gap so the columns stay dense
+            last = len(self._ids) - 1
+            if position != last:
+                self._ids[position] = self._ids[last]
+                self._summaries[position] = self._summaries[last]
+                self._prompts[position] = self._prompts[last]
+                self._timestamps[position] = self._timestamps[last]
+                self._token_counts[position] = self._token_counts[last]
+                self._importances[position] = self._importances[last]
+                self._positions[self._ids[position]] = position
+            del self._ids[last], self._summaries[last], self._prompts[last], self._timestamps[last], \
+                self._token_counts[last]
+
+    def missing(self, memory_ids: Sequence[int]) -> List[int]:
+        """The ids that aren't in the store"""
+        return [memory_id for memory_id in memory_ids if memory_id not in self._positions]
+
+    def get_many(self, memory_ids: Sequence[int]) -> Tuple[np.ndarray, Dict[str, list], np.ndarray]:
+        """
+        Look up several memories at once.
+
+        :param memory_ids: The ids to look up.
+        :return: The indices into memory_ids of the ids that were found, the found rows' metadata by column, and
+            their importances as an array (NaN where a memory has no importance).
+        """
+        with self._lock:
+            found = [(index, self._positions[memory_id]) for index, memory_id in enumerate(memory_ids)
+                     if memory_id in self._positions]
+            found_indices = np.array([index for index, _ in found], dtype=np.int64)
+            positions = [position for _, position in found]
+            columns = {
+                'memory_id': [self._ids[position] for position in positions],
+                'memory_summary': [self._summaries[position] for position in positions],
+                'related_prompt': [self._prompts[position] for position in positions],
+                'timestamp': [self._timestamps[position] for position in positions],
+                'token_count': [self._token_counts[position] for position in positions],
+            }
+            importances = self._importances[np.array(positions, dtype=np.int64)]
+        return found_indices, columns, importances
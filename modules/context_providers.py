@@ -0,0 +1,225 @@
+import heapq
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_GEOCODE_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'gpt-semantic-memory', 'geocode.json')
+
+
+class ContextProvider:
+    """A value from an external service, such as the weather, kept up to date in the background"""
+
+    def __init__(self, name: str, fetch: Callable[[], Any], refresh_interval: float, ttl: float, jitter: float):
+        self.name = name
+        self.fetch = fetch
+        self.refresh_interval = refresh_interval
+        self.ttl = ttl
+        self.jitter = jitter
+        self.value = None
+        self.fetched_at: Optional[float] = None
+        self.refreshing = False
+        # The sequence number of the provider's current entry in the schedule, earlier entries have been superseded
+        self.scheduled: Optional[int] = None
+        self.due = 0.0
+        self.fetch_count = 0
+        self.error_count = 0
+
+    def is_stale(self) -> bool:
+        return self.fetched_at is None or time.monotonic() - self.fetched_at > self.ttl
+
+    def next_refresh_delay(self) -> float:
+        # Jittered so providers registered together, and processes started together, don't all call out at once
+        return self.refresh_interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class ContextScheduler:
+    """
+    Refreshes every context provider in the process from one scheduler thread and a small pool of fetch threads,
+    sharing a pooled requests.Session between them.
+
+    Providers are registered by name, so bots asking for the same provider share it rather than each polling the
+    service. Reads never wait on a fetch: a value older than its ttl is still returned while a refresh is started in
+    the background.
+    """
+
+    _shared: Optional['ContextScheduler'] = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, max_workers: int = 4, request_timeout: float = 10.0):
+        """
+        :param max_workers: The most fetches run at once.
+        :param request_timeout: Seconds fetches should pass as the timeout of their session requests. A request that
+            hangs without one holds a fetch thread, and its provider is never refreshed again.
+        """
+        self.request_timeout = request_timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._condition = threading.Condition()
+        self._providers: Dict[str, ContextProvider] = {}
+        # (due time, sequence number, provider name), the sequence number keeps entries with equal times ordered
+        self._schedule: List[Tuple[float, int, str]] = []
+        self._sequence = 0
+        self._stopped = False
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='context-provider')
+        self._scheduler_thread = threading.Thread(target=self._run, name='context-scheduler', daemon=True)
+        self._scheduler_thread.start()
+
+    @classmethod
+    def shared(cls) -> 'ContextScheduler':
+        """The scheduler shared by everything in the process"""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def register(self, name: str, fetch: Callable[[], Any], refresh_interval: float, ttl: float = None,
+                 jitter: float = 0.1) -> ContextProvider:
+        """
+        Register a provider and fetch its first value in the background. If a provider with this name is already
+        registered, that one is returned and fetch is ignored.
+
+        :param name: Identifies what's fetched, e.g. 'weather:York,GB'.
+        :param fetch: Returns the current value, called on a fetch thread. It should raise if the value can't be
+            fetched, so the last good value is kept.
+        :param refresh_interval: Seconds between refreshes.
+        :param ttl: Seconds before a value is stale and reading it starts a refresh, twice refresh_interval if None.
+        :param jitter: The fraction each refresh interval is randomly lengthened or shortened by.
+        """
+        with self._condition:
+            provider = self._providers.get(name)
+            if provider is None:
+                provider = ContextProvider(name, fetch, refresh_interval,
+                                           ttl if ttl is not None else refresh_interval * 2, jitter)
+                self._providers[name] = provider
+                self._schedule_refresh(provider, 0)
+            return provider
+
+    def get(self, name: str, default: Any = None) -> Any:
+        """The provider's latest value, or default if it has none yet or isn't registered"""
+        with self._condition:
+            provider = self._providers.get(name)
+            if provider is None:
+                return default
+            if provider.is_stale() and not provider.refreshing and provider.due > time.monotonic():
+                # Stale while revalidate, the refresh runs in the background and this read gets the old value
+                self._schedule_refresh(provider, 0)
+            return provider.value if provider.fetched_at is not None else default
+
+    def refresh(self, name: str):
+        """Refresh a provider now, in the background"""
+        with self._condition:
+            provider = self._providers.get(name)
+            if provider is not None:
+                self._schedule_refresh(provider, 0)
+
+    def wait_for(self, name: str, timeout: float = None) -> bool:
+        """Wait for a provider's first value, returning whether it arrived"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                provider = self._providers.get(name)
+                if provider is not None and provider.fetched_at is not None:
+                    return True
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+
+    def stats(self) -> Dict[str, Dict]:
+        with self._condition:
+            return {name: {'fetches': provider.fetch_count, 'errors': provider.error_count,
+                           'age': None if provider.fetched_at is None else time.monotonic() - provider.fetched_at}
+                    for name, provider in self._providers.items()}
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._scheduler_thread.join()
+        self._executor.shutdown(wait=False)
+        self.session.close()
+
+    def _schedule_refresh(self, provider: ContextProvider, delay: float):
+        self._sequence += 1
+        provider.scheduled = self._sequence
+        provider.due = time.monotonic() + delay
+        heapq.heappush(self._schedule, (provider.due, self._sequence, provider.name))
+        self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    if self._schedule and self._schedule[0][0] <= time.monotonic():
+                        break
+                    self._condition.wait(self._schedule[0][0] - time.monotonic() if self._schedule else None)
+                if self._stopped:
+                    return
+                _, sequence, name = heapq.heappop(self._schedule)
+                provider = self._providers[name]
+                # A refresh asked for while one is running is covered by the one running, which schedules the next
+                if sequence != provider.scheduled or provider.refreshing:
+                    continue
+                provider.refreshing = True
+            self._executor.submit(self._refresh, provider)
+
+    def _refresh(self, provider: ContextProvider):
+        try:
+            value = provider.fetch()
+        except Exception as e:
+            print(f"ERROR refreshing {provider.name}: {type(e)} {e}")
+            with self._condition:
+                provider.error_count += 1
+                provider.refreshing = False
+                # The last good value is kept, and retried sooner than a normal refresh
+                self._schedule_refresh(provider, min(provider.next_refresh_delay(), 60))
+            return
+
+        with self._condition:
+            provider.value = value
+            provider.fetched_at = time.monotonic()
+            provider.fetch_count += 1
+            provider.refreshing = False
+            self._schedule_refresh(provider, provider.next_refresh_delay())
+            # Also wakes wait_for
+            self._condition.notify_all()
+
+
+class GeocodeCache:
+    """Place name to coordinate lookups, kept in a JSON file so they're only ever made once"""
+
+    def __init__(self, path: str = DEFAULT_GEOCODE_CACHE):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as cache_file:
+                self._coordinates: Dict[str, List[float]] = json.load(cache_file)
+        except (OSError, ValueError):
+            self._coordinates = {}
+
+    def get(self, place: str) -> Optional[Tuple[float, float]]:
+        with self._lock:
+            coordinates = self._coordinates.get(place.strip().lower())
+        return tuple(coordinates) if coordinates is not None else None
+
+    def set(self, place: str, lat: float, lon: float):
+        with self._lock:
+            self._coordinates[place.strip().lower()] = [lat, lon]
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Written whole and renamed into place, so a crash can't leave a half written file
+            temp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w') as cache_file:
+                json.dump(self._coordinates, cache_file, indent=1)
+            os.replace(temp_path, self.path)
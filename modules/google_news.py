@@ -1,30 +1,28 @@
-import threading
-import time
-
-import requests
+from modules.context_providers import ContextScheduler
 
 
 class GoogleNews:
 
-    def __init__(self, api_key: str, query: str=None, page_size: int=10, language: str='en', news_update_interval: int=60):
+    def __init__(self, api_key: str, query: str=None, page_size: int=10, language: str='en', news_update_interval: int=60,
+                 context: ContextScheduler = None):
         self.api_key = api_key
         self.query = query
         self.language = language
         self.page_size = page_size
-        self.current_news = None
         self.news_update_interval = news_update_interval * 60
+        self.context = context if context is not None else ContextScheduler.shared()
+        self.provider_name = f'news:{language}:{query}'
+
+    @property
+    def current_news(self):
+        return self.context.get(self.provider_name)
 
     def get_news(self):
         return self.current_news
 
-    def update_news(self):
-        while True:
-            self.current_news = self.fetch_news()
-            time.sleep(self.news_update_interval)
-
     def start_news_updater(self):
-        update_thread = threading.Thread(target=self.update_news, daemon=True)
-        update_thread.start()
+        # Refreshed by the shared scheduler, along with every other poller asking for the same news
+        self.context.register(self.provider_name, self.fetch_news, self.news_update_interval)
 
     def fetch_news(self):
         base_url = "https://newsapi.org/v2/everything"
@@ -35,12 +33,7 @@ class GoogleNews:
             'apiKey': self.api_key
         }
 
-        response = requests.get(base_url, params=params)
-
-        if response.status_code == 200:
-            data = response.json()
-            articles = data['articles']
-            return articles
-        else:
-            print(f"Error fetching news: {response.status_code}")
-            return None
+        response = self.context.session.get(base_url, params=params, timeout=self.context.request_timeout)
+        # Raised so the scheduler keeps the last news rather than replacing it
+        response.raise_for_status()
+        return response.json()['articles']
@@ -0,0 +1,256 @@
+import asyncio
+import heapq
+import itertools
+import random
+import threading
+import time
+from typing import Dict, List, Optional
+
+import openai
+
+from token_counter import count_message_tokens
+
+# Lower numbers are served first when requests for a model are waiting on its limits
+PRIORITY_REPLY = 0
+PRIORITY_BACKGROUND = 1
+
+# Errors worth trying again, anything else is the request's fault and is raised straight away
+RETRYABLE_ERRORS = (openai.error.RateLimitError, openai.error.APIConnectionError,
+                    openai.error.ServiceUnavailableError, openai.error.Timeout, openai.error.TryAgain)
+
+
+class TokenBucket:
+    """Allows rate_per_minute of something, in bursts of up to capacity"""
+
+    def __init__(self, rate_per_minute: float, capacity: float = None):
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay_for(self, amount: float, now: float) -> float:
+        """Seconds until amount can be taken, 0 if it can be now"""
+        self._refill(now)
+        # More than the bucket holds waits for it to fill, it would never have enough otherwise
+        shortfall = min(amount, self.capacity) - self.level
+        return shortfall / self.rate if shortfall > 0 else 0.0
+
+    def take(self, amount: float, now: float):
+        # Can go negative, when a response used more tokens than estimated, which holds back the requests after it
+        self._refill(now)
+        self.level -= amount
+
+
+class _Waiter:
+    __slots__ = ('priority', 'sequence', 'wake')
+
+    def __init__(self, priority: int, sequence: int):
+        self.priority = priority
+        self.sequence = sequence
+        self.wake: Optional[asyncio.Future] = None
+
+    def __lt__(self, other: '_Waiter') -> bool:
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+
+class _ModelLimiter:
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.waiters: List[_Waiter] = []
+        # Set when the API says the limit has been hit, every request for the model holds off until then
+        self.blocked_until = 0.0
+        self.request_count = 0
+        self.retry_count = 0
+        self.rate_limited_count = 0
+        self.wait_count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def delay_for(self, tokens: int, now: float) -> float:
+        return max(self.blocked_until - now, self.requests.delay_for(1, now), self.tokens.delay_for(tokens, now))
+
+
+class OpenAIClient:
+    """
+    Makes chat completion requests for everything sharing an API key, keeping each model's requests and tokens per
+    minute under the configured limits rather than sending them and being rate limited.
+
+    Requests wait their turn per model, highest priority first, so the reply a user is waiting for goes ahead of
+    background work like the fast analysis. Rate limit and server errors are retried with jittered exponential backoff,
+    waiting as long as the API asks when it says. Works from any event loop, and from several at once.
+    """
+
+    _shared: Dict[str, 'OpenAIClient'] = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, requests_per_minute: float = 3500, tokens_per_minute: float = 90000,
+                 model_limits: Dict[str, Dict[str, float]] = None, max_retries: int = 5, base_delay: float = 1.0,
+                 max_delay: float = 60.0):
+        """
+        :param requests_per_minute: The requests allowed per minute for models without their own limits.
+        :param tokens_per_minute: The tokens allowed per minute for models without their own limits.
+        :param model_limits: Limits per model, e.g. {'gpt-4': {'requests_per_minute': 200, 'tokens_per_minute': 40000}}.
+        :param max_retries: How many times a failed request is retried before its error is raised.
+        :param base_delay: Seconds before the first retry, doubling each retry after.
+        :param max_delay: The most seconds to wait before a retry.
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.model_limits = model_limits or {}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._limiters: Dict[str, _ModelLimiter] = {}
+        self._sequence = itertools.count()
+
+    @classmethod
+    def from_config(cls, config) -> 'OpenAIClient':
+        """
+        The client for the config's API key, shared by everything in the process using that key as its limits are.
+
+        Limits are read from the [openai] section, requests_per_minute and tokens_per_minute for every model, and
+        requests_per_minute.<model> and tokens_per_minute.<model> for a particular one.
+        """
+        section = config['openai']
+        model_limits = {}
+        for option in section:
+            for limit in ('requests_per_minute', 'tokens_per_minute'):
+                if option.startswith(f'{limit}.'):
+                    model_limits.setdefault(option[len(limit) + 1:], {})[limit] = section.getfloat(option)
+        with cls._shared_lock:
+            client = cls._shared.get(section['api_key'])
+            if client is None:
+                client = cls(requests_per_minute=section.getfloat('requests_per_minute', fallback=3500),
+                             tokens_per_minute=section.getfloat('tokens_per_minute', fallback=90000),
+                             model_limits=model_limits,
+                             max_retries=section.getint('max_retries', fallback=5),
+                             max_delay=section.getfloat('max_retry_delay', fallback=60.0))
+                cls._shared[section['api_key']] = client
+            return client
+
+    def _limiter(self, model: str) -> _ModelLimiter:
+        limiter = self._limiters.get(model)
+        if limiter is None:
+            limits = self.model_limits.get(model, {})
+            limiter = _ModelLimiter(limits.get('requests_per_minute', self.requests_per_minute),
+                                    limits.get('tokens_per_minute', self.tokens_per_minute))
+            self._limiters[model] = limiter
+        return limiter
+
+    async def chat_completion(self, model: str, messages: List[dict], priority: int = PRIORITY_REPLY, **kwargs):
+        """
+        openai.ChatCompletion.acreate, once the model's limits allow it.
+
+        :param priority: PRIORITY_REPLY for a reply someone is waiting on, PRIORITY_BACKGROUND for work that can wait.
+        :raises openai.error.OpenAIError: If the request fails and can't be retried, or is still failing after
+            max_retries retries.
+        """
+        estimated_tokens = count_message_tokens(messages)
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(model, estimated_tokens, priority)
+            try:
+                response = await openai.ChatCompletion.acreate(model=model, messages=messages, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self._retry_delay(e, attempt)
+                print(f"OpenAI {model} request failed, retrying in {delay:.1f}s: {type(e)} {e}")
+                with self._lock:
+                    limiter = self._limiter(model)
+                    limiter.retry_count += 1
+                    if isinstance(e, openai.error.RateLimitError):
+                        # Another request now would only be rate limited too
+                        limiter.rate_limited_count += 1
+                        limiter.blocked_until = max(limiter.blocked_until, time.monotonic() + delay)
+                await asyncio.sleep(delay)
+                continue
+
+            usage = getattr(response, 'usage', None)
+            used_tokens = getattr(usage, 'total_tokens', None)
+            if isinstance(used_tokens, int):
+                # The estimate only covered the prompt, charge for what was actually used
+                with self._lock:
+                    self._limiter(model).tokens.take(used_tokens - estimated_tokens, time.monotonic())
+            return response
+
+    def _retry_delay(self, error: Exception, attempt: int) -> float:
+        headers = getattr(error, 'headers', None) or {}
+        for header, scale in (('retry-after-ms', 0.001), ('retry-after', 1)):
+            try:
+                return min(float(headers[header]) * scale, self.max_delay)
+            except (KeyError, TypeError, ValueError):
+                pass
+        # Jittered, so requests that failed together don't all retry together
+        return random.uniform(0.5, 1.0) * min(self.base_delay * 2 ** attempt, self.max_delay)
+
+    async def _acquire(self, model: str, tokens: int, priority: int):
+        waiter = _Waiter(priority, next(self._sequence))
+        begin_time = time.monotonic()
+        with self._lock:
+            limiter = self._limiter(model)
+            heapq.heappush(limiter.waiters, waiter)
+        try:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    if limiter.waiters[0] is waiter:
+                        delay = limiter.delay_for(tokens, now)
+                        if delay <= 0:
+                            limiter.requests.take(1, now)
+                            limiter.tokens.take(tokens, now)
+                            heapq.heappop(limiter.waiters)
+                            limiter.request_count += 1
+                            wait = now - begin_time
+                            if wait > 0:
+                                limiter.wait_count += 1
+                                limiter.total_wait += wait
+                                limiter.max_wait = max(limiter.max_wait, wait)
+                            self._wake_next(limiter)
+                            return
+                        wake = None
+                    else:
+                        # Only the first waiter watches the clock, the rest wait to be first
+                        delay = None
+                        wake = waiter.wake = asyncio.get_running_loop().create_future()
+                if wake is None:
+                    await asyncio.sleep(delay)
+                else:
+                    await wake
+        except BaseException:
+            with self._lock:
+                if waiter in limiter.waiters:
+                    limiter.waiters.remove(waiter)
+                    heapq.heapify(limiter.waiters)
+                    self._wake_next(limiter)
+            raise
+
+    @staticmethod
+    def _wake_next(limiter: _ModelLimiter):
+        if not limiter.waiters:
+            return
+        wake = limiter.waiters[0].wake
+        if wake is not None:
+            # The waiter may be on another thread's event loop
+            wake.get_loop().call_soon_threadsafe(lambda: wake.done() or wake.set_result(None))
+
+    def queue_depth(self, model: str = None) -> int:
+        """How many requests are waiting on a model's limits, or on every model's if None"""
+        with self._lock:
+            if model is not None:
+                limiter = self._limiters.get(model)
+                return len(limiter.waiters) if limiter is not None else 0
+            return sum(len(limiter.waiters) for limiter in self._limiters.values())
+
+    def stats(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {model: {'queued': len(limiter.waiters), 'requests': limiter.request_count,
+                            'retries': limiter.retry_count, 'rate_limited': limiter.rate_limited_count,
+                            'waited': limiter.wait_count, 'max_wait': limiter.max_wait,
+                            'mean_wait': limiter.total_wait / limiter.request_count if limiter.request_count else 0.0}
+                    for model, limiter in self._limiters.items()}
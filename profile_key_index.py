@@ -0,0 +1,92 @@
+import threading
+from collections import Counter
+from typing import Dict, Iterable, List, Set, Tuple
+
+from fuzzywuzzy import process, utils
+
+
+def _trigrams(text: str) -> Set[str]:
+    # Padded so words and short keys still have trigrams
+    padded = f'  {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class ProfileKeyIndex:
+    """
+    Character trigram index over a profile's keys, so a fuzzy lookup only scores the keys that share the most
+    trigrams with it rather than every key.
+
+    Keys are compared as fuzzywuzzy compares them, lowercased with punctuation removed.
+    """
+
+    def __init__(self, keys: Iterable[str] = (), max_candidates: int = 50):
+        """
+        :param keys: The keys to start with.
+        :param max_candidates: The most keys scored per lookup, profiles with no more keys than this have every key
+            scored.
+        """
+        self.max_candidates = max_candidates
+        self._lock = threading.Lock()
+        self._keys: Set[str] = set()
+        self._keys_by_processed: Dict[str, Set[str]] = {}
+        self._keys_by_trigram: Dict[str, Set[str]] = {}
+        for key in keys:
+            self.add(key)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._keys
+
+    def add(self, key: str):
+        with self._lock:
+            if key in self._keys:
+                return
+            self._keys.add(key)
+            processed = utils.full_process(key)
+            self._keys_by_processed.setdefault(processed, set()).add(key)
+            for trigram in _trigrams(processed):
+                self._keys_by_trigram.setdefault(trigram, set()).add(key)
+
+    def remove(self, key: str):
+        with self._lock:
+            if key not in self._keys:
+                return
+            self._keys.remove(key)
+            processed = utils.full_process(key)
+            self._discard(self._keys_by_processed, processed, key)
+            for trigram in _trigrams(processed):
+                self._discard(self._keys_by_trigram, trigram, key)
+
+    @staticmethod
+    def _discard(keys_by: Dict[str, Set[str]], index_key: str, key: str):
+        keys = keys_by.get(index_key)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del keys_by[index_key]
+
+    def candidates(self, query: str) -> List[str]:
+        """The keys worth scoring against query, those sharing the most trigrams with it"""
+        with self._lock:
+            if len(self._keys) <= self.max_candidates:
+                return sorted(self._keys)
+            shared_trigrams = Counter()
+            for trigram in _trigrams(utils.full_process(query)):
+                shared_trigrams.update(self._keys_by_trigram.get(trigram, ()))
+        ranked = sorted(shared_trigrams.items(), key=lambda item: (-item[1], item[0]))
+        return [key for key, _ in ranked[:self.max_candidates]]
+
+    def extract(self, query: str, limit: int = 5) -> List[Tuple[str, int]]:
+        """
+        The closest keys to query, as fuzzywuzzy's process.extract would find them among every key.
+
+        :return: Up to limit (key, score) pairs, best first.
+        """
+        with self._lock:
+            exact_keys = self._keys_by_processed.get(utils.full_process(query))
+            if exact_keys:
+                # Nothing scores higher than an exact match
+                return [(key, 100) for key in sorted(exact_keys)][:limit]
+        return process.extract(query, self.candidates(query), limit=limit)
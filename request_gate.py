@@ -0,0 +1,128 @@
+import math
+import threading
+import time
+from collections import Counter
+from typing import Dict, Hashable
+
+
+class Overloaded(Exception):
+    """Raised when a request is turned away rather than queued, retry_after is how many seconds to wait"""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class GateSlot:
+    """A request's place in the gate, given back with release() or by leaving a with block"""
+
+    def __init__(self, gate: 'RequestGate', user_key: Hashable):
+        self.gate = gate
+        self.user_key = user_key
+        self.started = time.monotonic()
+        self._released = False
+
+    def release(self):
+        # Streaming responses release from the response's close, which can happen more than once
+        if not self._released:
+            self._released = True
+            self.gate._release(self)
+
+    def __enter__(self) -> 'GateSlot':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class RequestGate:
+    """
+    Limits how many chats are handled at once, how many more can wait for a turn, and how many one user can have
+    going, so overload gets a quick answer to come back later instead of a growing pile of waiting requests.
+    """
+
+    def __init__(self, max_concurrent: int = 8, max_queued: int = 16, per_user_limit: int = 2,
+                 queue_timeout: float = 30.0):
+        """
+        :param max_concurrent: The most requests handled at once.
+        :param max_queued: The most requests waiting for a turn, any more are turned away.
+        :param per_user_limit: The most requests one user can have handled or waiting at once.
+        :param queue_timeout: The most seconds a request waits for a turn before it's turned away.
+        """
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.per_user_limit = per_user_limit
+        self.queue_timeout = queue_timeout
+        self._condition = threading.Condition()
+        self._active = 0
+        self._queued = 0
+        self._by_user = Counter()
+        # A moving average of how long requests take, for telling turned away requests when to come back
+        self._average_duration = 5.0
+        self.admitted_count = 0
+        self.rejected_count = 0
+
+    def acquire(self, user_key: Hashable) -> GateSlot:
+        """
+        Wait for a turn to handle a request.
+
+        :param user_key: Identifies who the request is for, for the per-user limit.
+        :raises Overloaded: If the user is at their limit, the queue is full or the wait timed out.
+        """
+        with self._condition:
+            if self._by_user[user_key] >= self.per_user_limit:
+                raise self._reject("Too many requests in progress for this user")
+            if self._active >= self.max_concurrent or self._queued:
+                if self._queued >= self.max_queued:
+                    raise self._reject("Server is busy")
+                self._queued += 1
+                self._by_user[user_key] += 1
+                deadline = time.monotonic() + self.queue_timeout
+                try:
+                    while self._active >= self.max_concurrent:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._remove_user(user_key)
+                            raise self._reject("Timed out waiting for a turn")
+                        self._condition.wait(remaining)
+                finally:
+                    self._queued -= 1
+            else:
+                self._by_user[user_key] += 1
+            self._active += 1
+            self.admitted_count += 1
+            return GateSlot(self, user_key)
+
+    def _release(self, slot: GateSlot):
+        duration = time.monotonic() - slot.started
+        with self._condition:
+            self._active -= 1
+            self._remove_user(slot.user_key)
+            self._average_duration += (duration - self._average_duration) * 0.1
+            self._condition.notify_all()
+
+    def _remove_user(self, user_key: Hashable):
+        self._by_user[user_key] -= 1
+        if self._by_user[user_key] <= 0:
+            del self._by_user[user_key]
+
+    def _reject(self, reason: str) -> Overloaded:
+        """Called holding the lock"""
+        self.rejected_count += 1
+        return Overloaded(reason, self._retry_after())
+
+    def _retry_after(self) -> int:
+        # Roughly when the queue ahead will have been worked through
+        return max(1, math.ceil(self._average_duration * (self._queued + 1) / self.max_concurrent))
+
+    def is_saturated(self) -> bool:
+        """Whether a new request would be turned away"""
+        with self._condition:
+            return self._active >= self.max_concurrent and self._queued >= self.max_queued
+
+    def stats(self) -> Dict:
+        with self._condition:
+            return {'active': self._active, 'queued': self._queued, 'max_concurrent': self.max_concurrent,
+                    'max_queued': self.max_queued, 'admitted': self.admitted_count, 'rejected': self.rejected_count,
+                    'average_duration': self._average_duration}
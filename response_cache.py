@@ -0,0 +1,204 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+
+def _normalise(text: str) -> str:
+    return re.sub(r'\s+', ' ', text).strip().lower()
+
+
+def _normalise_user(user_id: Optional[str]) -> str:
+    return (user_id or '').strip().lower()
+
+
+class _CachedResponse:
+    __slots__ = ('key', 'user_id', 'response', 'embedding', 'created')
+
+    def __init__(self, key: str, user_id: str, response: str, embedding: Optional[np.ndarray], created: float):
+        self.key = key
+        self.user_id = user_id
+        self.response = response
+        self.embedding = embedding
+        self.created = created
+
+
+class _ConversationCache:
+    def __init__(self):
+        # By (user, normalised input)
+        self.by_key: Dict[Tuple[str, str], _CachedResponse] = {}
+        self.entries: List[_CachedResponse] = []
+        # The entries' unit embeddings stacked for one matrix product per lookup, rebuilt after a change
+        self.matrix: Optional[np.ndarray] = None
+        self.matrix_entries: List[_CachedResponse] = []
+
+    def remove(self, entries: List[_CachedResponse]):
+        removed = set(map(id, entries))
+        self.entries = [entry for entry in self.entries if id(entry) not in removed]
+        self.by_key = {(entry.user_id, entry.key): entry for entry in self.entries}
+        self.matrix = None
+
+    def similarity_matrix(self):
+        if self.matrix is None:
+            self.matrix_entries = [entry for entry in self.entries if entry.embedding is not None]
+            self.matrix = np.vstack([entry.embedding for entry in self.matrix_entries]) if self.matrix_entries \
+                else np.zeros((0, 0), dtype=np.float32)
+        return self.matrix, self.matrix_entries
+
+
+class ResponseCache:
+    """
+    Replies to recent inputs by conversation, so an input the conversation has just had answered, or one close enough
+    to it, gets the same reply without asking the model again.
+
+    Inputs are matched exactly first, ignoring case and whitespace, then by the cosine similarity of their embeddings.
+    A reply only matches inputs from the user it was made for, and is dropped once older than ttl or when anything in
+    that user's profile changes, as the reply may no longer be right.
+    """
+
+    def __init__(self, similarity_threshold: float = 0.97, ttl: float = 3600, max_entries: int = 256,
+                 max_conversations: int = 1000):
+        """
+        :param similarity_threshold: The lowest cosine similarity between embeddings counted as the same input.
+        :param ttl: Seconds a reply is reused for.
+        :param max_entries: The most replies kept per conversation, the oldest are dropped first.
+        :param max_conversations: The most conversations replies are kept for, the least recently used are dropped
+            first.
+        """
+        self.similarity_threshold = similarity_threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_conversations = max_conversations
+        self._lock = threading.Lock()
+        self._conversations: OrderedDict[Hashable, _ConversationCache] = OrderedDict()
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get_exact(self, conversation_id: Hashable, user_id: str, user_input: str) -> Optional[str]:
+        """The reply to this exact input, without counting a miss as get would"""
+        with self._lock:
+            conversation = self._conversation(conversation_id)
+            if conversation is None:
+                return None
+            entry = conversation.by_key.get((_normalise_user(user_id), _normalise(user_input)))
+            if entry is None:
+                return None
+            self.exact_hits += 1
+            return entry.response
+
+    def get(self, conversation_id: Hashable, user_id: str, user_input: str,
+            embedding: np.ndarray = None) -> Optional[str]:
+        """
+        The reply to this input, or to one similar enough to it.
+
+        :param embedding: The input's embedding, only exact matches are looked for without one.
+        :return: The cached reply, or None on a miss.
+        """
+        response = self.get_exact(conversation_id, user_id, user_input)
+        if response is not None:
+            return response
+
+        unit_embedding = self._unit(embedding)
+        with self._lock:
+            conversation = self._conversation(conversation_id)
+            if conversation is not None and unit_embedding is not None:
+                matrix, entries = conversation.similarity_matrix()
+                if len(entries):
+                    similarities = matrix @ unit_embedding
+                    user_id = _normalise_user(user_id)
+                    for i in np.argsort(-similarities):
+                        if similarities[i] < self.similarity_threshold:
+                            break
+                        if entries[i].user_id == user_id:
+                            self.similar_hits += 1
+                            return entries[i].response
+            self.misses += 1
+            return None
+
+    def put(self, conversation_id: Hashable, user_id: str, user_input: str, response: str,
+            embedding: np.ndarray = None):
+        """Keep the reply to an input, replacing any earlier reply to it"""
+        entry = _CachedResponse(_normalise(user_input), _normalise_user(user_id), response, self._unit(embedding),
+                                time.monotonic())
+        with self._lock:
+            conversation = self._conversations.get(conversation_id)
+            if conversation is None:
+                conversation = self._conversations[conversation_id] = _ConversationCache()
+                while len(self._conversations) > self.max_conversations:
+                    self._conversations.popitem(last=False)
+            self._conversations.move_to_end(conversation_id)
+
+            previous = conversation.by_key.get((entry.user_id, entry.key))
+            stale = [previous] if previous is not None else []
+            remaining = [cached for cached in conversation.entries if cached is not previous]
+            stale += remaining[:max(0, len(remaining) + 1 - self.max_entries)]
+            if stale:
+                conversation.remove(stale)
+            conversation.entries.append(entry)
+            conversation.by_key[entry.user_id, entry.key] = entry
+            conversation.matrix = None
+
+    def invalidate_user(self, user_id: str) -> int:
+        """Drop every reply made for a user, in every conversation, returning how many were dropped"""
+        user_id = _normalise_user(user_id)
+        return self._invalidate(lambda entry: entry.user_id == user_id)
+
+    def invalidate_conversation(self, conversation_id: Hashable) -> int:
+        with self._lock:
+            conversation = self._conversations.pop(conversation_id, None)
+            dropped = len(conversation.entries) if conversation is not None else 0
+            self.invalidations += dropped
+            return dropped
+
+    def _invalidate(self, predicate: Callable[[_CachedResponse], bool]) -> int:
+        dropped = 0
+        with self._lock:
+            for conversation in self._conversations.values():
+                stale = [entry for entry in conversation.entries if predicate(entry)]
+                if stale:
+                    conversation.remove(stale)
+                    dropped += len(stale)
+            self.invalidations += dropped
+        return dropped
+
+    def _conversation(self, conversation_id: Hashable) -> Optional[_ConversationCache]:
+        """The conversation's cache with expired replies dropped, called holding the lock"""
+        conversation = self._conversations.get(conversation_id)
+        if conversation is None:
+            return None
+        self._conversations.move_to_end(conversation_id)
+        # Entries are in the order they were added, so the expired ones are at the front
+        expires_before = time.monotonic() - self.ttl
+        expired = 0
+        while expired < len(conversation.entries) and conversation.entries[expired].created < expires_before:
+            expired += 1
+        if expired:
+            conversation.remove(conversation.entries[:expired])
+        return conversation
+
+    @staticmethod
+    def _unit(embedding: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        if embedding is None:
+            return None
+        norm = np.linalg.norm(embedding)
+        # Inputs with no known words embed to zero, they can only match exactly
+        if norm == 0:
+            return None
+        return (np.asarray(embedding, dtype=np.float32) / norm).astype(np.float32)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(conversation.entries) for conversation in self._conversations.values())
+
+    def stats(self) -> Dict:
+        with self._lock:
+            hits = self.exact_hits + self.similar_hits
+            lookups = hits + self.misses
+            return {'entries': sum(len(conversation.entries) for conversation in self._conversations.values()),
+                    'exact_hits': self.exact_hits, 'similar_hits': self.similar_hits, 'misses': self.misses,
+                    'invalidations': self.invalidations, 'hit_rate': hits / lookups if lookups else 0.0}
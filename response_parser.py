@@ -0,0 +1,135 @@
+import re
+from typing import Optional, Tuple
+
+# The lines the model is asked to end its reply with, after the r: body
+TRAILER_PATTERNS = {
+    'importance': re.compile(r'\s*[Ii]:\s*(\d\.?\d*)'),
+    'memory_summary': re.compile(r'\s*[Ss]ummary:\s*(.+)'),
+    'content_words': re.compile(r'\s*[Cc]:\s*(.+)'),
+    'conversation_history_condensed': re.compile(r'\s*[Cc][Hh]:\s*(.+)'),
+}
+TRAILER_PREFIXES = ('summary:', 'i:', 'c:', 'ch:')
+
+
+class ParsedResponse:
+    """A reply split into the body shown to the user and the trailer saved as a memory"""
+
+    def __init__(self, body: str, memory_summary: str, importance: float, content_words: Optional[str],
+                 conversation_history_condensed: Optional[str]):
+        self.body = body
+        self.memory_summary = memory_summary
+        self.importance = importance
+        self.content_words = content_words
+        self.conversation_history_condensed = conversation_history_condensed
+
+
+def parse_response(response: str, importance: float = 1.0) -> ParsedResponse:
+    """
+    Split a reply in the requested (r, summary, i, c) format into its body and trailer.
+
+    :param response: The reply's full text.
+    :param importance: The importance if the reply doesn't give one.
+    """
+    assistant_response = response.split('\n')
+    conversation_history_condensed = None
+    content_words = None
+    memory_summary = ""
+    summary_begins_at = 0
+    if len(assistant_response) > 1:
+        # Where the summary line would be, if it isn't labelled
+        memory_summary = assistant_response[-3] if len(assistant_response) >= 3 else assistant_response[0]
+        # Handles odd issues with extra newlines
+        for line_num in range(1, min(7, len(assistant_response) + 1)):
+            if match := TRAILER_PATTERNS['importance'].match(assistant_response[-line_num]):
+                importance = float(match.group(1))
+                summary_begins_at = line_num
+            elif match := TRAILER_PATTERNS['memory_summary'].match(assistant_response[-line_num]):
+                memory_summary = match.group(1)
+                summary_begins_at = line_num
+            elif match := TRAILER_PATTERNS['content_words'].match(assistant_response[-line_num]):
+                content_words = match.group(1)
+                summary_begins_at = line_num
+            elif match := TRAILER_PATTERNS['conversation_history_condensed'].match(assistant_response[-line_num]):
+                conversation_history_condensed = match.group(1)
+                summary_begins_at = line_num
+    else:
+        memory_summary = assistant_response[-1]
+
+    body = '\n'.join(assistant_response[:-summary_begins_at])
+    if body.startswith('r:') or body.startswith('R:'):
+        body = body[2:].strip()
+    else:
+        body = '\n'.join(assistant_response)
+    return ParsedResponse(body, memory_summary, importance, content_words, conversation_history_condensed)
+
+
+def _is_trailer_line(line: str) -> bool:
+    return any(pattern.match(line) for pattern in TRAILER_PATTERNS.values())
+
+
+def _may_become_trailer_line(partial_line: str) -> bool:
+    """Whether a line still being received could turn out to be a trailer line"""
+    start = partial_line.lstrip().lower()
+    return any(prefix.startswith(start) or start.startswith(prefix) for prefix in TRAILER_PREFIXES)
+
+
+class StreamingResponseParser:
+    """
+    Parses a reply as it streams in, giving back the body as it arrives while holding back anything that might be the
+    trailer. Once the stream ends the whole reply is parsed as parse_response would, and whatever of the body wasn't
+    given back yet is.
+    """
+
+    def __init__(self, importance: float = 1.0):
+        """
+        :param importance: The importance if the reply doesn't give one.
+        """
+        self.importance = importance
+        self.text = ''
+        self.streamed = ''
+        self._in_trailer = False
+
+    def feed(self, delta: str) -> str:
+        """Add the next piece of the reply, returning the body text that can be shown now"""
+        self.text += delta
+        if self._in_trailer:
+            return ''
+        body = self._streamable_body()
+        if not body.startswith(self.streamed):
+            return ''
+        new_text = body[len(self.streamed):]
+        self.streamed = body
+        return new_text
+
+    def finish(self) -> Tuple[str, ParsedResponse]:
+        """
+        Parse the whole reply.
+
+        :return: The rest of the body not yet returned by feed, and the parsed reply.
+        """
+        parsed = parse_response(self.text, self.importance)
+        if not parsed.body.startswith(self.streamed):
+            # Only when something that looked like the body turned out not to be, which the parse has the final say on
+            print("STREAMED BODY DIFFERS FROM PARSED BODY:", self.streamed, parsed.body)
+            return '', parsed
+        return parsed.body[len(self.streamed):], parsed
+
+    def _streamable_body(self) -> str:
+        text = self.text
+        if len(text) < 2:
+            # Not yet known whether it starts with r:
+            return ''
+        if text[:2] in ('r:', 'R:'):
+            text = text[2:].lstrip()
+
+        *lines, partial_line = text.split('\n')
+        body_lines = []
+        for line in lines:
+            if _is_trailer_line(line):
+                self._in_trailer = True
+                break
+            body_lines.append(line)
+        if not self._in_trailer and not _may_become_trailer_line(partial_line):
+            body_lines.append(partial_line)
+        # Trailing whitespace is held back, it's stripped if the trailer follows
+        return '\n'.join(body_lines).rstrip()
@@ -0,0 +1,47 @@
+import unittest
+
+from context_builder import ContextBuilder, prompt_token_budget
+from token_counter import MESSAGE_OVERHEAD_TOKENS, REPLY_PRIMING_TOKENS
+
+
+def message(content: str, role: str = 'assistant') -> dict:
+    return {'role': role, 'content': content}
+
+
+class TestContextBuilder(unittest.TestCase):
+
+    def test_required_sections_then_priorities(self):
+        # Every message is 10 tokens with its overhead
+        tokens = 10 - MESSAGE_OVERHEAD_TOKENS
+        context = ContextBuilder(REPLY_PRIMING_TOKENS + 60)
+        context.add_section('header', [message('system')], [tokens])
+        context.add_section('memories', [message('m1'), message('m2')], [tokens, tokens], priority=2)
+        context.add_section('dialogue', [message('d1'), message('d2'), message('d3')], [tokens] * 3, priority=1)
+        context.add_section('input', [message('input', 'user')], [tokens])
+
+        self.assertEqual([entry['content'] for entry in context.build()], ['system', 'm1', 'd1', 'd2', 'd3', 'input'])
+        self.assertEqual(context.token_usage(), {'header': 10, 'memories': 10, 'dialogue': 30, 'input': 10})
+
+    def test_newest_first_keeps_latest_dialogue_without_gaps(self):
+        context = ContextBuilder(1000)
+        context.add_section('dialogue', [message('old'), message('long'), message('new')], [10, 500, 10],
+                            priority=1, max_tokens=100, newest_first=True)
+        self.assertEqual([entry['content'] for entry in context.build()], ['new'])
+
+    def test_messages_that_dont_fit_skipped(self):
+        context = ContextBuilder(REPLY_PRIMING_TOKENS + 40)
+        context.add_section('memories', [message('small'), message('large'), message('small again')], [10, 100, 10],
+                            priority=1)
+        self.assertEqual([entry['content'] for entry in context.build()], ['small', 'small again'])
+
+
+class TestPromptTokenBudget(unittest.TestCase):
+
+    def test_budget_per_model(self):
+        self.assertEqual(prompt_token_budget('gpt-4', reply_tokens=1000), 7192)
+        self.assertEqual(prompt_token_budget('gpt-4-32k-0613', reply_tokens=1000), 31768)
+        self.assertEqual(prompt_token_budget('gpt-4', overrides={'gpt-4': 6000}), 6000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest.mock import MagicMock
+
+import requests
+
+from modules.context_providers import ContextScheduler, GeocodeCache
+from modules.google_news import GoogleNews
+
+
+class TestContextScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.context = ContextScheduler(max_workers=2)
+
+    def tearDown(self):
+        self.context.stop()
+
+    def test_providers_shared_by_name(self):
+        calls = []
+        self.context.register('weather:York,GB', lambda: calls.append(1) or 'Sunny', refresh_interval=3600)
+        self.context.register('weather:York,GB', lambda: 'Rainy', refresh_interval=3600)
+
+        self.assertTrue(self.context.wait_for('weather:York,GB', timeout=5))
+        self.assertEqual(self.context.get('weather:York,GB'), 'Sunny')
+        self.assertEqual(calls, [1])
+        self.assertEqual(self.context.get('weather:Leeds,GB', default='Unknown'), 'Unknown')
+
+    def test_stale_value_served_while_refreshing(self):
+        values = iter(['first', 'second'])
+        refreshed = threading.Event()
+
+        def fetch():
+            value = next(values)
+            if value == 'second':
+                refreshed.set()
+            return value
+
+        self.context.register('news', fetch, refresh_interval=3600, ttl=0)
+        self.context.wait_for('news', timeout=5)
+
+        self.assertEqual(self.context.get('news'), 'first')
+        self.assertTrue(refreshed.wait(5))
+
+    def test_failed_refresh_keeps_last_value(self):
+        failed = threading.Event()
+        results = iter(['Sunny'])
+
+        def fetch():
+            try:
+                return next(results)
+            except StopIteration:
+                failed.set()
+                raise ConnectionError("Service unavailable")
+
+        self.context.register('weather', fetch, refresh_interval=3600)
+        self.context.wait_for('weather', timeout=5)
+        self.context.refresh('weather')
+
+        self.assertTrue(failed.wait(5))
+        self.assertEqual(self.context.get('weather'), 'Sunny')
+        self.assertEqual(self.context.stats()['weather']['fetches'], 1)
+
+
+class TestGoogleNews(unittest.TestCase):
+
+    def test_fetch_raises_on_error_response(self):
+        context = MagicMock(request_timeout=5)
+        context.session.get.return_value.raise_for_status.side_effect = requests.HTTPError("500 Server Error")
+        news = GoogleNews('placeholder_key', query='weather', context=context)
+
+        with self.assertRaises(requests.HTTPError):
+            news.fetch_news()
+        self.assertEqual(context.session.get.call_args.kwargs['timeout'], 5)
+
+
+class TestGeocodeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'cache', 'geocode.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_persisted(self):
+        GeocodeCache(self.path).set('York,GB', 53.96, -1.08)
+        self.assertEqual(GeocodeCache(self.path).get('york,gb'), (53.96, -1.08))
+        self.assertIsNone(GeocodeCache(self.path).get('Leeds,GB'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+from unittest.mock import patch
+
+from conversation_session import ConversationSession, SessionManager
+
+
+class TestConversationSession(unittest.TestCase):
+
+    def test_recent_memories_deduplicated_and_bounded(self):
+        session = ConversationSession('channel', 'instruction', recent_memory_limit=3)
+        memories = [{'role': 'assistant', 'content': f'Memory: {i}'} for i in range(5)]
+        session.add_recent_memories(memories[:2], [])
+        recent = session.add_recent_memories(memories, [{'role': 'assistant', 'content': 'user/key=value'}])
+
+        self.assertEqual([memory['content'] for memory in recent],
+                         ['Memory: 2', 'Memory: 3', 'Memory: 4', 'user/key=value'])
+
+    def test_condensed_history_bounded(self):
+        session = ConversationSession('channel', 'instruction', condensed_history_limit=2)
+        for i in range(3):
+            session.add_condensed_history(f'summary {i}')
+        self.assertEqual(session.get_condensed_history(), ['summary 1', 'summary 2'])
+
+
+class TestSessionManager(unittest.TestCase):
+
+    def test_sessions_kept_apart(self):
+        sessions = SessionManager('instruction')
+        sessions.get('a').add_message('user', 'Hello')
+        self.assertIs(sessions.get('a'), sessions.get('a'))
+        self.assertEqual(len(sessions.get('a').messages), 2)
+        self.assertEqual(len(sessions.get('b').messages), 1)
+
+    def test_idle_sessions_evicted(self):
+        sessions = SessionManager('instruction', idle_timeout=60)
+        with patch('conversation_session.time.monotonic', return_value=0):
+            sessions.get('a')
+        with patch('conversation_session.time.monotonic', return_value=30):
+            sessions.get('b')
+        with patch('conversation_session.time.monotonic', return_value=70):
+            self.assertEqual(sessions.evict_idle(), 1)
+        self.assertNotIn('a', sessions)
+        self.assertIn('b', sessions)
+
+    def test_least_recently_used_evicted_past_max_sessions(self):
+        sessions = SessionManager('instruction', max_sessions=2)
+        sessions.get('a')
+        sessions.get('b')
+        sessions.get('a')
+        sessions.get('c')
+        self.assertEqual(len(sessions), 2)
+        self.assertNotIn('b', sessions)
+
+
+if __name__ == '__main__':
+    unittest.main()
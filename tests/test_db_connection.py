@@ -0,0 +1,73 @@
+import glob
+import os
+import tempfile
+import threading
+import unittest
+
+from sqlalchemy import text
+
+from db_connection import SQLiteDatabase
+from memory_database import Base, ProfileData
+
+
+class TestSQLiteDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_db_file = tempfile.mktemp()
+        self.db = SQLiteDatabase(self.temp_db_file)
+        self.db.create_all(Base.metadata)
+
+    def tearDown(self):
+        self.db.dispose()
+        for path in glob.glob(f'{self.temp_db_file}*'):
+            os.remove(path)
+
+    def test_wal_mode_and_read_only_readers(self):
+        with self.db.write_session() as session:
+            self.assertEqual(session.execute(text("PRAGMA journal_mode")).scalar(), 'wal')
+        with self.db.read_session() as session:
+            self.assertEqual(session.execute(text("PRAGMA query_only")).scalar(), 1)
+
+    def test_write_rolled_back_on_error(self):
+        with self.assertRaises(ValueError):
+            with self.db.write_session() as session:
+                session.add(ProfileData(key='name', value='Ada'))
+                session.flush()
+                raise ValueError()
+        with self.db.read_session() as session:
+            self.assertEqual(session.query(ProfileData).count(), 0)
+
+    def test_reads_not_blocked_by_open_write(self):
+        write_open = threading.Event()
+        finish_write = threading.Event()
+
+        def write():
+            with self.db.write_session() as session:
+                session.add(ProfileData(key='name', value='Ada'))
+                session.flush()
+                write_open.set()
+                finish_write.wait(5)
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        write_open.wait(5)
+        # Sees the last commit, not the write in progress, without waiting for it
+        with self.db.read_session() as session:
+            self.assertEqual(session.query(ProfileData).count(), 0)
+        finish_write.set()
+        writer.join()
+
+        with self.db.read_session() as session:
+            self.assertEqual(session.query(ProfileData.value).scalar(), 'Ada')
+
+    def test_in_memory_database_shared_by_readers(self):
+        db = SQLiteDatabase(':memory:')
+        db.create_all(Base.metadata)
+        with db.write_session() as session:
+            session.add(ProfileData(key='name', value='Ada'))
+        with db.read_session() as session:
+            self.assertEqual(session.query(ProfileData.value).scalar(), 'Ada')
+
+
+if __name__ == '__main__':
+    unittest.main()
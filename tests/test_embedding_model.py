@@ -0,0 +1,89 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+from gensim.models import KeyedVectors
+
+from embedding_model import build_compact_model, load_word2vec, retrieval_overlap, average_word_vectors, \
+    batch_average_word_vectors, EmbeddingCache
+
+
+class TestEmbeddingModel(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.model = KeyedVectors(4)
+        self.model.add_vectors(['hello', 'world'], np.eye(2, 4, dtype=np.float32))
+
+    @patch('gensim.downloader.load')
+    def test_model_converted_once_and_memory_mapped(self, mock_api_load):
+        mock_api_load.return_value = self.model
+
+        word2vec = load_word2vec('test-model', cache_dir=self.cache_dir)
+        self.assertIsInstance(word2vec.vectors, np.memmap)
+        np.testing.assert_array_equal(word2vec['world'], [0, 1, 0, 0])
+        self.assertTrue(os.path.exists(os.path.join(self.cache_dir, 'test-model.kv')))
+
+        self.assertIs(load_word2vec('test-model', cache_dir=self.cache_dir), word2vec)
+        mock_api_load.assert_called_once()
+
+    def test_compact_model_keeps_top_lowercase_vocabulary(self):
+        model = KeyedVectors(4)
+        model.add_vectors(['the', 'The', 'new_york', 'cat', 'dog', 'fish'],
+                          np.arange(24, dtype=np.float32).reshape(6, 4))
+
+        compact_model = build_compact_model(model, os.path.join(self.cache_dir, 'compact'), top_n=2)
+        self.assertEqual(compact_model.index_to_key, ['the', 'cat'])
+        self.assertNotIn('dog', compact_model)
+        np.testing.assert_array_equal(compact_model['cat'], model['cat'])
+        np.testing.assert_array_equal(average_word_vectors(compact_model, ['the', 'cat', 'dog']),
+                                      np.mean([model['the'], model['cat']], axis=0))
+
+    def test_compact_model_hash_buckets_and_float16(self):
+        model = KeyedVectors(4)
+        model.add_vectors(['the', 'cat', 'dog'], np.arange(12, dtype=np.float32).reshape(3, 4))
+
+        compact_model = build_compact_model(model, os.path.join(self.cache_dir, 'compact'), top_n=2, float16=True,
+                                            hash_buckets=1)
+        self.assertEqual(compact_model.vectors.dtype, np.float16)
+        self.assertIn('dog', compact_model)
+        np.testing.assert_array_equal(compact_model['dog'], model['dog'])
+        self.assertEqual(compact_model.name, 'word2vec-google-news-300-compact-2-f16-h1')
+
+    def test_batch_average_word_vectors_matches_single_text(self):
+        rng = np.random.default_rng(0)
+        model = KeyedVectors(300)
+        model.add_vectors([f'word{i}' for i in range(100)], rng.normal(size=(100, 300)).astype(np.float32))
+        word_lists = [[f'word{i}' for i in rng.integers(0, 120, size=length)] for length in range(40)]
+
+        embeddings = batch_average_word_vectors(model, word_lists)
+        self.assertEqual(embeddings.shape, (40, 300))
+        for embedding, words in zip(embeddings, word_lists):
+            np.testing.assert_array_equal(embedding, average_word_vectors(model, words))
+
+    def test_embedding_cache(self):
+        cache = EmbeddingCache(max_size=2)
+        generate = MagicMock(side_effect=lambda text: np.full(4, len(text), dtype=np.float32))
+
+        first = cache.get("Hello  there", generate)
+        self.assertIs(cache.get("hello there", generate), first)
+        self.assertFalse(first.flags.writeable)
+        cache.get("one", generate)
+        cache.get("two", generate)
+        cache.get("hello there", generate)
+
+        self.assertEqual(generate.call_count, 4)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 4)
+
+    def test_retrieval_overlap(self):
+        embeddings = np.random.default_rng(0).normal(size=(20, 4))
+        self.assertEqual(retrieval_overlap(embeddings, embeddings, k=5), 1.0)
+        self.assertLess(retrieval_overlap(embeddings, embeddings[::-1], k=5), 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,19 @@
+import asyncio
+import configparser
+import os
+import shutil
+import tempfile
+import threading
+import time
 import gensim.downloader as api
 import unittest
 from types import SimpleNamespace
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, AsyncMock, MagicMock
 
 import numpy as np
 
 from gpt_communication import GPTCommunication
+from response_cache import ResponseCache
 
 
 class TestGPTCommunication(unittest.TestCase):
@@ -31,8 +39,8 @@ class TestGPTCommunication(unittest.TestCase):
         self.db_file = ":memory:"
         self.gpt_comm = GPTCommunication(self.api_key, self.db_file)
 
-        # Mock the openai.ChatCompletion.create method to avoid actual API calls
-        self.patcher_openai_create = patch('openai.ChatCompletion.create')
+        # Mock the openai.ChatCompletion.acreate method to avoid actual API calls
+        self.patcher_openai_create = patch('openai.ChatCompletion.acreate', new_callable=AsyncMock)
         self.mock_openai_create = self.patcher_openai_create.start()
         self.mock_openai_create.return_value = {
             'choices': [
@@ -58,7 +66,7 @@ class TestGPTCommunication(unittest.TestCase):
         self.assertEqual(len(self.gpt_comm.messages), 1)
         self.assertIn("system", self.gpt_comm.messages[0]["role"])
 
-    @patch("openai.ChatCompletion.create")
+    @patch("openai.ChatCompletion.acreate", new_callable=AsyncMock)
     def test_send_message(self, mock_chat_completion):
         mock_chat_completion.return_value = SimpleNamespace(
             choices=[
@@ -80,5 +88,213 @@ class TestGPTCommunication(unittest.TestCase):
         self.assertEqual(messages[-1], {"role": "assistant", "content": "Hello! I am your assistant."})
 
 
+class TestGPTCommunicationAsync(unittest.IsolatedAsyncioTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.patcher_api_load = patch('gensim.downloader.load')
+        mocked_word2vec = MagicMock()
+        mocked_word2vec.vector_size = 300
+        mocked_word2vec.get_vector = MagicMock(side_effect=lambda _: np.zeros(300))
+        cls.patcher_api_load.start().return_value = mocked_word2vec
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.patcher_api_load.stop()
+
+    def setUp(self):
+        config = configparser.ConfigParser()
+        config.read_dict({
+            'default': {'assistant_type': 'helpful', 'name_of_user': 'User', 'name_of_agent': 'Agent'},
+            'openai': {'api_key': 'placeholder_key', 'api_model': 'main-model', 'fast_api_model': 'fast-model'},
+            'openweathermap': {'api_key': 'placeholder_key', 'update_interval': '10', 'location': '0,0'},
+        })
+        # Profiles are opened in the working directory
+        self.previous_dir = os.getcwd()
+        self.temp_dir = tempfile.mkdtemp()
+        os.chdir(self.temp_dir)
+        with patch.object(GPTCommunication, 'start_weather_updater'):
+            self.gpt_comm = GPTCommunication(':memory:', config=config)
+
+    def tearDown(self):
+        self.gpt_comm.executor.shutdown()
+        os.chdir(self.previous_dir)
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    async def test_replies_in_flight_concurrently(self):
+        in_flight = 0
+        most_in_flight = 0
+
+        async def acreate(model, messages):
+            nonlocal in_flight, most_in_flight
+            if model == 'fast-model':
+                return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=''))])
+            in_flight += 1
+            most_in_flight = max(most_in_flight, in_flight)
+            await asyncio.sleep(0.05)
+            in_flight -= 1
+            reply = messages[-1]['content'].split('.')[0]
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(
+                content=f"r: Reply to {reply}\nsummary: Greeting\ni: 5.0\nc: greeting"))])
+
+        with patch('openai.ChatCompletion.acreate', side_effect=acreate):
+            responses = await asyncio.gather(*[self.gpt_comm.asend_message(f'Message {i}') for i in range(5)])
+
+        self.assertEqual(responses, [f'Reply to Message {i}' for i in range(5)])
+        self.assertEqual(most_in_flight, 5)
+        self.assertEqual(len(self.gpt_comm.memory_db.get_dialogue_history(max_length=10000)), 10)
+
+    async def test_prompt_stages_run_concurrently(self):
+        retrieval_finished = threading.Event()
+        fast_model_called_during_retrieval = []
+        retrieve_relevant_memories = self.gpt_comm.memory_db.retrieve_relevant_memories
+
+        def slow_retrieval(*args, **kwargs):
+            time.sleep(0.2)
+            retrieval_finished.set()
+            return retrieve_relevant_memories(*args, **kwargs)
+
+        async def acreate(model, messages):
+            if model == 'fast-model':
+                fast_model_called_during_retrieval.append(not retrieval_finished.is_set())
+                return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=''))])
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(
+                content="r: Hello!\nsummary: Greeting\ni: 1.0\nc: greeting"))])
+
+        with patch.object(self.gpt_comm.memory_db, 'retrieve_relevant_memories', side_effect=slow_retrieval), \
+                patch('openai.ChatCompletion.acreate', side_effect=acreate):
+            self.assertEqual(await self.gpt_comm.asend_message("Hello"), "Hello!")
+
+        self.assertEqual(fast_model_called_during_retrieval, [True])
+        self.assertEqual(set(self.gpt_comm.last_stage_timings), {'history', 'retrieval', 'save_input', 'fast_analysis',
+                                                                 'profile_prefetch', 'counters', 'prompt'})
+        self.assertGreaterEqual(self.gpt_comm.last_stage_timings['retrieval'], 200)
+
+    async def test_stage_timings_kept_per_conversation(self):
+        retrieve_relevant_memories = self.gpt_comm.memory_db.retrieve_relevant_memories
+
+        def retrieval(*args, **kwargs):
+            if kwargs['session_key'] == 'slow':
+                time.sleep(0.2)
+            return retrieve_relevant_memories(*args, **kwargs)
+
+        response = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(
+            content="r: Hello!\nsummary: Greeting\ni: 1.0\nc: greeting"))])
+        with patch.object(self.gpt_comm.memory_db, 'retrieve_relevant_memories', side_effect=retrieval), \
+                patch('openai.ChatCompletion.acreate', new_callable=AsyncMock, return_value=response):
+            await asyncio.gather(self.gpt_comm.asend_message("Hello", conversation_id='slow'),
+                                 self.gpt_comm.asend_message("Hello", conversation_id='fast'))
+
+        self.assertGreaterEqual(self.gpt_comm.sessions.get('slow').last_stage_timings['retrieval'], 200)
+        self.assertLess(self.gpt_comm.sessions.get('fast').last_stage_timings['retrieval'], 200)
+        self.assertIn('input', self.gpt_comm.sessions.get('fast').last_token_usage)
+
+    async def test_conversations_kept_apart(self):
+        async def acreate(model, messages):
+            if model == 'fast-model':
+                return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=''))])
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(
+                content="r: Hello!\nsummary: Greeting\ni: 1.0\nc: greeting\nCH: Said hello"))])
+
+        with patch('openai.ChatCompletion.acreate', side_effect=acreate):
+            await asyncio.gather(self.gpt_comm.asend_message("Hello", conversation_id='a'),
+                                 self.gpt_comm.asend_message("Goodbye", conversation_id='b'))
+
+        prompts = [self.gpt_comm.sessions.get(conversation_id).messages for conversation_id in ('a', 'b')]
+        self.assertTrue(prompts[0][-2]['content'].startswith('Hello.'))
+        self.assertTrue(prompts[1][-2]['content'].startswith('Goodbye.'))
+        self.assertEqual(self.gpt_comm.sessions.get('a').get_condensed_history(), ['Said hello'])
+        self.assertEqual([entry['content'] for entry in self.gpt_comm.memory_db.get_dialogue_history(
+            conversation_id='b')], ['Hello!', 'Goodbye'])
+        self.assertEqual(list(self.gpt_comm.dialogue_history_condensed), [])
+
+    async def test_history_condensed_per_conversation(self):
+        condensed_for = []
+
+        async def acreate(model, messages):
+            if model == 'fast-model':
+                return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=''))])
+            if 'CH: <' in messages[-1]['content']:
+                condensed_for.append(messages[-1]['content'].split('.')[0])
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(
+                content="r: Hello!\nsummary: Greeting\ni: 1.0\nc: greeting"))])
+
+        # Interleaved, so a counter shared between them would reach 10 halfway through each conversation
+        with patch('openai.ChatCompletion.acreate', side_effect=acreate):
+            for i in range(1, 11):
+                await self.gpt_comm.asend_message(f'a{i}', conversation_id='a')
+                await self.gpt_comm.asend_message(f'b{i}', conversation_id='b')
+
+        self.assertEqual(condensed_for, ['a10', 'b10'])
+
+    async def test_repeated_input_hits_embedding_cache(self):
+        response = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(
+            content="r: Hello!\nsummary: Greeting\ni: 1.0\nc: greeting"))])
+        with patch('openai.ChatCompletion.acreate', new_callable=AsyncMock, return_value=response):
+            for _ in range(3):
+                await self.gpt_comm.asend_message("Hello")
+
+        # The first has no dialogue before it, the others are queried with the same last reply
+        stats = self.gpt_comm.memory_db.embedding_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+    async def test_cached_response_reused_until_profile_changes(self):
+        self.gpt_comm.response_cache = ResponseCache()
+        response = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(
+            content="r: Hello!\nsummary: Greeting\ni: 1.0\nc: greeting"))])
+
+        with patch('openai.ChatCompletion.acreate', new_callable=AsyncMock, return_value=response) as acreate:
+            self.assertEqual(await self.gpt_comm.asend_message("Hello"), "Hello!")
+            self.assertEqual(await self.gpt_comm.asend_message(" hello"), "Hello!")
+            self.assertEqual(acreate.call_count, 2)
+
+            self.gpt_comm.perform_action('STORE(User, favourite colour, blue)')
+            self.assertEqual(await self.gpt_comm.asend_message("Hello"), "Hello!")
+            self.assertEqual(acreate.call_count, 4)
+
+        self.assertEqual(self.gpt_comm.response_cache.stats()['exact_hits'], 1)
+        self.assertEqual(len(self.gpt_comm.memory_db.get_dialogue_history(max_length=10000)), 6)
+
+    async def test_stream_message_yields_body_and_saves_memory(self):
+        async def chunks(content):
+            for i in range(0, len(content), 4):
+                yield {'choices': [{'delta': {'content': content[i:i + 4]}}]}
+
+        async def acreate(model, messages, stream=False):
+            if model == 'fast-model':
+                return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=''))])
+            self.assertTrue(stream)
+            return chunks("r: Hello there!\nHow are you?\nsummary: Greeted the user\ni: 9.0\nc: greeting")
+
+        with patch('openai.ChatCompletion.acreate', side_effect=acreate), \
+                patch.object(self.gpt_comm.memory_db, 'save_memory') as save_memory:
+            pieces = [piece async for piece in self.gpt_comm.astream_message("Hello")]
+
+        self.assertGreater(len(pieces), 1)
+        self.assertEqual(''.join(pieces), "Hello there!\nHow are you?")
+        self.assertEqual(save_memory.call_args[0][0], 'greeting')
+        self.assertEqual(save_memory.call_args[0][1], 'Greeted the user')
+        self.assertEqual(save_memory.call_args[0][3], 9.0)
+        self.assertEqual(self.gpt_comm.memory_db.get_dialogue_history()[0]['content'], "Hello there!\nHow are you?")
+
+    async def test_memories_saved_to_namespace(self):
+        response = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(
+            content="r: Hello!\nsummary: Greeting\ni: 9.0\nc: greeting"))])
+        with patch('openai.ChatCompletion.acreate', new_callable=AsyncMock, return_value=response):
+            await self.gpt_comm.asend_message("Hello", conversation_id='discord:1', memory_namespace='discord:guild:1')
+
+        memory_db = self.gpt_comm.memory_db
+        memories = memory_db.retrieve_relevant_memories("greeting", namespace='discord:guild:1', include_global=False)
+        self.assertEqual([memory['namespace'] for memory in memories], ['discord:guild:1'])
+        self.assertEqual(memory_db.retrieve_relevant_memories("greeting"), [])
+
+    def test_send_message_wraps_asend_message(self):
+        response = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="r: Hello!\nsummary: Greeting\ni: 1.0\nc: greeting"))])
+        with patch('openai.ChatCompletion.acreate', new_callable=AsyncMock, return_value=response) as acreate:
+            self.assertEqual(self.gpt_comm.send_message("Hello"), "Hello!")
+        self.assertEqual(acreate.call_count, 2)
+        self.assertEqual(self.gpt_comm.messages[-1], {"role": "assistant", "content": "Hello!"})
+
+
 if __name__ == "__main__":
     unittest.main()
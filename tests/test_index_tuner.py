@@ -0,0 +1,30 @@
+import unittest
+
+import numpy as np
+
+from index_tuner import exact_neighbours, tune
+
+
+class TestIndexTuner(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.ids = np.arange(100, 400)
+        self.embeddings = rng.normal(size=(300, 8)).astype(np.float32)
+        self.queries = rng.normal(size=(20, 8)).astype(np.float32)
+
+    def test_exact_neighbours(self):
+        neighbours = exact_neighbours(self.embeddings, self.embeddings[:5], 3, chunk_size=2)
+        self.assertEqual(neighbours.shape, (5, 3))
+        self.assertEqual(neighbours[:, 0].tolist(), [0, 1, 2, 3, 4])
+
+    def test_tune_picks_fastest_passing_settings(self):
+        # A search_k covering every item makes Annoy's search exhaustive, so that setting always passes
+        results, best = tune(self.ids, self.embeddings, self.queries, 5, 1.0, [2], [1, 1000])
+        self.assertEqual(len(results), 2)
+        self.assertEqual(best['recall'], 1.0)
+        self.assertEqual(best['n_trees'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,20 @@
 import unittest
 from unittest.mock import patch, MagicMock
 
-from memory_database import MemoryDatabase
+from conversation_session import DEFAULT_CONVERSATION_ID
+from db_connection import SQLiteDatabase
+from memory_database import ArbitraryData, Base, MemoryDatabase, Memories, ProfileData, ProfileStore
+from memory_metadata import MemoryMetadataStore
+from token_counter import count_tokens
+from sqlalchemy import text
 import numpy as np
 import tempfile
+import glob
 import os
+import shutil
+import sqlite3
+import threading
+import time
 
 
 class TestMemoryDatabase(unittest.TestCase):
@@ -30,7 +40,8 @@ class TestMemoryDatabase(unittest.TestCase):
         self.memory_db = MemoryDatabase(self.temp_db_file)
 
     def tearDown(self):
-        os.remove(self.temp_db_file)
+        for path in glob.glob(f'{self.temp_db_file}*'):
+            os.remove(path)
 
     def test_save_dialogue_entry(self):
         self.memory_db.save_dialogue_entry("user", "Hello, how are you?", "2023-04-05 10:00:00")
@@ -38,12 +49,214 @@ class TestMemoryDatabase(unittest.TestCase):
         self.assertEqual(len(history), 1)
         self.assertEqual(history[0]["content"], "Hello, how are you?")
 
+    def test_dialogue_history_newest_first_within_length(self):
+        for minute in range(5):
+            self.memory_db.save_dialogue_entry("user", f"Message {minute}", f"2023-04-05 10:0{minute}:00")
+
+        history = self.memory_db.get_dialogue_history(max_length=30)
+        self.assertEqual([entry["content"] for entry in history], ["Message 4", "Message 3", "Message 2"])
+        history = self.memory_db.get_dialogue_history(2)
+        self.assertEqual([entry["content"] for entry in history], ["Message 4", "Message 3"])
+
+    def test_dialogue_history_by_conversation(self):
+        self.memory_db.save_dialogue_entry("user", "Hello", "2023-04-05 10:00:00", conversation_id='discord:1')
+        self.memory_db.save_dialogue_entry("user", "Hi", "2023-04-05 10:01:00", conversation_id='discord:2')
+
+        history = self.memory_db.get_dialogue_history(conversation_id='discord:1')
+        self.assertEqual([entry["content"] for entry in history], ["Hello"])
+        history = list(self.memory_db.iter_dialogue_history(conversation_id='discord:2'))
+        self.assertEqual([entry["content"] for entry in history], ["Hi"])
+        self.assertEqual(len(self.memory_db.get_dialogue_history()), 2)
+
+    def test_dialogue_from_before_conversations_is_default_conversations(self):
+        temp_db_file = tempfile.mktemp()
+        with sqlite3.connect(temp_db_file) as connection:
+            connection.execute("CREATE TABLE dialogue_history (id INTEGER PRIMARY KEY, content VARCHAR NOT NULL, "
+                               "speaker VARCHAR NOT NULL, timestamp VARCHAR NOT NULL)")
+            connection.execute("INSERT INTO dialogue_history (content, speaker, timestamp) "
+                               "VALUES ('Hello there', 'user', '2023-04-05 10:00:00')")
+        connection.close()
+
+        memory_db = MemoryDatabase(temp_db_file)
+        memory_db.save_dialogue_entry("user", "Hi", "2023-04-05 10:01:00")
+        history = memory_db.get_dialogue_history(conversation_id=DEFAULT_CONVERSATION_ID)
+        self.assertEqual([entry["content"] for entry in history], ["Hi", "Hello there"])
+        memory_db.close()
+        for path in glob.glob(f'{temp_db_file}*'):
+            os.remove(path)
+
+    def test_iter_dialogue_history(self):
+        for minute in range(5):
+            self.memory_db.save_dialogue_entry("user", f"Message {minute}", "2023-04-05 10:00:00")
+
+        history = list(self.memory_db.iter_dialogue_history(page_size=2))
+        self.assertEqual([entry["content"] for entry in history], [f"Message {i}" for i in reversed(range(5))])
+        older = list(self.memory_db.iter_dialogue_history(before=(history[1]["timestamp"], history[1]["id"])))
+        self.assertEqual(older, history[2:])
+
     def test_save_memory(self):
         self.memory_db.save_memory("Greeting", "Hello", "2023-04-05 10:00:00", 1.0)
         memories = self.memory_db.get_all_memories()
         self.assertEqual(len(memories), 1)
         self.assertEqual(memories[0][1], "Greeting")
 
+    def test_insert_memory_stores_embedding(self):
+        self.memory_db.insert_memory("Greeting", "Hello", "2023-04-05 10:00:00", 5.0)
+        with self.memory_db.db.read_session() as session:
+            memory = session.query(Memories).first()
+        embedding = np.frombuffer(memory.embedding, dtype=np.float32)
+        self.assertEqual(embedding.shape, (300,))
+
+    def test_backfill_embeddings(self):
+        with self.memory_db.db.write_session() as session:
+            session.add(Memories(memory_summary="Greeting", related_prompt="Hello", embedding=None,
+                                 timestamp="2023-04-05 10:00:00", importance=5.0))
+
+        self.assertEqual(self.memory_db.backfill_embeddings(), 1)
+        self.assertEqual(self.memory_db.backfill_embeddings(), 0)
+
+        with self.memory_db.db.read_session() as session:
+            memory = session.query(Memories).first()
+        self.assertEqual(len(memory.embedding), 300 * 4)
+
+    def test_dialogue_history_within_tokens(self):
+        for minute in range(3):
+            self.memory_db.save_dialogue_entry("user", "word " * 40, f"2023-04-05 10:0{minute}:00")
+
+        history = self.memory_db.get_dialogue_history(max_tokens=2 * count_tokens("word " * 40))
+        self.assertEqual(len(history), 2)
+        self.assertEqual(history[0]["token_count"], count_tokens("word " * 40))
+
+    def test_token_count_columns_added_and_backfilled(self):
+        temp_db_file = tempfile.mktemp()
+        with sqlite3.connect(temp_db_file) as connection:
+            connection.execute("CREATE TABLE dialogue_history (id INTEGER PRIMARY KEY, content VARCHAR NOT NULL, "
+                               "speaker VARCHAR NOT NULL, timestamp VARCHAR NOT NULL)")
+            connection.execute("INSERT INTO dialogue_history (content, speaker, timestamp) "
+                               "VALUES ('Hello there', 'user', '2023-04-05 10:00:00')")
+        connection.close()
+
+        memory_db = MemoryDatabase(temp_db_file)
+        history = memory_db.get_dialogue_history()
+        self.assertEqual(history[0]["token_count"], count_tokens("Hello there"))
+        self.assertEqual(memory_db.backfill_token_counts(), 0)
+        memory_db.close()
+        for path in glob.glob(f'{temp_db_file}*'):
+            os.remove(path)
+
+    def test_token_count_backfill_recorded(self):
+        self.memory_db.save_dialogue_entry("user", "Hello there", "2023-04-05 10:00:00")
+        with self.memory_db.db.write_session() as session:
+            session.execute(text("UPDATE dialogue_history SET token_count = NULL"))
+
+        # Recorded as done when the database was opened, so the tables aren't scanned again
+        self.assertEqual(self.memory_db.backfill_token_counts(), 0)
+
+        with self.memory_db.db.write_session() as session:
+            session.query(ArbitraryData).filter(ArbitraryData.key == 'token_counts_backfilled').update(
+                {ArbitraryData.str_value: 'another-tokenizer'})
+        self.assertEqual(self.memory_db.backfill_token_counts(), 1)
+        self.assertEqual(self.memory_db.backfill_token_counts(), 0)
+
+    def test_generate_embeddings(self):
+        embeddings = self.memory_db.generate_embeddings(["Hello, how are you?", ""])
+        self.assertEqual(embeddings.shape, (2, 300))
+        np.testing.assert_array_equal(embeddings[0], self.memory_db._generate_embedding("Hello, how are you?"))
+
+    def test_index_snapshot_reloaded_and_topped_up(self):
+        self.memory_db.insert_memory("Greeting", "Hello", "2023-04-05 10:00:00", 5.0)
+        self.assertTrue(os.path.exists(f'{self.temp_db_file}.annoy'))
+
+        # Saved after the snapshot was written, so it has to be added on top of it
+        self.memory_db.insert_memory("Farewell", "Goodbye", "2023-04-05 10:01:00", 5.0)
+        reopened_db = MemoryDatabase(self.temp_db_file)
+        self.assertEqual(len(reopened_db.vector_index), 2)
+        self.assertEqual(len(reopened_db.vector_index._delta), 2)
+
+        reopened_db.vector_index.rebuild(background=False)
+        reopened_db = MemoryDatabase(self.temp_db_file)
+        self.assertEqual(len(reopened_db.vector_index), 2)
+        self.assertEqual(len(reopened_db.vector_index._delta), 0)
+
+    def test_stale_index_snapshot_rebuilt(self):
+        self.memory_db.insert_memory("Greeting", "Hello", "2023-04-05 10:00:00", 5.0)
+        self.memory_db.vector_index.rebuild(background=False)
+
+        with self.memory_db.db.write_session() as session:
+            session.query(Memories).delete()
+
+        reopened_db = MemoryDatabase(self.temp_db_file)
+        self.assertEqual(len(reopened_db.vector_index), 0)
+
+    def test_retrieve_memories_uses_metadata_store(self):
+        self.memory_db.insert_memory("greeting, hello", "Hello", "2023-04-05 10:00:00", 2.0)
+        self.memory_db.insert_memory("farewell, goodbye", "Goodbye", "2023-04-05 10:01:00", 8.0)
+        self.memory_db.memory_metadata = MemoryMetadataStore()
+
+        # The first retrieval fills the store from SQLite, the second is served from it
+        for _ in range(2):
+            retrieved_memories = self.memory_db.retrieve_relevant_memories("hello", num_results=2,
+                                                                           similarity_weight=0.0)
+            self.assertEqual([memory['related_prompt'] for memory in retrieved_memories], ["Goodbye", "Hello"])
+        self.assertEqual(len(self.memory_db.memory_metadata), 2)
+
+        self.memory_db.update_memory(retrieved_memories[1]['memory_id'], "2023-04-05 10:02:00", 9.0)
+        retrieved_memories = self.memory_db.retrieve_relevant_memories("hello", num_results=2, similarity_weight=0.0)
+        self.assertEqual(retrieved_memories[0]['related_prompt'], "Hello")
+        self.assertEqual(retrieved_memories[0]['timestamp'], "2023-04-05 10:02:00")
+
+        self.memory_db.delete_memory(retrieved_memories[0]['memory_id'])
+        retrieved_memories = self.memory_db.retrieve_relevant_memories("hello", num_results=2, similarity_weight=0.0)
+        self.assertEqual([memory['related_prompt'] for memory in retrieved_memories], ["Goodbye"])
+
+    def test_namespaces_searched_separately(self):
+        self.memory_db.insert_memory("greeting", "Hello", "2023-04-05 10:00:00", 5.0, namespace='discord:guild:1')
+        self.memory_db.insert_memory("greeting", "Hi", "2023-04-05 10:01:00", 5.0, namespace='discord:guild:2')
+        self.memory_db.insert_memory("greeting", "Hey", "2023-04-05 10:02:00", 5.0)
+
+        retrieved_memories = self.memory_db.retrieve_relevant_memories("greeting", namespace='discord:guild:1')
+        self.assertEqual(sorted(memory['related_prompt'] for memory in retrieved_memories), ["Hello", "Hey"])
+        retrieved_memories = self.memory_db.retrieve_relevant_memories("greeting", namespace='discord:guild:1',
+                                                                       include_global=False)
+        self.assertEqual([memory['related_prompt'] for memory in retrieved_memories], ["Hello"])
+        self.assertEqual([memory['related_prompt'] for memory in self.memory_db.retrieve_relevant_memories("greeting")],
+                         ["Hey"])
+
+    def test_namespace_indexes_loaded_lazily_and_evicted(self):
+        memory_db = MemoryDatabase(self.temp_db_file, max_loaded_namespaces=2)
+        memory_db.insert_memory("greeting", "Hello", "2023-04-05 10:00:00", 5.0, namespace='discord:guild:1')
+        self.assertEqual(memory_db.loaded_namespaces(), ['global'])
+
+        self.assertEqual(len(memory_db.retrieve_relevant_memories("greeting", namespace='discord:guild:1')), 1)
+        self.assertTrue(os.path.exists(f'{self.temp_db_file}.discord%3Aguild%3A1.annoy'))
+        memory_db.retrieve_relevant_memories("greeting", namespace='discord:guild:2')
+        self.assertCountEqual(memory_db.loaded_namespaces(), ['global', 'discord:guild:2'])
+
+        # Saved while unloaded, so it's added on top of the snapshot when the namespace is next searched
+        memory_db.insert_memory("farewell", "Goodbye", "2023-04-05 10:01:00", 5.0, namespace='discord:guild:1')
+        retrieved_memories = memory_db.retrieve_relevant_memories("greeting", namespace='discord:guild:1',
+                                                                  include_global=False)
+        self.assertEqual(sorted(memory['related_prompt'] for memory in retrieved_memories), ["Goodbye", "Hello"])
+        self.assertEqual(len(memory_db.partition('discord:guild:1').vector_index._delta), 1)
+        self.assertTrue(memory_db.unload_namespace('discord:guild:1'))
+        self.assertEqual(memory_db.loaded_namespaces(), ['global'])
+
+    def test_memories_without_namespace_are_global(self):
+        temp_db_file = tempfile.mktemp()
+        with sqlite3.connect(temp_db_file) as connection:
+            connection.execute("CREATE TABLE memories (id INTEGER PRIMARY KEY, memory_summary VARCHAR, "
+                               "related_prompt VARCHAR, embedding BLOB, timestamp VARCHAR, importance FLOAT)")
+            connection.execute("INSERT INTO memories (memory_summary, related_prompt, timestamp, importance) "
+                               "VALUES ('Greeting', 'Hello', '2023-04-05 10:00:00', 5.0)")
+        connection.close()
+
+        memory_db = MemoryDatabase(temp_db_file)
+        retrieved_memories = memory_db.retrieve_relevant_memories("Greeting")
+        self.assertEqual([memory['namespace'] for memory in retrieved_memories], ['global'])
+        memory_db.close()
+        for path in glob.glob(f'{temp_db_file}*'):
+            os.remove(path)
+
     def test_retrieve_relevant_memories(self):
         self.memory_db.save_memory("Greeting", "Hello", "2023-04-05 10:00:00", 1.0)
         self.memory_db.save_memory("Farewell", "Goodbye", "2023-04-05 10:01:00", 1.0)
@@ -98,6 +311,44 @@ class TestMemoryDatabase(unittest.TestCase):
         #self.assertEqual(retrieved_memories[2]["related_prompt"], "Hey there!")
         #self.assertEqual(retrieved_memories[3]["related_prompt"], "Hello")
 
+    def test_write_behind_reads_own_writes(self):
+        memory_db = MemoryDatabase(self.temp_db_file, write_behind='async', write_behind_delay=0.05)
+        memory_db.save_dialogue_entry("user", "Hello", "2023-04-05 10:00:00", session_key='conversation')
+        memory_db.insert_memory("greeting, hello", "Hello", "2023-04-05 10:00:00", 5.0, session_key='conversation')
+
+        history = memory_db.get_dialogue_history(session_key='conversation')
+        self.assertEqual([entry["content"] for entry in history], ["Hello"])
+        retrieved_memories = memory_db.retrieve_relevant_memories("hello", session_key='conversation')
+        self.assertEqual([memory['memory_summary'] for memory in retrieved_memories], ["greeting, hello"])
+        memory_db.close()
+
+    def test_write_behind_counters(self):
+        self.memory_db.set_count('replies', 5)
+        memory_db = MemoryDatabase(self.temp_db_file, write_behind='group')
+        self.assertEqual([memory_db.increment_count('replies') for _ in range(3)], [6, 7, 8])
+        memory_db.set_count('replies', 0)
+        self.assertEqual(memory_db.increment_count('replies'), 1)
+        memory_db.close()
+
+        self.assertEqual(self.memory_db.increment_count('replies'), 2)
+
+    def test_grouped_increments_share_a_batch(self):
+        memory_db = MemoryDatabase(self.temp_db_file, write_behind='group', write_behind_delay=0.2)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(memory_db.increment_count('replies')))
+                   for _ in range(5)]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+        memory_db.close()
+
+        self.assertEqual(sorted(results), [1, 2, 3, 4, 5])
+        self.assertLess(elapsed, 0.6)
+        self.assertEqual(self.memory_db.increment_count('replies'), 6)
+
     def test_calculate_similarity(self):
         embedding1 = np.array([0.5, 0.5, 0.5, 0.5])
         embedding2 = np.array([0.5, 0.5, 0.5, 0.5])
@@ -116,5 +367,71 @@ class TestMemoryDatabase(unittest.TestCase):
         self.assertEqual(processed_text, ["hello,", "how", "are", "you?"])
 
 
+class TestProfileStore(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.profile_store = ProfileStore(os.path.join(self.temp_dir, 'profiles.db'), max_cached_profiles=2)
+
+    def tearDown(self):
+        self.profile_store.db.dispose()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_profiles_kept_apart_and_persisted(self):
+        self.profile_store.get('ada').set_key_value('favourite music', 'jazz')
+        self.profile_store.get('grace').set_key_value('favourite music', 'opera')
+        self.profile_store.get('ada').set_key_value('favourite musc', 'blues')
+
+        reopened_store = ProfileStore(os.path.join(self.temp_dir, 'profiles.db'))
+        self.assertEqual(reopened_store.get('ada').get_all_keys(), ['favourite music'])
+        self.assertEqual(reopened_store.get('ada').get_key_value('favourite music'), 'blues')
+        self.assertEqual(reopened_store.get('grace').get_key_value('favourite music'), 'opera')
+
+        reopened_store.get('ada').delete_key('favourite music')
+        self.assertIsNone(ProfileStore(os.path.join(self.temp_dir, 'profiles.db')).get('ada').get_key_value(
+            'favourite music'))
+        reopened_store.db.dispose()
+
+    def test_least_recently_used_profiles_evicted(self):
+        ada = self.profile_store.get('ada')
+        self.profile_store.get('grace')
+        self.assertIs(self.profile_store.get('ada'), ada)
+        self.profile_store.get('alan')
+
+        self.assertEqual(len(self.profile_store), 2)
+        self.assertIn('ada', self.profile_store)
+        self.assertNotIn('grace', self.profile_store)
+
+    def test_evicted_profile_still_in_use_can_write(self):
+        ada = self.profile_store.get('ada')
+        self.profile_store.get('grace')
+        self.profile_store.get('alan')
+        reloaded_ada = self.profile_store.get('ada')
+        self.assertIsNot(reloaded_ada, ada)
+
+        reloaded_ada.set_key_value('favourite music', 'jazz')
+        ada.set_key_value('favourite music', 'blues')
+        reloaded_ada.set_key_value('favourite food', 'pasta')
+        ada.set_key_value('favourite food', 'curry')
+
+        reopened_store = ProfileStore(os.path.join(self.temp_dir, 'profiles.db'))
+        self.assertEqual(sorted(reopened_store.get('ada').get_all_keys()), ['favourite food', 'favourite music'])
+        self.assertEqual(reopened_store.get('ada').get_key_value('favourite music'), 'blues')
+        self.assertEqual(reopened_store.get('ada').get_key_value('favourite food'), 'curry')
+        reopened_store.db.dispose()
+
+    def test_migrate_profile_files(self):
+        old_profile = SQLiteDatabase(os.path.join(self.temp_dir, 'ada_profile.db'))
+        old_profile.create_all(Base.metadata)
+        with old_profile.write_session() as session:
+            session.add(ProfileData(key='favourite music', value='jazz'))
+        old_profile.dispose()
+
+        self.assertEqual(self.profile_store.migrate_profile_files(self.temp_dir), 1)
+        self.assertEqual(self.profile_store.get('ada').get_key_value('favourite music'), 'jazz')
+        self.assertTrue(os.path.exists(os.path.join(self.temp_dir, 'ada_profile.db.migrated')))
+        self.assertEqual(self.profile_store.migrate_profile_files(self.temp_dir), 0)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,95 @@
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import openai
+
+from openai_client import PRIORITY_BACKGROUND, PRIORITY_REPLY, OpenAIClient, TokenBucket
+
+
+def make_response(content: str = 'OK', total_tokens: int = None):
+    response = MagicMock()
+    response.choices[0].message.content = content
+    response.usage.total_tokens = total_tokens
+    return response
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_delay_until_refilled(self):
+        bucket = TokenBucket(60, capacity=2)
+        start = bucket.updated
+        bucket.take(2, start)
+        # Asking for more than the bucket holds waits for it to fill rather than forever
+        self.assertAlmostEqual(bucket.delay_for(10, start), 2.0)
+        self.assertAlmostEqual(bucket.delay_for(1, start), 1.0)
+        self.assertEqual(bucket.delay_for(1, start + 1), 0.0)
+
+
+class TestOpenAIClient(unittest.IsolatedAsyncioTestCase):
+
+    async def test_reply_served_before_background_requests(self):
+        client = OpenAIClient(requests_per_minute=60)
+        client._limiter('model').requests.level = 0
+        order = []
+
+        async def acreate(model, messages, **kwargs):
+            order.append(messages[0]['content'])
+            return make_response()
+
+        with patch('openai.ChatCompletion.acreate', side_effect=acreate):
+            background = asyncio.create_task(client.chat_completion(
+                'model', [{'role': 'user', 'content': 'background'}], priority=PRIORITY_BACKGROUND))
+            await asyncio.sleep(0.05)
+            reply = asyncio.create_task(client.chat_completion(
+                'model', [{'role': 'user', 'content': 'reply'}], priority=PRIORITY_REPLY))
+            await asyncio.sleep(0.05)
+            self.assertEqual(client.queue_depth('model'), 2)
+            await asyncio.gather(background, reply)
+
+        self.assertEqual(order, ['reply', 'background'])
+        stats = client.stats()['model']
+        self.assertEqual(stats['queued'], 0)
+        self.assertGreater(stats['max_wait'], 0.5)
+
+    async def test_rate_limit_retried_after_retry_after(self):
+        client = OpenAIClient()
+        rate_limited = openai.error.RateLimitError('Rate limited', headers={'retry-after-ms': '50'})
+        acreate = AsyncMock(side_effect=[rate_limited, make_response('Hello')])
+
+        with patch('openai.ChatCompletion.acreate', acreate), \
+                patch('openai_client.asyncio.sleep', wraps=asyncio.sleep) as sleep:
+            response = await client.chat_completion('model', [{'role': 'user', 'content': 'Hi'}])
+
+        self.assertEqual(response.choices[0].message.content, 'Hello')
+        self.assertEqual(acreate.await_count, 2)
+        self.assertAlmostEqual(sleep.await_args_list[0].args[0], 0.05)
+        self.assertEqual(client.stats()['model']['rate_limited'], 1)
+
+    async def test_gives_up_after_max_retries(self):
+        client = OpenAIClient(max_retries=2, base_delay=0.01)
+        acreate = AsyncMock(side_effect=openai.error.ServiceUnavailableError('Overloaded'))
+
+        with patch('openai.ChatCompletion.acreate', acreate):
+            with self.assertRaises(openai.error.ServiceUnavailableError):
+                await client.chat_completion('model', [{'role': 'user', 'content': 'Hi'}])
+        self.assertEqual(acreate.await_count, 3)
+
+    async def test_request_errors_not_retried(self):
+        client = OpenAIClient()
+        acreate = AsyncMock(side_effect=openai.error.InvalidRequestError('Too long', 'messages'))
+
+        with patch('openai.ChatCompletion.acreate', acreate):
+            with self.assertRaises(openai.error.InvalidRequestError):
+                await client.chat_completion('model', [{'role': 'user', 'content': 'Hi'}])
+        self.assertEqual(acreate.await_count, 1)
+
+    async def test_tokens_used_charged_against_limit(self):
+        client = OpenAIClient(tokens_per_minute=1000)
+        with patch('openai.ChatCompletion.acreate', AsyncMock(return_value=make_response(total_tokens=400))):
+            await client.chat_completion('model', [{'role': 'user', 'content': 'Hi'}])
+        self.assertAlmostEqual(client._limiter('model').tokens.level, 600, delta=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
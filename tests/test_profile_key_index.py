@@ -0,0 +1,37 @@
+import unittest
+
+from fuzzywuzzy import process
+
+from profile_key_index import ProfileKeyIndex
+
+
+class TestProfileKeyIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.keys = [f'{topic} {detail}' for topic in ('favourite', 'least favourite', 'learning', 'watching')
+                     for detail in ('music', 'film', 'book', 'food', 'language', 'sport', 'game', 'show')]
+        self.key_index = ProfileKeyIndex(self.keys, max_candidates=8)
+
+    def test_exact_match_short_circuits(self):
+        self.assertEqual(self.key_index.extract('Favourite Music!'), [('favourite music', 100)])
+
+    def test_best_match_same_as_scoring_every_key(self):
+        for query in ('favourite musik', 'learning languages', 'watching a show', 'least favorite food', 'sport'):
+            self.assertLessEqual(len(self.key_index.candidates(query)), 8)
+            self.assertEqual(self.key_index.extract(query)[0], process.extract(query, self.keys)[0])
+
+    def test_add_and_remove(self):
+        self.key_index.add('pronouns')
+        self.assertIn('pronouns', self.key_index.candidates('pronouns please'))
+        self.key_index.remove('pronouns')
+        self.assertNotIn('pronouns', self.key_index)
+        self.assertNotIn('pronouns', self.key_index.candidates('pronouns please'))
+        self.assertEqual(len(self.key_index), len(self.keys))
+
+    def test_small_profiles_score_every_key(self):
+        key_index = ProfileKeyIndex(['name', 'age'])
+        self.assertEqual(key_index.candidates('zzz'), ['age', 'name'])
+
+
+if __name__ == '__main__':
+    unittest.main()
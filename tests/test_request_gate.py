@@ -0,0 +1,50 @@
+import threading
+import time
+import unittest
+
+from request_gate import Overloaded, RequestGate
+
+
+class TestRequestGate(unittest.TestCase):
+
+    def test_queue_full_rejected_with_retry_after(self):
+        gate = RequestGate(max_concurrent=1, max_queued=1, per_user_limit=5, queue_timeout=5)
+        first = gate.acquire('a')
+        queued = []
+        waiter = threading.Thread(target=lambda: queued.append(gate.acquire('b')))
+        waiter.start()
+        while gate.stats()['queued'] == 0:
+            time.sleep(0.01)
+
+        with self.assertRaises(Overloaded) as context:
+            gate.acquire('c')
+        self.assertGreaterEqual(context.exception.retry_after, 1)
+        self.assertTrue(gate.is_saturated())
+
+        first.release()
+        waiter.join()
+        self.assertEqual(gate.stats()['active'], 1)
+        queued[0].release()
+        self.assertEqual(gate.stats()['rejected'], 1)
+
+    def test_per_user_limit(self):
+        gate = RequestGate(max_concurrent=4, per_user_limit=2)
+        with gate.acquire('a'), gate.acquire('a'):
+            with self.assertRaises(Overloaded):
+                gate.acquire('a')
+            gate.acquire('b').release()
+        # Given back on leaving the with block
+        gate.acquire('a').release()
+        self.assertEqual(gate.stats()['active'], 0)
+
+    def test_queue_timeout(self):
+        gate = RequestGate(max_concurrent=1, queue_timeout=0.05)
+        with gate.acquire('a'):
+            with self.assertRaises(Overloaded):
+                gate.acquire('b')
+        self.assertEqual(gate.stats()['queued'], 0)
+        gate.acquire('b').release()
+
+
+if __name__ == '__main__':
+    unittest.main()
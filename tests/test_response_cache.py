@@ -0,0 +1,58 @@
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+
+from response_cache import ResponseCache
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def test_exact_and_similar_inputs_hit_for_same_user(self):
+        cache = ResponseCache(similarity_threshold=0.95)
+        cache.put('channel', 'Ada', 'What time is it?', 'Half past two', np.array([1.0, 0.0, 0.0]))
+
+        self.assertEqual(cache.get('channel', 'ada', '  what time  is it?'), 'Half past two')
+        self.assertEqual(cache.get('channel', 'Ada', 'What is the time?', np.array([0.99, 0.1, 0.0])),
+                         'Half past two')
+        self.assertIsNone(cache.get('channel', 'Ada', 'Tell me a joke', np.array([0.0, 1.0, 0.0])))
+        self.assertIsNone(cache.get('channel', 'Grace', 'What time is it?', np.array([1.0, 0.0, 0.0])))
+        self.assertIsNone(cache.get('other channel', 'Ada', 'What time is it?'))
+
+        stats = cache.stats()
+        self.assertEqual((stats['exact_hits'], stats['similar_hits'], stats['misses']), (1, 1, 3))
+        self.assertAlmostEqual(stats['hit_rate'], 0.4)
+
+    def test_expired_after_ttl(self):
+        cache = ResponseCache(ttl=60)
+        with patch('response_cache.time.monotonic', return_value=0):
+            cache.put('channel', 'Ada', 'Hello', 'Hi Ada!')
+        with patch('response_cache.time.monotonic', return_value=30):
+            self.assertEqual(cache.get('channel', 'Ada', 'Hello'), 'Hi Ada!')
+        with patch('response_cache.time.monotonic', return_value=61):
+            self.assertIsNone(cache.get('channel', 'Ada', 'Hello'))
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidated_by_user(self):
+        cache = ResponseCache()
+        cache.put('a', 'Ada', 'Hello', 'Hi Ada!')
+        cache.put('b', 'Ada', 'Hello', 'Hi again Ada!')
+        cache.put('a', 'Grace', 'Hello', 'Hi Grace!')
+
+        self.assertEqual(cache.invalidate_user(' ada'), 2)
+        self.assertIsNone(cache.get('b', 'Ada', 'Hello'))
+        self.assertEqual(cache.get('a', 'Grace', 'Hello'), 'Hi Grace!')
+
+    def test_oldest_dropped_past_max_entries(self):
+        cache = ResponseCache(max_entries=2)
+        for i in range(3):
+            cache.put('channel', 'Ada', f'Question {i}', f'Answer {i}', np.array([1.0, float(i)]))
+        cache.put('channel', 'Ada', 'Question 2', 'New answer 2')
+
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('channel', 'Ada', 'Question 0'))
+        self.assertEqual(cache.get('channel', 'Ada', 'Question 2'), 'New answer 2')
+
+
+if __name__ == '__main__':
+    unittest.main()
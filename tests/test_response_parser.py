@@ -0,0 +1,57 @@
+import unittest
+
+from response_parser import StreamingResponseParser, parse_response
+
+RESPONSE = "r: Hello Ada!\nHow are you?\nsummary: Assistant greeted Ada\ni: 4.5\nc: greeting, Ada\nCH: Said hello"
+
+
+class TestParseResponse(unittest.TestCase):
+
+    def test_body_and_trailer(self):
+        parsed = parse_response(RESPONSE)
+        self.assertEqual(parsed.body, "Hello Ada!\nHow are you?")
+        self.assertEqual(parsed.memory_summary, "Assistant greeted Ada")
+        self.assertEqual(parsed.importance, 4.5)
+        self.assertEqual(parsed.content_words, "greeting, Ada")
+        self.assertEqual(parsed.conversation_history_condensed, "Said hello")
+
+    def test_unformatted_response_is_all_body(self):
+        parsed = parse_response("Hello Ada!", importance=2.0)
+        self.assertEqual(parsed.body, "Hello Ada!")
+        self.assertEqual(parsed.importance, 2.0)
+        self.assertIsNone(parsed.content_words)
+
+
+class TestStreamingResponseParser(unittest.TestCase):
+
+    def stream(self, response: str, piece_length: int):
+        parser = StreamingResponseParser()
+        pieces = [parser.feed(response[i:i + piece_length]) for i in range(0, len(response), piece_length)]
+        rest, parsed = parser.finish()
+        return pieces, rest, parsed
+
+    def test_body_streamed_and_trailer_held_back(self):
+        for piece_length in (1, 3, 8, len(RESPONSE)):
+            pieces, rest, parsed = self.stream(RESPONSE, piece_length)
+            self.assertEqual(''.join(pieces) + rest, parse_response(RESPONSE).body)
+            self.assertEqual(parsed.content_words, "greeting, Ada")
+            self.assertNotIn('summary', ''.join(pieces))
+
+        pieces, _, _ = self.stream(RESPONSE, 1)
+        # Everything but the last line of the body is out before the reply ends
+        self.assertTrue(''.join(pieces).startswith("Hello Ada!\nHow are you"))
+
+    def test_lines_starting_like_trailer_lines_streamed(self):
+        response = "r: I think\nCats are great\nsummary: Cats\ni: 1.0\nc: cats"
+        pieces, rest, _ = self.stream(response, 1)
+        self.assertEqual(''.join(pieces), "I think\nCats are great")
+        self.assertEqual(rest, '')
+
+    def test_unformatted_response_streamed_whole(self):
+        pieces, rest, parsed = self.stream("Hello Ada!", 2)
+        self.assertEqual(''.join(pieces) + rest, "Hello Ada!")
+        self.assertEqual(parsed.body, "Hello Ada!")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import glob
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from vector_index import VectorIndex
+
+
+class TestVectorIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+        self.vectors = {item_id: self.rng.normal(size=8).astype(np.float32) for item_id in range(50)}
+        self.index = VectorIndex(8, rebuild_threshold=1000)
+        self.index.build(self.vectors.items())
+
+    def test_added_items_are_searchable_before_rebuild(self):
+        new_vector = self.rng.normal(size=8).astype(np.float32)
+        self.index.add_item(100, new_vector)
+
+        ids, distances = self.index.get_nns_by_vector(new_vector, 1, include_distances=True)
+        self.assertEqual(ids, [100])
+        self.assertAlmostEqual(distances[0], 0.0, places=3)
+        self.assertEqual(len(self.index), 51)
+
+    def test_delta_distances_match_annoy(self):
+        query = self.rng.normal(size=8).astype(np.float32)
+        ids, distances = self.index.get_nns_by_vector(query, 5, include_distances=True)
+
+        delta_index = VectorIndex(8)
+        for item_id in ids:
+            delta_index.add_item(item_id, self.vectors[item_id])
+        delta_ids, delta_distances = delta_index.get_nns_by_vector(query, 5, include_distances=True)
+
+        self.assertEqual(delta_ids, ids)
+        np.testing.assert_allclose(delta_distances, distances, atol=1e-4)
+
+    def test_removed_and_replaced_items(self):
+        self.index.remove_item(3)
+        ids = self.index.get_nns_by_vector(self.vectors[3], 50)
+        self.assertNotIn(3, ids)
+
+        replacement = -self.vectors[4]
+        self.index.add_item(4, replacement)
+        ids, distances = self.index.get_nns_by_vector(replacement, 1, include_distances=True)
+        self.assertEqual(ids, [4])
+        self.assertEqual(self.index.get_nns_by_vector(self.vectors[4], 50).count(4), 1)
+
+    def test_rebuild_merges_delta(self):
+        self.index.rebuild_threshold = 5
+        for item_id in range(100, 105):
+            self.index.add_item(item_id, self.rng.normal(size=8).astype(np.float32))
+        self.index.remove_item(0)
+        self.index.wait_for_rebuild()
+        self.index.rebuild(background=False)
+
+        self.assertEqual(len(self.index), 54)
+        self.assertEqual(self.index._delta, {})
+        self.assertEqual(self.index._hidden_ids, set())
+        self.assertNotIn(0, self.index.get_nns_by_vector(self.vectors[0], 60))
+
+    def test_snapshot_round_trip(self):
+        snapshot_path = os.path.join(tempfile.mkdtemp(), 'index.annoy')
+        index = VectorIndex(8, snapshot_path=snapshot_path, snapshot_metadata=lambda ids: {'max_id': max(ids)})
+        index.build(self.vectors.items())
+
+        loaded_index = VectorIndex(8, snapshot_path=snapshot_path)
+        metadata = loaded_index.load_snapshot()
+        self.assertEqual(metadata['max_id'], 49)
+        self.assertEqual(metadata['item_count'], 50)
+        self.assertEqual(loaded_index.get_nns_by_vector(self.vectors[7], 1), [7])
+        self.assertIsNone(VectorIndex(16, snapshot_path=snapshot_path).load_snapshot())
+
+        for path in glob.glob(f'{snapshot_path}*'):
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
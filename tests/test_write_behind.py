@@ -0,0 +1,69 @@
+import glob
+import os
+import tempfile
+import threading
+import unittest
+
+from db_connection import SQLiteDatabase
+from memory_database import Base, ProfileData
+from write_behind import WriteBehindQueue
+
+
+class TestWriteBehindQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_db_file = tempfile.mktemp()
+        self.db = SQLiteDatabase(self.temp_db_file)
+        self.db.create_all(Base.metadata)
+        self.write_behind = WriteBehindQueue(self.db, max_delay=0.05)
+
+    def tearDown(self):
+        self.write_behind.close()
+        self.db.dispose()
+        for path in glob.glob(f'{self.temp_db_file}*'):
+            os.remove(path)
+
+    def count_rows(self) -> int:
+        with self.db.read_session() as session:
+            return session.query(ProfileData).count()
+
+    def test_writes_committed_in_batches(self):
+        futures = [self.write_behind.submit(lambda session, i=i: session.add(ProfileData(key=f'key{i}', value='v')))
+                   for i in range(20)]
+        self.write_behind.flush()
+
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertEqual(self.count_rows(), 20)
+        self.assertLess(self.write_behind.stats()['batches'], 20)
+
+    def test_failed_write_only_fails_itself(self):
+        first = self.write_behind.submit(lambda session: session.add(ProfileData(key='name', value='Ada')))
+        duplicate = self.write_behind.submit(lambda session: session.add(ProfileData(key='name', value='Grace')))
+        last = self.write_behind.submit(lambda session: session.add(ProfileData(key='pronouns', value='she/her')))
+        self.write_behind.flush()
+
+        self.assertIsNone(first.exception())
+        self.assertIsNotNone(duplicate.exception())
+        self.assertIsNone(last.exception())
+        self.assertEqual(self.count_rows(), 2)
+
+    def test_wait_for_key_and_on_commit(self):
+        committed = threading.Event()
+        self.write_behind.submit(lambda session: session.add(ProfileData(key='name', value='Ada')),
+                                 on_commit=lambda _: committed.set(), key='conversation')
+        self.write_behind.wait_for('conversation')
+
+        self.assertTrue(committed.is_set())
+        self.assertEqual(self.count_rows(), 1)
+
+    def test_close_commits_queued_writes(self):
+        self.write_behind.submit(lambda session: session.add(ProfileData(key='name', value='Ada')))
+        self.write_behind.close()
+
+        self.assertEqual(self.count_rows(), 1)
+        with self.assertRaises(RuntimeError):
+            self.write_behind.submit(lambda session: None)
+
+
+if __name__ == '__main__':
+    unittest.main()
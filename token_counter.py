@@ -0,0 +1,46 @@
+import functools
+from typing import Dict, List
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Counts made with another tokenizer are recounted, see MemoryDatabase.backfill_token_counts
+TOKENIZER_NAME = 'tiktoken:cl100k_base' if tiktoken is not None else 'characters/4'
+# Each chat message costs a few tokens on top of its content, for its role and separators
+MESSAGE_OVERHEAD_TOKENS = 4
+# Every reply is primed with a few tokens
+REPLY_PRIMING_TOKENS = 3
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding():
+    # Used by every chat model this project runs, gpt-3.5-turbo and gpt-4
+    return tiktoken.get_encoding('cl100k_base')
+
+
+@functools.lru_cache(maxsize=8192)
+def count_tokens(text: str) -> int:
+    """
+    The number of tokens in text, counted with tiktoken if it's installed, otherwise estimated at four characters a
+    token.
+
+    Cached, as the same memories and summaries are in prompt after prompt.
+    """
+    if not text:
+        return 0
+    if tiktoken is None:
+        return (len(text) + 3) // 4
+    return len(_encoding().encode(text, disallowed_special=()))
+
+
+def message_tokens(content_tokens: int) -> int:
+    """The tokens a chat message takes up, given the tokens in its content"""
+    return content_tokens + MESSAGE_OVERHEAD_TOKENS
+
+
+def count_message_tokens(messages: List[Dict[str, str]]) -> int:
+    """The tokens a chat prompt takes up, including the priming of the reply"""
+    return sum(message_tokens(count_tokens(message.get('content') or '')) for message in messages) \
+        + REPLY_PRIMING_TOKENS
@@ -0,0 +1,255 @@
+import json
+import os
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+import numpy as np
+from annoy import AnnoyIndex
+
+
+class VectorIndex:
+    """
+    Angular nearest neighbour index made of a built Annoy index plus a small delta of recently added vectors.
+
+    Annoy indexes can't be added to once built, so new vectors go into the delta which is searched exactly with NumPy
+    and merged with the Annoy results. When the delta grows past rebuild_threshold the main index is rebuilt in a
+    background thread and swapped in, so inserts never pay for a rebuild themselves.
+
+    If snapshot_path is given, the main index is built straight into that file and can be memory-mapped back in with
+    load_snapshot(), so processes on the same host share its pages through the page cache. snapshot_metadata is
+    called with the ids in each new snapshot and whatever it returns is stored alongside it.
+    """
+
+    def __init__(self, dimensions: int, n_trees: int = 10, rebuild_threshold: int = 1000,
+                 snapshot_path: str = None, snapshot_metadata: Callable[[Set[int]], Dict] = None, search_k: int = -1):
+        self.dimensions = dimensions
+        self.n_trees = n_trees
+        # Nodes Annoy inspects per search, -1 is Annoy's default of n * n_trees
+        self.search_k = search_k
+        self.rebuild_threshold = rebuild_threshold
+        self.snapshot_path = snapshot_path
+        self.snapshot_metadata = snapshot_metadata
+
+        self._lock = threading.Lock()
+        self._main_index: Optional[AnnoyIndex] = None
+        self._main_ids: Set[int] = set()
+        # Ids in the main index that mustn't be returned from it, because they were removed or replaced in the delta
+        self._hidden_ids: Set[int] = set()
+        self._delta: Dict[int, np.ndarray] = {}
+        self._delta_ids: Optional[np.ndarray] = None
+        self._delta_matrix: Optional[np.ndarray] = None
+        # Ids added or removed while a rebuild is running, used to work out which ids to hide in the new index
+        self._changed_during_rebuild: Set[int] = set()
+        self._rebuild_thread: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._main_ids - self._hidden_ids) + len(self._delta)
+
+    def build(self, items: Iterable[Tuple[int, np.ndarray]]):
+        """
+        Build the main index from scratch, replacing anything already in the index.
+
+        :param items: (id, vector) pairs to index.
+        """
+        index, temp_path = self._new_annoy_index()
+        ids = set()
+        for item_id, vector in items:
+            index.add_item(item_id, vector)
+            ids.add(item_id)
+        index.build(self.n_trees)
+        self._save_snapshot(temp_path, ids)
+
+        with self._lock:
+            self._main_index = index
+            self._main_ids = ids
+            self._hidden_ids = set()
+            self._delta = {}
+            self._invalidate_delta()
+
+    def load_snapshot(self) -> Optional[Dict]:
+        """
+        Memory-map the snapshot at snapshot_path as the main index, replacing anything already in the index.
+
+        :return: The metadata stored with the snapshot, or None if there's no usable snapshot.
+        """
+        if self.snapshot_path is None or not os.path.exists(f'{self.snapshot_path}.json'):
+            return None
+        try:
+            with open(f'{self.snapshot_path}.json') as metadata_file:
+                metadata = json.load(metadata_file)
+            ids = np.load(f'{self.snapshot_path}.ids.npy')
+            # Guards against the index and its metadata coming from different writes
+            if metadata.get('index_size') != os.path.getsize(self.snapshot_path) or \
+                    metadata.get('dimensions') != self.dimensions or metadata.get('item_count') != len(ids):
+                return None
+            index = AnnoyIndex(self.dimensions, 'angular')
+            index.load(self.snapshot_path)
+        except (OSError, ValueError) as e:
+            print(f"Unable to load index snapshot {self.snapshot_path}: {e}")
+            return None
+
+        with self._lock:
+            self._main_index = index
+            self._main_ids = set(ids.tolist())
+            self._hidden_ids = set()
+            self._delta = {}
+            self._invalidate_delta()
+        return metadata
+
+    def add_item(self, item_id: int, vector: np.ndarray):
+        """Add or replace a vector, it is searchable immediately"""
+        with self._lock:
+            self._delta[item_id] = np.asarray(vector, dtype=np.float32)
+            self._invalidate_delta()
+            if item_id in self._main_ids:
+                self._hidden_ids.add(item_id)
+            if self._rebuild_thread is not None:
+                self._changed_during_rebuild.add(item_id)
+        self._maybe_start_rebuild()
+
+    def remove_item(self, item_id: int):
+        with self._lock:
+            if self._delta.pop(item_id, None) is not None:
+                self._invalidate_delta()
+            if item_id in self._main_ids:
+                self._hidden_ids.add(item_id)
+            if self._rebuild_thread is not None:
+                self._changed_during_rebuild.add(item_id)
+        self._maybe_start_rebuild()
+
+    def get_nns_by_vector(self, vector: np.ndarray, n: int, search_k: int = None, include_distances: bool = False) \
+            -> Union[List[int], Tuple[List[int], List[float]]]:
+        """
+        Find the n nearest neighbours of vector, same signature and angular distances as AnnoyIndex.get_nns_by_vector.
+        search_k defaults to the index's search_k.
+        """
+        if search_k is None:
+            search_k = self.search_k
+        with self._lock:
+            main_index = self._main_index
+            hidden_ids = set(self._hidden_ids)
+            delta_ids, delta_matrix = self._get_delta_arrays()
+
+        results = []
+        if main_index is not None and n > 0:
+            # Fetch extra results to make up for any hidden ones that get filtered out
+            ids, distances = main_index.get_nns_by_vector(vector, n + len(hidden_ids), search_k=search_k,
+                                                          include_distances=True)
+            results.extend((distance, item_id) for item_id, distance in zip(ids, distances)
+                           if item_id not in hidden_ids)
+
+        if delta_ids is not None and n > 0:
+            distances = self._angular_distances(delta_matrix, vector)
+            nearest = np.argsort(distances, kind='stable')[:n]
+            results.extend((float(distances[i]), int(delta_ids[i])) for i in nearest)
+
+        results.sort()
+        results = results[:n]
+        ids = [item_id for _, item_id in results]
+        if include_distances:
+            return ids, [distance for distance, _ in results]
+        return ids
+
+    def rebuild(self, background: bool = True):
+        """Merge the delta into a freshly built main index"""
+        with self._lock:
+            thread = self._rebuild_thread
+            if thread is None:
+                # Snapshot under the same lock that resets the change log so nothing slips between the two
+                snapshot = (self._main_index, self._main_ids - self._hidden_ids, dict(self._delta))
+                self._changed_during_rebuild = set()
+                thread = threading.Thread(target=self._rebuild, args=snapshot, daemon=True)
+                self._rebuild_thread = thread
+                thread.start()
+        if not background:
+            thread.join()
+
+    def wait_for_rebuild(self, timeout: float = None):
+        thread = self._rebuild_thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _maybe_start_rebuild(self):
+        if len(self._delta) + len(self._hidden_ids) >= self.rebuild_threshold:
+            self.rebuild()
+
+    def _rebuild(self, old_index: Optional[AnnoyIndex], old_ids: Set[int], delta: Dict[int, np.ndarray]):
+        try:
+            index, temp_path = self._new_annoy_index()
+            for item_id in old_ids:
+                if item_id not in delta:
+                    index.add_item(item_id, old_index.get_item_vector(item_id))
+            for item_id, vector in delta.items():
+                index.add_item(item_id, vector)
+            index.build(self.n_trees)
+            new_ids = old_ids | delta.keys()
+            self._save_snapshot(temp_path, new_ids)
+
+            with self._lock:
+                # Anything that changed while building is still in the delta or was removed, either way the new
+                # index's copy is out of date
+                for item_id, vector in delta.items():
+                    if self._delta.get(item_id) is vector:
+                        del self._delta[item_id]
+                self._invalidate_delta()
+                self._hidden_ids = {item_id for item_id in self._changed_during_rebuild if item_id in new_ids}
+                self._main_index = index
+                self._main_ids = new_ids
+        finally:
+            with self._lock:
+                self._rebuild_thread = None
+                self._changed_during_rebuild = set()
+
+    def _new_annoy_index(self) -> Tuple[AnnoyIndex, Optional[str]]:
+        """Returns a new index, built on disk in a temporary file next to the snapshot if snapshots are enabled"""
+        index = AnnoyIndex(self.dimensions, 'angular')
+        if self.snapshot_path is None:
+            return index, None
+        temp_path = f'{self.snapshot_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        index.on_disk_build(temp_path)
+        return index, temp_path
+
+    def _save_snapshot(self, temp_path: Optional[str], ids: Set[int]):
+        """Move a finished on-disk build into place and write its ids and metadata, each replaced atomically"""
+        if temp_path is None:
+            return
+        metadata = dict(self.snapshot_metadata(ids)) if self.snapshot_metadata is not None else {}
+        metadata.update({'dimensions': self.dimensions, 'n_trees': self.n_trees, 'item_count': len(ids),
+                         'index_size': os.path.getsize(temp_path)})
+        # The built index stays mapped from the renamed file, so it can still be queried afterwards
+        os.replace(temp_path, self.snapshot_path)
+
+        with open(f'{temp_path}.ids.npy', 'wb') as ids_file:
+            np.save(ids_file, np.fromiter(ids, dtype=np.int64, count=len(ids)))
+        os.replace(f'{temp_path}.ids.npy', f'{self.snapshot_path}.ids.npy')
+
+        with open(f'{temp_path}.json', 'w') as metadata_file:
+            json.dump(metadata, metadata_file)
+        os.replace(f'{temp_path}.json', f'{self.snapshot_path}.json')
+
+    def _invalidate_delta(self):
+        self._delta_ids = None
+        self._delta_matrix = None
+
+    def _get_delta_arrays(self) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+        """Returns the delta ids and their unit-normalised vectors, caching them until the delta changes"""
+        if not self._delta:
+            return None, None
+        if self._delta_ids is None:
+            self._delta_ids = np.fromiter(self._delta.keys(), dtype=np.int64, count=len(self._delta))
+            matrix = np.stack(list(self._delta.values()))
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            self._delta_matrix = np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+        return self._delta_ids, self._delta_matrix
+
+    @staticmethod
+    def _angular_distances(unit_matrix: np.ndarray, vector: np.ndarray) -> np.ndarray:
+        """Annoy's angular distance, sqrt(2 - 2 * cos), treating zero vectors as orthogonal to everything"""
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            return np.full(len(unit_matrix), np.sqrt(2.0))
+        cosines = unit_matrix @ (vector / norm)
+        # Rows that were zero vectors have a cosine of 0 and so also end up at sqrt(2)
+        return np.sqrt(np.maximum(2.0 - 2.0 * cosines, 0.0))
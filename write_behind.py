@@ -0,0 +1,172 @@
+import atexit
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional
+
+from sqlalchemy.orm import Session
+
+from db_connection import SQLiteDatabase
+
+# Writes are committed by the caller as it makes them, one transaction each
+WRITE_BEHIND_OFF = 'off'
+# Writes are queued and committed in batches, callers wait for their batch's commit, so a write is as durable on return
+# as it would be otherwise
+WRITE_BEHIND_GROUP = 'group'
+# Writes are queued and callers return straight away, anything queued when the process dies without exiting normally
+# is lost
+WRITE_BEHIND_ASYNC = 'async'
+WRITE_BEHIND_MODES = (WRITE_BEHIND_OFF, WRITE_BEHIND_GROUP, WRITE_BEHIND_ASYNC)
+
+
+class _QueuedWrite:
+    __slots__ = ('operation', 'on_commit', 'key', 'future')
+
+    def __init__(self, operation: Callable[[Session], Any], on_commit: Optional[Callable[[Any], None]],
+                 key: Optional[Hashable]):
+        self.operation = operation
+        self.on_commit = on_commit
+        self.key = key
+        self.future = Future()
+
+
+class WriteBehindQueue:
+    """
+    Queues writes and commits them from a background thread, as many as have queued up per transaction, so a burst of
+    writes pays for one commit rather than one each.
+
+    Writes are committed in the order they were submitted. If a batch fails its writes are retried one per transaction,
+    so one bad write only fails itself.
+    """
+
+    def __init__(self, db: SQLiteDatabase, max_batch_size: int = 256, max_delay: float = 0.01):
+        """
+        :param db: The database to write to.
+        :param max_batch_size: The most writes committed per transaction.
+        :param max_delay: How long in seconds to let writes gather after the first before committing them.
+        """
+        self.db = db
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self._condition = threading.Condition()
+        self._pending: Deque[_QueuedWrite] = deque()
+        self._last_write: Optional[_QueuedWrite] = None
+        self._last_write_by_key: Dict[Hashable, _QueuedWrite] = {}
+        self._closed = False
+        self.batch_count = 0
+        self.write_count = 0
+
+        self._writer_thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._writer_thread.start()
+        # Daemon threads are killed at exit, so flush what's queued first
+        atexit.register(self.close)
+
+    def submit(self, operation: Callable[[Session], Any], on_commit: Callable[[Any], None] = None,
+               key: Hashable = None) -> Future:
+        """
+        Queue a write.
+
+        :param operation: Makes the write, called with a session on the writer connection, it mustn't commit.
+        :param on_commit: Called on the writer thread with what operation returned, once it's committed.
+        :param key: Groups writes whose reads need to see them, see wait_for.
+        :return: A future for what operation returned, set once it's committed.
+        """
+        write = _QueuedWrite(operation, on_commit, key)
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Write-behind queue is closed")
+            self._pending.append(write)
+            self._last_write = write
+            if key is not None:
+                self._last_write_by_key[key] = write
+            self._condition.notify_all()
+        return write.future
+
+    def wait_for(self, key: Hashable = None, timeout: float = None):
+        """
+        Wait until the writes submitted so far are committed, so they'll be seen by reads that follow.
+
+        :param key: Only wait for writes submitted with this key, or for every write if None.
+        :param timeout: The most seconds to wait.
+        """
+        with self._condition:
+            write = self._last_write if key is None else self._last_write_by_key.get(key)
+        if write is not None:
+            # Failed writes have already been reported, they're as done as they'll get
+            write.future.exception(timeout)
+
+    def flush(self, timeout: float = None):
+        self.wait_for(timeout=timeout)
+
+    def close(self):
+        """Commit everything queued and stop the writer"""
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify_all()
+        self._writer_thread.join()
+        atexit.unregister(self.close)
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def stats(self) -> Dict:
+        with self._condition:
+            return {'pending': len(self._pending), 'batches': self.batch_count, 'writes': self.write_count,
+                    'writes_per_batch': self.write_count / self.batch_count if self.batch_count else 0.0}
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                # Give other requests a moment to add to the batch
+                deadline = time.monotonic() + self.max_delay
+                while len(self._pending) < self.max_batch_size and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch = [self._pending.popleft() for _ in range(min(self.max_batch_size, len(self._pending)))]
+            self._commit(batch)
+
+    def _commit(self, batch: List[_QueuedWrite]):
+        try:
+            with self.db.write_session() as session:
+                results = [write.operation(session) for write in batch]
+        except Exception as e:
+            if len(batch) == 1:
+                print(f"ERROR in write-behind: {type(e)} {e}")
+                self._finish(batch[0], error=e)
+            else:
+                print(f"Write-behind batch of {len(batch)} failed, retrying one at a time: {type(e)} {e}")
+                for write in batch:
+                    self._commit([write])
+            return
+
+        with self._condition:
+            self.batch_count += 1
+            self.write_count += len(batch)
+        for write, result in zip(batch, results):
+            self._finish(write, result)
+
+    def _finish(self, write: _QueuedWrite, result: Any = None, error: Exception = None):
+        if error is None and write.on_commit is not None:
+            try:
+                write.on_commit(result)
+            except Exception as e:
+                print(f"ERROR in write-behind on_commit: {type(e)} {e}")
+        if error is None:
+            write.future.set_result(result)
+        else:
+            write.future.set_exception(error)
+
+        with self._condition:
+            if self._last_write is write:
+                self._last_write = None
+            if write.key is not None and self._last_write_by_key.get(write.key) is write:
+                del self._last_write_by_key[write.key]